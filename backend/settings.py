@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -137,6 +138,46 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Уменьшенные копии загруженных изображений (core.images)
+IMAGE_RENDITION_WIDTHS = (160, 320, 640, 1024)
+IMAGE_RENDITIONS_ASYNC = True
+
+# Срок хранения ответов по Idempotency-Key (core.idempotency)
+IDEMPOTENCY_KEY_TTL_HOURS = 24
+# Через сколько секунд незавершённый запрос считается брошенным и повтор выполняется заново
+IDEMPOTENCY_PENDING_LEASE_SECONDS = 30
+
+# Локальная шина событий (core.events) и SSE-лента заказов (cart.feed)
+EVENTS_BUFFER_SIZE = 500
+ORDER_STREAM_MAX_SECONDS = 300
+
+# Очистка отработавших кодов лояльности (loyalty.maintenance).
+# Интервал встроенного планировщика в секундах; None — выключен, запускать
+# manage.py purge_loyalty_codes по cron.
+LOYALTY_CODE_RETENTION_HOURS = 24
+LOYALTY_CODE_PURGE_INTERVAL_SECONDS = None
+
+# Ключ перестановки номеров в коды лояльности (loyalty.codes). Только из
+# окружения; без него при DEBUG = False не проходит системная проверка
+# loyalty.E001 (manage.py check, runserver, migrate)
+LOYALTY_CODE_SECRET = os.environ.get('LOYALTY_CODE_SECRET', '')
+if not LOYALTY_CODE_SECRET and DEBUG:
+    # Только для разработки: коды с известным ключом предсказуемы
+    LOYALTY_CODE_SECRET = 'dev-only-loyalty-code-secret'
+
+# Как часто воркер сверяет версию таблицы рангов в памяти (core.ranks), секунд
+RANK_CACHE_CHECK_SECONDS = 5
+
+# Кэш аутентификации по токену (core.authentication): LRU в памяти процесса и,
+# если задан алиас из CACHES, общий кэш между воркерами
+TOKEN_AUTH_CACHE_SIZE = 10000
+TOKEN_AUTH_CACHE_TTL_SECONDS = 60
+TOKEN_AUTH_SHARED_CACHE = None
+
+# Карточка клиента для /api/client/info/ (core.cards): алиас из CACHES и срок хранения
+CLIENT_CARD_CACHE = 'default'
+CLIENT_CARD_CACHE_SECONDS = 300
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,82 @@
+"""Лента заказов заведения: публикация событий и формат Server-Sent Events.
+
+События публикуются в топик orders:shop:<id> локального брокера core.events:
+order.created — новый заказ, order.status — смена статуса. В data лежит тот же
+объект заказа, что отдаёт API, поэтому планшету баристы не нужно дозапрашивать
+заказ после уведомления.
+"""
+import json
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from core.events import broker, publish_on_commit
+
+EVENT_ORDER_CREATED = 'order.created'
+EVENT_ORDER_STATUS = 'order.status'
+# Позиция клиента потеряна (перезапуск, другой воркер): нужно перечитать список заказов
+EVENT_RESET = 'reset'
+
+# Ограничения ожидания: long-poll и одно SSE-соединение
+LONG_POLL_MAX_TIMEOUT = 30
+HEARTBEAT_SECONDS = 15
+
+
+def order_topic(coffee_shop_id):
+    return f'orders:shop:{coffee_shop_id}'
+
+
+def publish_order(order, event_type, data):
+    """data — сериализованный заказ (OrderSerializer), уже посчитанный для ответа."""
+    publish_on_commit(order_topic(order.coffee_shop_id), event_type, data)
+
+
+def event_to_dict(event):
+    return {'id': event.id, 'type': event.type, 'order': event.data}
+
+
+def _format_sse(event):
+    data = json.dumps(event.data, cls=DjangoJSONEncoder, ensure_ascii=False)
+    return f'id: {event.id}\nevent: {event.type}\ndata: {data}\n\n'
+
+
+def _stream_start(after, reset):
+    """Начало потока; reset — Last-Event-ID не от этого брокера, клиент перечитывает заказы."""
+    start = 'retry: 1000\n\n'
+    if reset:
+        start += f'id: {after}\nevent: {EVENT_RESET}\ndata: {{}}\n\n'
+    return start
+
+
+def _stream_deadline():
+    return time.monotonic() + getattr(settings, 'ORDER_STREAM_MAX_SECONDS', 300)
+
+
+def sse_stream(topic, after, reset=False):
+    """Синхронный поток для WSGI. Соединение закрывается по ORDER_STREAM_MAX_SECONDS,
+    EventSource переподключается сам и передаёт Last-Event-ID."""
+    yield _stream_start(after, reset)
+    deadline = _stream_deadline()
+    while time.monotonic() < deadline:
+        events = broker.wait(topic, after, min(HEARTBEAT_SECONDS, max(deadline - time.monotonic(), 0)))
+        if not events:
+            yield ': ping\n\n'
+            continue
+        for event in events:
+            yield _format_sse(event)
+        after = events[-1].id
+
+
+async def sse_stream_async(topic, after, reset=False):
+    """То же для ASGI: ожидание не держит event loop."""
+    yield _stream_start(after, reset)
+    deadline = _stream_deadline()
+    while time.monotonic() < deadline:
+        events = await broker.await_events(topic, after, min(HEARTBEAT_SECONDS, max(deadline - time.monotonic(), 0)))
+        if not events:
+            yield ': ping\n\n'
+            continue
+        for event in events:
+            yield _format_sse(event)
+        after = events[-1].id
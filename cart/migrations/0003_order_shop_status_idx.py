@@ -0,0 +1,17 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0002_order_planned_coffee_quantity_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['coffee_shop', 'status', 'created_at'], name='cart_order_shop_status_idx'),
+        ),
+    ]
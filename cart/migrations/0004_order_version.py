@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0003_order_shop_status_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Версия'),
+        ),
+    ]
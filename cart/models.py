@@ -49,12 +49,29 @@ class Order(models.Model):
     planned_earn_points = models.IntegerField(default=0, verbose_name=_('План к начислению (в баллах)'))
     planned_coffee_quantity = models.IntegerField(default=0, verbose_name=_('Плановое количество кофе'))
 
+    # Номер изменения для оптимистичной блокировки (см. cart.transitions)
+    version = models.PositiveIntegerField(default=0, verbose_name=_('Версия'))
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Лента и список заказов заведения с фильтром по статусу и дате
+            models.Index(fields=['coffee_shop', 'status', 'created_at'], name='cart_order_shop_status_idx'),
+        ]
+
     def __str__(self) -> str:
         return f"Order #{self.id} ({self.get_status_display()})"
 
+    def save(self, *args, **kwargs):
+        # Любая запись существующего заказа (в т.ч. из админки) — новая версия
+        if self.pk and not self._state.adding:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'version'}
+        super().save(*args, **kwargs)
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items', verbose_name=_('Заказ'))
@@ -0,0 +1,76 @@
+"""Расчёт корзины перед созданием заказа.
+
+Все варианты товаров загружаются одним запросом (in_bulk), суммы и план
+лояльности считаются в памяти. Запись заказа — в OrderCreateSerializer.
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import List
+
+from rest_framework import serializers
+
+from menue.models import ItemVariant
+from .models import OrderItem
+
+
+@dataclass
+class PricedCart:
+    lines: List[OrderItem] = field(default_factory=list)
+    items_total: int = 0
+    discount_amount: int = 0
+    final_amount: int = 0
+    planned_use_points: bool = False
+    planned_points_to_spend: int = 0
+    planned_earn_points: int = 0
+    planned_coffee_quantity: int = 0
+
+
+def price_cart(items, user=None, use_points=False):
+    """Считает позиции, итоги и план начисления/списания баллов (суммы в копейках)."""
+    variant_ids = [item['variant_id'] for item in items]
+    variants = ItemVariant.objects.select_related('menu_item', 'portion').in_bulk(set(variant_ids))
+    for variant_id in variant_ids:
+        if variant_id not in variants:
+            raise serializers.ValidationError({'items': f'Вариант товара id={variant_id} не найден'})
+
+    cart = PricedCart()
+    for item in items:
+        variant = variants[item['variant_id']]
+        quantity = item['quantity']
+        is_coffee = item.get('is_coffee', False)
+
+        # price: Decimal (som) -> int (kopecks)
+        unit_price_kop = int(Decimal(variant.price) * 100)
+        total_price_kop = unit_price_kop * quantity
+
+        cart.lines.append(OrderItem(
+            item_variant=variant,
+            name_snapshot=variant.menu_item.name,
+            portion_snapshot=str(variant.portion),
+            quantity=quantity,
+            unit_price=unit_price_kop,
+            total_price=total_price_kop,
+            is_coffee=is_coffee,
+        ))
+        cart.items_total += total_price_kop
+        if is_coffee:
+            cart.planned_coffee_quantity += quantity
+
+    if user:
+        # Loyalty planning
+        cart.planned_use_points = bool(use_points)
+        if cart.planned_use_points:
+            max_spend_som = cart.items_total // 100
+            cart.planned_points_to_spend = min(user.points, max_spend_som)
+        # Earn percent by current rank
+        try:
+            from core.ranks import current_rank
+            current = current_rank(user.total_spent)
+            percent = current.cashback_percent if current else 0
+        except Exception:
+            percent = 0
+        cart.planned_earn_points = (cart.items_total // 100) * percent // 100
+
+    cart.discount_amount = cart.planned_points_to_spend * 100
+    cart.final_amount = cart.items_total - cart.discount_amount
+    return cart
@@ -1,8 +1,7 @@
-from decimal import Decimal
-from typing import List
+from django.db import transaction
 from rest_framework import serializers
 from .models import Order, OrderItem
-from menue.models import ItemVariant
+from .pricing import price_cart
 
 
 class OrderItemInputSerializer(serializers.Serializer):
@@ -50,84 +49,34 @@ class OrderCreateSerializer(serializers.Serializer):
         user = request.user if request.user.is_authenticated else None
 
         from core.models import CoffeeShop
-        try:
-            coffee_shop = CoffeeShop.objects.get(id=validated_data['coffee_shop_id'])
-        except CoffeeShop.DoesNotExist:
+        coffee_shop_id = validated_data['coffee_shop_id']
+        if not CoffeeShop.objects.filter(id=coffee_shop_id).exists():
             raise serializers.ValidationError({'coffee_shop_id': 'Заведение не найдено'})
 
-        order = Order.objects.create(
-            user=user,
-            coffee_shop=coffee_shop,
-            delivery_type=validated_data['delivery_type'],
-            payment_method=validated_data['payment_method'],
-            payment_status=Order.PaymentStatus.PENDING,
-            status=Order.Status.NEW,
-            customer_comment=validated_data.get('customer_comment') or '',
-            delivery_address=validated_data.get('delivery_address'),
-        )
-
-        items_total = 0
-        created_items: List[OrderItem] = []
-
-        planned_coffee_qty = 0
-        for item in validated_data['items']:
-            variant_id = item['variant_id']
-            quantity = item['quantity']
-            is_coffee = item.get('is_coffee', False)
-
-            try:
-                variant = ItemVariant.objects.select_related('menu_item', 'portion').get(id=variant_id)
-            except ItemVariant.DoesNotExist:
-                raise serializers.ValidationError({'items': f'Вариант товара id={variant_id} не найден'})
-
-            # price: Decimal (som) -> int (kopecks)
-            unit_price_kop = int(Decimal(variant.price) * 100)
-            total_price_kop = unit_price_kop * quantity
-
-            oi = OrderItem(
-                order=order,
-                item_variant=variant,
-                name_snapshot=variant.menu_item.name,
-                portion_snapshot=str(variant.portion),
-                quantity=quantity,
-                unit_price=unit_price_kop,
-                total_price=total_price_kop,
-                is_coffee=is_coffee,
+        # Всё проверяем и считаем до первой записи: при ошибке в БД ничего не остаётся
+        cart = price_cart(validated_data['items'], user=user, use_points=validated_data.get('use_points', False))
+
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=user,
+                coffee_shop_id=coffee_shop_id,
+                delivery_type=validated_data['delivery_type'],
+                payment_method=validated_data['payment_method'],
+                payment_status=Order.PaymentStatus.PENDING,
+                status=Order.Status.NEW,
+                customer_comment=validated_data.get('customer_comment') or '',
+                delivery_address=validated_data.get('delivery_address'),
+                items_total_amount=cart.items_total,
+                discount_amount=cart.discount_amount,
+                final_amount=cart.final_amount,
+                planned_use_points=cart.planned_use_points,
+                planned_points_to_spend=cart.planned_points_to_spend,
+                planned_earn_points=cart.planned_earn_points,
+                planned_coffee_quantity=cart.planned_coffee_quantity,
             )
-            created_items.append(oi)
-            items_total += total_price_kop
-            if is_coffee:
-                planned_coffee_qty += quantity
-
-        OrderItem.objects.bulk_create(created_items)
-
-        # Loyalty planning
-        planned_use_points = bool(validated_data.get('use_points', False)) if user else False
-        planned_points_to_spend = 0
-        if user and planned_use_points:
-            max_spend_som = items_total // 100
-            planned_points_to_spend = min(user.points, max_spend_som)
-        # Earn percent by current rank
-        planned_earn_points = 0
-        if user:
-            try:
-                from core.models import Rank
-                current, _, _ = Rank.get_progress_percent(user.total_spent)
-                percent = current.cashback_percent if current else 0
-            except Exception:
-                percent = 0
-            planned_earn_points = (items_total // 100) * percent // 100
-
-        order.items_total_amount = items_total
-        order.discount_amount = planned_points_to_spend * 100
-        order.final_amount = items_total - order.discount_amount
-        order.planned_use_points = planned_use_points
-        order.planned_points_to_spend = planned_points_to_spend
-        order.planned_earn_points = planned_earn_points
-        order.planned_coffee_quantity = planned_coffee_qty
-        order.save(update_fields=['items_total_amount', 'discount_amount', 'final_amount',
-                                  'planned_use_points', 'planned_points_to_spend',
-                                  'planned_earn_points', 'planned_coffee_quantity'])
+            for line in cart.lines:
+                line.order = order
+            OrderItem.objects.bulk_create(cart.lines)
 
         return order
 
@@ -144,7 +93,7 @@ class OrderSerializer(serializers.ModelSerializer):
             'items_total_amount', 'discount_amount', 'final_amount',
             'items_total_amount_som', 'final_amount_som',
             'customer_comment', 'delivery_address', 'delivery_latitude', 'delivery_longitude',
-            'items', 'created_at'
+            'items', 'version', 'created_at'
         ]
         read_only_fields = fields
 
@@ -153,3 +102,23 @@ class OrderSerializer(serializers.ModelSerializer):
 
     def get_final_amount_som(self, obj):
         return obj.final_amount / 100
+
+
+class OrderTransitionSerializer(serializers.Serializer):
+    """Пакетная смена статуса: orders — id заказов или {"id", "version"}."""
+    status = serializers.ChoiceField(choices=Order.Status.choices)
+    orders = serializers.ListField(child=serializers.JSONField(), min_length=1, max_length=100)
+
+    def validate_orders(self, value):
+        result = {}
+        for entry in value:
+            if isinstance(entry, dict):
+                order_id, version = entry.get('id'), entry.get('version')
+            else:
+                order_id, version = entry, None
+            if isinstance(order_id, bool) or not isinstance(order_id, int):
+                raise serializers.ValidationError('Ожидается id заказа или {"id": ..., "version": ...}')
+            if version is not None and (isinstance(version, bool) or not isinstance(version, int)):
+                raise serializers.ValidationError('version должна быть числом')
+            result[order_id] = version
+        return result
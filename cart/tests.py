@@ -1,3 +1,308 @@
+from decimal import Decimal
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from core.models import BalanceLedgerEntry, IdempotencyKey, User, CoffeeShop
+from menue.models import Category, MenuItem, Portion, ItemVariant
+from core import ranks
+from core.events import broker
+from .models import Order, OrderItem
 
-# Create your tests here.
+
+class OrderTestMixin:
+    def setUp(self):
+        self.coffee_shop = CoffeeShop.objects.create(name="Test Coffee Shop", address="Test Address")
+        self.client_user = User.objects.create(phone="+70001112233", role=User.ROLE_CLIENT, points=50)
+        portion = Portion.objects.create(name="S", volume=250)
+        category = Category.objects.create(name="Кофе")
+        self.variants = [
+            ItemVariant.objects.create(
+                menu_item=MenuItem.objects.create(category=category, name=f"Напиток {i}"),
+                portion=portion, price=Decimal('150'), is_default=True,
+            )
+            for i in range(5)
+        ]
+        self.api_client = APIClient()
+        # Таблица рангов прогрета, как в работающем процессе
+        ranks.invalidate()
+        ranks.get_table()
+
+    def order_payload(self, variant_ids, **extra):
+        payload = {
+            'coffee_shop_id': self.coffee_shop.id,
+            'delivery_type': 'pickup',
+            'payment_method': 'cash',
+            'items': [{'variant_id': vid, 'quantity': 2, 'is_coffee': True} for vid in variant_ids],
+        }
+        payload.update(extra)
+        return payload
+
+
+class OrderCreateTest(OrderTestMixin, TestCase):
+    def test_order_is_priced_and_written_atomically(self):
+        self.api_client.force_authenticate(self.client_user)
+        payload = self.order_payload([v.id for v in self.variants], use_points=True)
+        # заведение + варианты + SAVEPOINT/INSERT заказа + INSERT позиций + RELEASE + позиции в ответе
+        with self.assertNumQueries(7):
+            response = self.api_client.post(reverse('order-create'), payload, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        order = Order.objects.get()
+        self.assertEqual(order.items_total_amount, 5 * 2 * 15000)
+        self.assertEqual(order.planned_points_to_spend, 50)
+        self.assertEqual(order.final_amount, 5 * 2 * 15000 - 5000)
+        self.assertEqual(order.planned_coffee_quantity, 10)
+        self.assertEqual(len(response.data['items']), 5)
+
+    def test_unknown_variant_leaves_no_order(self):
+        self.api_client.force_authenticate(self.client_user)
+        payload = self.order_payload([self.variants[0].id, 999999])
+        response = self.api_client.post(reverse('order-create'), payload, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class OrderIdempotencyTest(OrderTestMixin, TestCase):
+    def test_retry_with_same_key_is_replayed(self):
+        self.api_client.force_authenticate(self.client_user)
+        url = reverse('order-create')
+        payload = self.order_payload([self.variants[0].id])
+        first = self.api_client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc-1')
+        self.assertEqual(first.status_code, 201)
+
+        with self.assertNumQueries(1):
+            second = self.api_client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc-1')
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.json()['id'], first.json()['id'])
+        self.assertEqual(Order.objects.count(), 1)
+
+        other = self.order_payload([self.variants[1].id])
+        response = self.api_client.post(url, other, format='json', HTTP_IDEMPOTENCY_KEY='abc-1')
+        self.assertEqual(response.status_code, 422)
+
+        self.api_client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc-2')
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_abandoned_pending_key_is_taken_over(self):
+        self.api_client.force_authenticate(self.client_user)
+        url = reverse('order-create')
+        payload = self.order_payload([self.variants[0].id])
+        self.api_client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc-1')
+        # Как после падения воркера посреди запроса: заказ откатился, запись осталась без ответа
+        Order.objects.all().delete()
+        record = IdempotencyKey.objects.get(key='abc-1')
+        IdempotencyKey.objects.filter(pk=record.pk).update(status_code=None, response_body=None)
+        response = self.api_client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc-1')
+        self.assertEqual(response.status_code, 409)
+
+        IdempotencyKey.objects.filter(pk=record.pk).update(created_at=timezone.now() - timezone.timedelta(seconds=31))
+        response = self.api_client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc-1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(IdempotencyKey.objects.get(pk=record.pk).status_code, 201)
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class OrderFeedTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        broker.clear()
+        self.barista = User.objects.create(phone="+70009998877", role=User.ROLE_BARISTA, coffee_shop=self.coffee_shop)
+        other_shop = CoffeeShop.objects.create(name="Other", address="Other")
+        self.other_barista = User.objects.create(phone="+70009998866", role=User.ROLE_BARISTA, coffee_shop=other_shop)
+
+    def poll(self, user, **params):
+        self.api_client.force_authenticate(user)
+        return self.api_client.get(reverse('order-feed'), params)
+
+    def test_new_order_and_status_change_reach_shop_feed(self):
+        start = self.poll(self.barista).data['last_event_id']
+
+        self.api_client.force_authenticate(self.client_user)
+        with self.captureOnCommitCallbacks(execute=True):
+            payload = self.order_payload([self.variants[0].id])
+            created = self.api_client.post(reverse('order-create'), payload, format='json')
+        self.api_client.force_authenticate(self.barista)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api_client.patch(reverse('order-accept', args=[created.data['id']]), {}, format='json')
+
+        # События уже в буфере: ответ без ожидания и без запросов к заказам
+        self.api_client.force_authenticate(self.barista)
+        with self.assertNumQueries(0):
+            response = self.api_client.get(reverse('order-feed'), {'after': start, 'timeout': 5})
+        events = response.data['events']
+        self.assertEqual([e['type'] for e in events], ['order.created', 'order.status'])
+        self.assertEqual(events[0]['order']['id'], created.data['id'])
+        self.assertEqual(events[1]['order']['status'], 'accepted')
+        self.assertEqual(response.data['last_event_id'], events[-1]['id'])
+
+        response = self.poll(self.other_barista, after=start, timeout=0)
+        self.assertEqual(response.data['events'], [])
+
+    def test_foreign_event_id_resets_position(self):
+        current = self.poll(self.barista).data['last_event_id']
+        # Номер до перезапуска (счётчик начинался с нуля) и номер, которого брокер ещё не выдавал
+        for after in (5, current + 1000):
+            with self.assertNumQueries(0):
+                response = self.poll(self.barista, after=after, timeout=5)
+            self.assertEqual(response.data, {'last_event_id': current, 'events': [], 'reset': True})
+
+        self.api_client.force_authenticate(self.barista)
+        response = self.api_client.get(reverse('order-stream'), HTTP_LAST_EVENT_ID='5')
+        self.assertIn(f'id: {current}\nevent: reset\n', next(iter(response.streaming_content)).decode())
+        response.close()
+
+    def test_clients_have_no_feed(self):
+        self.assertEqual(self.poll(self.client_user).status_code, 403)
+
+
+class OrderListTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.barista = User.objects.create(phone="+70009998877", role=User.ROLE_BARISTA, coffee_shop=self.coffee_shop)
+        self.orders = [
+            Order.objects.create(user=self.client_user, coffee_shop=self.coffee_shop, status=status)
+            for status in ['new', 'accepted', 'new', 'completed', 'new']
+        ]
+        for order in self.orders:
+            OrderItem.objects.create(
+                order=order, item_variant=self.variants[0], name_snapshot='x', portion_snapshot='S',
+                quantity=1, unit_price=100, total_price=100,
+            )
+        self.api_client.force_authenticate(self.barista)
+
+    def test_cursor_pages_prefetch_items(self):
+        url = reverse('order-list')
+        # заказы страницы + позиции одним запросом
+        with self.assertNumQueries(2):
+            first = self.api_client.get(url, {'page_size': 2})
+        self.assertEqual([o['id'] for o in first.data['results']], [self.orders[4].id, self.orders[3].id])
+        second = self.api_client.get(first.data['next'])
+        self.assertEqual([o['id'] for o in second.data['results']], [self.orders[2].id, self.orders[1].id])
+
+        # Без параметров пагинации — прежний формат списка
+        self.assertEqual(len(self.api_client.get(url).data), 5)
+
+    def test_status_and_date_filters(self):
+        url = reverse('order-list')
+        response = self.api_client.get(url, {'status': 'new,accepted'})
+        self.assertEqual(len(response.data), 4)
+        today = timezone.localdate(self.orders[0].created_at).isoformat()
+        self.assertEqual(len(self.api_client.get(url, {'created_from': today, 'created_to': today}).data), 5)
+        response = self.api_client.get(url, {'created_from': '2000-01-01T00:00', 'created_to': '2000-01-02'})
+        self.assertEqual(response.data, [])
+        self.assertEqual(self.api_client.get(url, {'status': 'bogus'}).status_code, 400)
+        self.assertEqual(self.api_client.get(url, {'created_from': 'yesterday'}).status_code, 400)
+
+
+class OrderAcceptTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.barista = User.objects.create(phone="+70009998877", role=User.ROLE_BARISTA, coffee_shop=self.coffee_shop)
+        self.order = Order.objects.create(
+            user=self.client_user, coffee_shop=self.coffee_shop, final_amount=30000,
+            planned_use_points=True, planned_points_to_spend=20, planned_earn_points=15, planned_coffee_quantity=2,
+        )
+        OrderItem.objects.create(
+            order=self.order, item_variant=self.variants[0], name_snapshot='x', portion_snapshot='S',
+            quantity=2, unit_price=15000, total_price=30000,
+        )
+        self.api_client.force_authenticate(self.barista)
+
+    def test_accept_applies_loyalty_once(self):
+        url = reverse('order-accept', args=[self.order.id])
+        # заказ + позиции + SAVEPOINT/UPDATE заказа/баланс под блокировкой/UPDATE клиента/запись журнала/RELEASE
+        with self.assertNumQueries(8):
+            response = self.api_client.patch(url, {}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'accepted')
+        self.assertEqual(len(response.data['items']), 1)
+
+        self.assertEqual(self.api_client.patch(url, {}, format='json').status_code, 400)
+        self.client_user.refresh_from_db()
+        self.assertEqual(self.client_user.points, 50 - 20 + 15)
+        self.assertEqual(self.client_user.coffee_count, 2)
+        self.assertEqual(self.client_user.total_spent, 30000)
+        entry = self.client_user.balance_entries.get(reason=BalanceLedgerEntry.REASON_ORDER_ACCEPTED)
+        self.assertEqual((entry.points, entry.reference), (-5, f'order:{self.order.id}'))
+
+    def test_spend_never_goes_below_zero(self):
+        User.objects.filter(pk=self.client_user.pk).update(points=5)
+        self.api_client.patch(reverse('order-accept', args=[self.order.id]), {}, format='json')
+        self.client_user.refresh_from_db()
+        self.assertEqual(self.client_user.points, 15)
+
+
+class OrderTransitionTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.barista = User.objects.create(phone="+70009998877", role=User.ROLE_BARISTA, coffee_shop=self.coffee_shop)
+        self.orders = [
+            Order.objects.create(
+                user=self.client_user, coffee_shop=self.coffee_shop, final_amount=10000,
+                planned_earn_points=10, planned_coffee_quantity=1,
+            )
+            for _ in range(5)
+        ]
+        self.api_client.force_authenticate(self.barista)
+        self.url = reverse('order-transition')
+
+    def move(self, to_status, orders):
+        return self.api_client.post(self.url, {'status': to_status, 'orders': orders}, format='json')
+
+    def balance(self):
+        self.client_user.refresh_from_db()
+        return self.client_user.points, self.client_user.coffee_count, self.client_user.total_spent
+
+    def test_batch_lifecycle_in_one_statement(self):
+        ids = [o.id for o in self.orders]
+        self.assertEqual(self.move('accepted', ids).status_code, 200)
+        self.move('in_progress', ids)
+        # заказы + позиции + SAVEPOINT/UPDATE/RELEASE
+        with self.assertNumQueries(5):
+            response = self.move('ready', ids)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({o['status'] for o in response.data}, {'ready'})
+        self.assertEqual({o['version'] for o in response.data}, {3})
+        self.assertEqual(Order.objects.filter(status='ready').count(), 5)
+
+    def test_illegal_transition_changes_nothing(self):
+        ids = [o.id for o in self.orders]
+        self.move('accepted', ids[:1])
+        response = self.move('in_progress', ids[:2])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(ids[1]), {str(k) for k in response.data['errors']})
+        self.assertEqual(Order.objects.get(pk=ids[0]).status, 'accepted')
+
+    def test_stale_version_is_conflict(self):
+        order = self.orders[0]
+        self.assertEqual(self.move('accepted', [{'id': order.id, 'version': 0}]).status_code, 200)
+        response = self.move('cancelled', [{'id': order.id, 'version': 0}])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Order.objects.get(pk=order.id).status, 'accepted')
+
+    def test_cancel_reverses_loyalty(self):
+        order = self.orders[0]
+        self.move('accepted', [order.id])
+        self.assertEqual(self.balance(), (60, 1, 10000))
+        self.assertEqual(self.move('cancelled', [order.id]).status_code, 200)
+        self.assertEqual(self.balance(), (50, 0, 0))
+
+    def test_cancel_refunds_only_the_points_actually_spent(self):
+        User.objects.filter(pk=self.client_user.pk).update(points=5)
+        order = Order.objects.create(
+            user=self.client_user, coffee_shop=self.coffee_shop, final_amount=10000,
+            planned_use_points=True, planned_points_to_spend=20, planned_earn_points=10,
+        )
+        self.move('accepted', [order.id])
+        self.client_user.refresh_from_db()
+        self.assertEqual(self.client_user.points, 10)
+        self.assertEqual(self.move('cancelled', [order.id]).status_code, 200)
+        self.client_user.refresh_from_db()
+        self.assertEqual((self.client_user.points, self.client_user.total_spent), (5, 0))
+
+    def test_other_shop_orders_are_not_found(self):
+        other = CoffeeShop.objects.create(name="Other", address="Other")
+        foreign = Order.objects.create(user=self.client_user, coffee_shop=other)
+        self.assertEqual(self.move('accepted', [foreign.id]).status_code, 404)
@@ -0,0 +1,148 @@
+"""Жизненный цикл заказа: таблица переходов и их применение.
+
+Переход — условный UPDATE по (id, version): если заказ успели изменить
+параллельно, строка не обновится и весь пакет откатывается с конфликтом.
+Пакет заказов («эти 5 заказов готовы») меняется одним UPDATE. Бонусные
+эффекты заказа применяются при принятии и откатываются при отмене уже
+принятого заказа в той же транзакции.
+"""
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.balances import apply_balance_change
+from core.models import BalanceLedgerEntry
+from .models import Order
+
+Status = Order.Status
+
+TRANSITIONS = {
+    Status.NEW: {Status.ACCEPTED, Status.CANCELLED},
+    Status.ACCEPTED: {Status.IN_PROGRESS, Status.CANCELLED},
+    Status.IN_PROGRESS: {Status.READY, Status.CANCELLED},
+    Status.READY: {Status.COMPLETED, Status.CANCELLED},
+    Status.COMPLETED: set(),
+    Status.CANCELLED: set(),
+}
+
+# Статусы, в которых бонусные эффекты заказа уже применены к балансу клиента
+LOYALTY_APPLIED = {Status.ACCEPTED, Status.IN_PROGRESS, Status.READY, Status.COMPLETED}
+
+
+class TransitionError(Exception):
+    """errors — {order_id: текст}; conflict — заказ изменён параллельно (версия не совпала)."""
+
+    def __init__(self, errors, conflict=False):
+        super().__init__(errors)
+        self.errors = errors
+        self.conflict = conflict
+
+
+def can_transition(from_status, to_status):
+    return to_status in TRANSITIONS.get(from_status, set())
+
+
+def _apply_loyalty(order):
+    apply_balance_change(
+        order.user_id,
+        spend_points=order.planned_points_to_spend if order.planned_use_points else 0,
+        points=order.planned_earn_points,
+        coffee_count=order.planned_coffee_quantity,
+        total_spent=order.final_amount,
+        reason=BalanceLedgerEntry.REASON_ORDER_ACCEPTED,
+        reference=f'order:{order.id}',
+    )
+
+
+def _accepted_entries(orders):
+    """{order_id: запись журнала ORDER_ACCEPTED} — что принятие заказов реально изменило в балансе."""
+    references = {f'order:{order.id}': order.id for order in orders}
+    # user_id — чтобы запрос шёл по индексу журнала (user, id), а не по всей таблице
+    entries = BalanceLedgerEntry.objects.filter(
+        user_id__in={order.user_id for order in orders},
+        reason=BalanceLedgerEntry.REASON_ORDER_ACCEPTED, reference__in=list(references),
+    )
+    return {references[entry.reference]: entry for entry in entries}
+
+
+def _reverse_loyalty(order, accepted):
+    """Откатывает то, что принятие заказа применило на самом деле.
+
+    Списание при принятии могло быть урезано до баланса клиента, поэтому
+    возвращаются баллы по записи журнала accepted, а не planned_points_to_spend.
+    Начисленные баллы и штампы забираются не ниже нуля. Для заказов, принятых
+    до появления журнала (записи нет), остаются плановые значения.
+    """
+    if accepted is not None:
+        spent = order.planned_earn_points - accepted.points
+        coffee_count = accepted.coffee_count
+        total_spent = accepted.total_spent
+    else:
+        spent = order.planned_points_to_spend if order.planned_use_points else 0
+        coffee_count = order.planned_coffee_quantity
+        total_spent = order.final_amount
+    apply_balance_change(
+        order.user_id,
+        spend_points=order.planned_earn_points,
+        points=spent,
+        coffee_count=-coffee_count,
+        total_spent=-total_spent,
+        reason=BalanceLedgerEntry.REASON_ORDER_CANCELLED,
+        reference=f'order:{order.id}',
+    )
+
+
+def transition_orders(orders, to_status, expected_versions=None):
+    """Переводит загруженные заказы в to_status одним UPDATE.
+
+    expected_versions — {order_id: version}, присланные клиентом; расхождение —
+    конфликт. Всё или ничего: при любой ошибке ни один заказ не меняется.
+    Обновляет переданные объекты на месте и возвращает их.
+    """
+    expected_versions = expected_versions or {}
+    errors, conflict = {}, False
+    for order in orders:
+        expected = expected_versions.get(order.id)
+        if expected is not None and expected != order.version:
+            errors[order.id] = f"Заказ изменён (версия {order.version}, ожидалась {expected})"
+            conflict = True
+        elif not can_transition(order.status, to_status):
+            errors[order.id] = (
+                f"Переход {Status(order.status).label} → {Status(to_status).label} недопустим"
+            )
+    if errors:
+        raise TransitionError(errors, conflict=conflict)
+    if not orders:
+        return orders
+
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Order.objects.filter(
+            reduce(or_, (Q(pk=order.pk, version=order.version) for order in orders))
+        ).update(status=to_status, version=F('version') + 1, updated_at=now)
+        if updated != len(orders):
+            raise TransitionError(
+                {order.id: "Заказ изменён параллельно, обновите данные" for order in orders}, conflict=True
+            )
+
+        reversed_orders = [
+            order for order in orders
+            if order.user_id and order.status in LOYALTY_APPLIED and to_status == Status.CANCELLED
+        ]
+        accepted = _accepted_entries(reversed_orders) if reversed_orders else {}
+        for order in orders:
+            if not order.user_id:
+                continue
+            if order.status == Status.NEW and to_status == Status.ACCEPTED:
+                _apply_loyalty(order)
+            elif order in reversed_orders:
+                _reverse_loyalty(order, accepted.get(order.id))
+
+    for order in orders:
+        order.status = to_status
+        order.version += 1
+        order.updated_at = now
+    return orders
@@ -1,8 +1,11 @@
 from django.urls import path
-from .views import OrderCreateView, OrderListView, OrderAcceptView
+from .views import OrderCreateView, OrderListView, OrderAcceptView, OrderFeedView, OrderStreamView, OrderTransitionView
 
 urlpatterns = [
     path('cart/orders/', OrderCreateView.as_view(), name='order-create'),
     path('cart/orders/list/', OrderListView.as_view(), name='order-list'),
+    path('cart/orders/feed/', OrderFeedView.as_view(), name='order-feed'),
+    path('cart/orders/stream/', OrderStreamView.as_view(), name='order-stream'),
     path('cart/orders/<int:pk>/accept/', OrderAcceptView.as_view(), name='order-accept'),
+    path('cart/orders/transition/', OrderTransitionView.as_view(), name='order-transition'),
 ]
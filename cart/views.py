@@ -1,17 +1,35 @@
-from rest_framework import generics, permissions, status, authentication
+from datetime import datetime, time
+
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework import generics, permissions, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.decorators import api_view, permission_classes
+from core.authentication import CachedTokenAuthentication
+from core.events import broker
+from .feed import (
+    EVENT_ORDER_CREATED, EVENT_ORDER_STATUS, LONG_POLL_MAX_TIMEOUT,
+    event_to_dict, order_topic, publish_order, sse_stream, sse_stream_async,
+)
 from .models import Order
-from .serializers import OrderCreateSerializer, OrderSerializer
+from .serializers import OrderCreateSerializer, OrderSerializer, OrderTransitionSerializer
+from .transitions import TransitionError, transition_orders
 from core.models import User
+from core.idempotency import idempotent
 
 
 class OrderCreateView(generics.CreateAPIView):
     """Клиент создаёт заказ из готовой корзины"""
     permission_classes = [permissions.IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = OrderCreateSerializer
 
+    @idempotent('order-create')
     def create(self, request, *args, **kwargs):
         print(request.data)
         if request.user.role not in [User.ROLE_CLIENT, User.ROLE_ANON_CLIENT]:
@@ -20,32 +38,90 @@ class OrderCreateView(generics.CreateAPIView):
         serializer = self.get_serializer(data=request.data, context={"request": request})
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
-        return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
+        data = OrderSerializer(order).data
+        publish_order(order, EVENT_ORDER_CREATED, data)
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+class OrderCursorPagination(CursorPagination):
+    """Keyset-пагинация по (created_at, id), включается параметром ?cursor или ?page_size.
+
+    Без них список возвращается целиком, как раньше.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.cursor_query_param not in params and self.page_size_query_param not in params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+def _parse_moment(value, end_of_day=False):
+    """Дата (YYYY-MM-DD) или дата-время ISO 8601 из параметра фильтра."""
+    day = parse_date(value)
+    if day is not None:
+        moment = datetime.combine(day, time.max if end_of_day else time.min)
+    else:
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(value)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
 
 
 class OrderListView(generics.ListAPIView):
     """Список заказов: клиент видит свои; бариста/старший бариста видят заказы своего заведения"""
     permission_classes = [permissions.IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = OrderSerializer
+    pagination_class = OrderCursorPagination
 
     def get_queryset(self):
         user = self.request.user
+        queryset = Order.objects.prefetch_related('items').order_by('-created_at', '-id')
         if user.role == User.ROLE_CLIENT:
-            return Order.objects.filter(user=user).order_by('-created_at')
-        if (user.role in [User.ROLE_BARISTA, User.ROLE_SENIOR_BARISTA] and user.coffee_shop):
-            return Order.objects.filter(coffee_shop=user.coffee_shop).order_by('-created_at')
-        if user.role == User.ROLE_MANAGER:
-            return Order.objects.all().order_by('-created_at')
-        return Order.objects.none()
+            queryset = queryset.filter(user=user)
+        elif (user.role in [User.ROLE_BARISTA, User.ROLE_SENIOR_BARISTA] and user.coffee_shop):
+            queryset = queryset.filter(coffee_shop=user.coffee_shop)
+        elif user.role == User.ROLE_MANAGER:
+            coffee_shop_id = self.request.query_params.get('coffee_shop_id')
+            if coffee_shop_id:
+                if not coffee_shop_id.isdigit():
+                    raise ValidationError({'coffee_shop_id': 'Ожидается число'})
+                queryset = queryset.filter(coffee_shop_id=int(coffee_shop_id))
+        else:
+            return Order.objects.none()
+        return self.filter_queryset_by_params(queryset)
+
+    def filter_queryset_by_params(self, queryset):
+        params = self.request.query_params
+        statuses = [s for s in params.get('status', '').split(',') if s]
+        if statuses:
+            unknown = set(statuses) - set(Order.Status.values)
+            if unknown:
+                raise ValidationError({'status': f"Неизвестный статус: {', '.join(sorted(unknown))}"})
+            queryset = queryset.filter(status__in=statuses)
+        bounds = (('created_from', 'created_at__gte', False), ('created_to', 'created_at__lte', True))
+        for param, lookup, end_of_day in bounds:
+            if params.get(param):
+                try:
+                    queryset = queryset.filter(**{lookup: _parse_moment(params[param], end_of_day)})
+                except ValueError:
+                    raise ValidationError({param: 'Ожидается дата YYYY-MM-DD или дата-время ISO 8601'})
+        return queryset
 
 
 class OrderAcceptView(generics.UpdateAPIView):
     """Бариста принимает заказ (меняет статус new -> accepted)"""
     permission_classes = [permissions.IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = OrderSerializer
-    queryset = Order.objects.all()
+    queryset = Order.objects.prefetch_related('items')
 
     def update(self, request, *args, **kwargs):
         user = request.user
@@ -54,27 +130,133 @@ class OrderAcceptView(generics.UpdateAPIView):
         order = self.get_object()
         if order.coffee_shop_id != user.coffee_shop_id:
             return Response({"error": "Можно управлять только заказами своего заведения"}, status=status.HTTP_403_FORBIDDEN)
-        if order.status != Order.Status.NEW:
+
+        # Compare-and-swap по версии: из двух параллельных принятий пройдёт одно,
+        # бонусные эффекты применяются в той же транзакции (cart.transitions)
+        try:
+            transition_orders([order], Order.Status.ACCEPTED)
+        except TransitionError as exc:
+            if exc.conflict:
+                return Response({"error": "Заказ уже изменён другим запросом"}, status=status.HTTP_409_CONFLICT)
             return Response({"error": "Заказ не в статусе 'Новый'"}, status=status.HTTP_400_BAD_REQUEST)
-        order.status = Order.Status.ACCEPTED
-        order.save(update_fields=['status'])
-
-        # Apply planned loyalty effects only upon acceptance
-        if order.user:
-            u = order.user
-            # Spend points
-            if order.planned_use_points and order.planned_points_to_spend > 0:
-                u.points = max(0, u.points - order.planned_points_to_spend)
-            # Earn points by rank-based percent calculated at order creation
-            if order.planned_earn_points > 0:
-                u.points += order.planned_earn_points
-            # Coffee quantity increment
-            if order.planned_coffee_quantity > 0:
-                u.coffee_count += order.planned_coffee_quantity
-            # Increase total_spent by actually payable amount (kopecks)
-            u.total_spent += order.final_amount
-            u.save(update_fields=['points', 'coffee_count', 'total_spent'])
-        return Response(OrderSerializer(order).data)
+
+        # Ответ собирается из уже загруженного заказа и его позиций
+        data = OrderSerializer(order).data
+        publish_order(order, EVENT_ORDER_STATUS, data)
+        return Response(data)
+
+
+class OrderTransitionView(APIView):
+    """Смена статуса одного или нескольких заказов по таблице переходов (cart.transitions)"""
+    permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+
+    def post(self, request):
+        user = request.user
+        if user.role in [User.ROLE_BARISTA, User.ROLE_SENIOR_BARISTA] and user.coffee_shop_id:
+            queryset = Order.objects.filter(coffee_shop_id=user.coffee_shop_id)
+        elif user.role == User.ROLE_MANAGER:
+            queryset = Order.objects.all()
+        else:
+            return Response({"error": "Доступ запрещен"}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = OrderTransitionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        versions = serializer.validated_data['orders']
+        to_status = serializer.validated_data['status']
+
+        orders = list(queryset.filter(pk__in=list(versions)).prefetch_related('items').order_by('id'))
+        missing = set(versions) - {order.id for order in orders}
+        if missing:
+            return Response(
+                {"errors": {order_id: "Заказ не найден" for order_id in sorted(missing)}},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        try:
+            transition_orders(orders, to_status, expected_versions=versions)
+        except TransitionError as exc:
+            return Response(
+                {"errors": exc.errors},
+                status=status.HTTP_409_CONFLICT if exc.conflict else status.HTTP_400_BAD_REQUEST,
+            )
+
+        data = OrderSerializer(orders, many=True).data
+        for order, order_data in zip(orders, data):
+            publish_order(order, EVENT_ORDER_STATUS, order_data)
+        return Response(data)
+
+
+class OrderFeedMixin:
+    """Топик ленты заказов для текущего пользователя: бариста — своё заведение,
+    управляющий — любое через ?coffee_shop_id."""
+    permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+
+    def get_topic(self, request):
+        user = request.user
+        if user.role in [User.ROLE_BARISTA, User.ROLE_SENIOR_BARISTA] and user.coffee_shop_id:
+            return order_topic(user.coffee_shop_id)
+        if user.role == User.ROLE_MANAGER:
+            try:
+                return order_topic(int(request.query_params['coffee_shop_id']))
+            except (KeyError, ValueError):
+                return None
+        return None
+
+    def get_after(self, request):
+        """Номер последнего полученного события: ?after или заголовок Last-Event-ID.
+        Без него лента начинается с текущего момента."""
+        value = request.query_params.get('after') or request.headers.get('Last-Event-ID')
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+
+class OrderFeedView(OrderFeedMixin, APIView):
+    """Long-poll: ждёт новых заказов и смен статуса заведения до ?timeout секунд"""
+
+    def get(self, request):
+        topic = self.get_topic(request)
+        if topic is None:
+            return Response({"error": "Доступ запрещен"}, status=status.HTTP_403_FORBIDDEN)
+        after = self.get_after(request)
+        if after is None:
+            return Response({'last_event_id': broker.last_id, 'events': [], 'reset': False})
+        if not broker.is_current(after):
+            # Номер от другого процесса или до перезапуска: продолжить с него нельзя
+            return Response({'last_event_id': broker.last_id, 'events': [], 'reset': True})
+        try:
+            timeout = min(max(float(request.query_params.get('timeout', 25)), 0), LONG_POLL_MAX_TIMEOUT)
+        except ValueError:
+            timeout = LONG_POLL_MAX_TIMEOUT
+        events = broker.wait(topic, after, timeout)
+        return Response({
+            'last_event_id': events[-1].id if events else after,
+            'events': [event_to_dict(event) for event in events],
+            'reset': False,
+        })
+
+
+class OrderStreamView(OrderFeedMixin, APIView):
+    """Server-Sent Events: поток новых заказов и смен статуса заведения"""
+
+    def get(self, request):
+        topic = self.get_topic(request)
+        if topic is None:
+            return Response({"error": "Доступ запрещен"}, status=status.HTTP_403_FORBIDDEN)
+        after = self.get_after(request)
+        reset = after is not None and not broker.is_current(after)
+        if after is None or reset:
+            after = broker.last_id
+        if isinstance(request._request, ASGIRequest):
+            stream = sse_stream_async(topic, after, reset)
+        else:
+            stream = sse_stream(topic, after, reset)
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 # Create your views here.
@@ -1,11 +1,14 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from .models import User, CoffeeShop, Rank
+from .ranks import assign_ranks
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
     list_display = ("phone", "role", "coffee_shop", "is_active", "is_staff")
     list_filter = ("role", "coffee_shop", "is_active")
     search_fields = ("phone",)
+    # Баланс меняется только через core.balances, чтобы каждое изменение попало в журнал
+    readonly_fields = ("points", "coffee_count", "total_spent")
 
 @admin.register(CoffeeShop)
 class CoffeeShopAdmin(admin.ModelAdmin):
@@ -18,3 +21,9 @@ class RankAdmin(admin.ModelAdmin):
     list_display = ("name", "min_total_spent_som", "cashback_percent", "color", "icon")
     list_editable = ("min_total_spent_som", "cashback_percent", "color")
     ordering = ("min_total_spent_som",)
+    actions = ("recompute_client_ranks",)
+
+    @admin.action(description="Пересчитать по текущим порогам клиентов выбранных рангов")
+    def recompute_client_ranks(self, request, queryset):
+        changed = assign_ranks(User, Rank, rank_ids=queryset.values_list('id', flat=True))
+        self.message_user(request, f"Обновлено клиентов: {changed}", messages.SUCCESS)
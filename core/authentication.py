@@ -0,0 +1,150 @@
+"""Аутентификация по токену с кэшем.
+
+Стандартный TokenAuthentication на каждый запрос делает
+Token.objects.select_related('user').get(key=...), в том числе при опросе
+статуса кода раз в секунду. Здесь токен → пользователь берётся из LRU в
+памяти процесса (TOKEN_AUTH_CACHE_SIZE записей, TOKEN_AUTH_CACHE_TTL_SECONDS),
+а при промахе — из общего кэша Django TOKEN_AUTH_SHARED_CACHE, если он задан.
+
+Сброс: сохранение / удаление пользователя, удаление токена и изменение
+баланса (core.balances) сбрасывают запись после коммита. Локальный LRU других
+воркеров этого не видит и живёт до TTL, поэтому эндпоинты, показывающие
+баланс, перечитывают его из БД (refresh_balance).
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+
+BALANCE_REFRESH_FIELDS = ['points', 'coffee_count', 'total_spent', 'current_rank']
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key токена -> (user, token, expires_at)
+_keys_by_user = {}
+
+
+def _ttl():
+    return getattr(settings, 'TOKEN_AUTH_CACHE_TTL_SECONDS', 60)
+
+
+def _shared():
+    alias = getattr(settings, 'TOKEN_AUTH_SHARED_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def _token_cache_key(key):
+    return f'auth-token:{key}'
+
+
+def _user_cache_key(user_id):
+    return f'auth-user:{user_id}'
+
+
+def _get_local(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            _drop(key)
+            return None
+        _entries.move_to_end(key)
+        return entry
+
+
+def _put_local(key, user, token):
+    with _lock:
+        _drop(key)
+        _entries[key] = (user, token, time.monotonic() + _ttl())
+        _keys_by_user.setdefault(user.pk, set()).add(key)
+        while len(_entries) > getattr(settings, 'TOKEN_AUTH_CACHE_SIZE', 10000):
+            _drop(next(iter(_entries)))
+
+
+def _drop(key):
+    """Удаляет запись из LRU; вызывается под _lock."""
+    entry = _entries.pop(key, None)
+    if entry is not None:
+        keys = _keys_by_user.get(entry[0].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _keys_by_user[entry[0].pk]
+
+
+def _get_shared(shared, key):
+    user_id = shared.get(_token_cache_key(key))
+    if user_id is None:
+        return None
+    return shared.get(_user_cache_key(user_id))
+
+
+def _put_shared(shared, key, user, token):
+    shared.set(_token_cache_key(key), user.pk, _ttl())
+    shared.set(_user_cache_key(user.pk), (user, token), _ttl())
+
+
+def invalidate_user(user_id):
+    """Сбрасывает закэшированного пользователя во всех его токенах (после коммита)."""
+    def drop():
+        with _lock:
+            for key in list(_keys_by_user.get(user_id, ())):
+                _drop(key)
+        shared = _shared()
+        if shared is not None:
+            shared.delete(_user_cache_key(user_id))
+    transaction.on_commit(drop)
+
+
+def invalidate_token(key):
+    """Сбрасывает токен (после коммита): удалённый токен больше не аутентифицирует."""
+    def drop():
+        with _lock:
+            _drop(key)
+        shared = _shared()
+        if shared is not None:
+            shared.delete(_token_cache_key(key))
+    transaction.on_commit(drop)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+        _keys_by_user.clear()
+
+
+def refresh_balance(user):
+    """Перечитывает баланс и ранг пользователя, полученного из кэша аутентификации."""
+    user.refresh_from_db(fields=BALANCE_REFRESH_FIELDS)
+    return user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication, который в установившемся режиме не ходит в БД.
+
+    Каждый запрос получает свою копию пользователя, поэтому изменения
+    request.user в одном запросе не попадают в кэш и в другие запросы.
+    """
+
+    def authenticate_credentials(self, key):
+        entry = _get_local(key)
+        if entry is None:
+            shared = _shared()
+            cached = _get_shared(shared, key) if shared is not None else None
+            if cached is not None:
+                _put_local(key, *cached)
+            else:
+                user, token = super().authenticate_credentials(key)
+                _put_local(key, user, token)
+                if shared is not None:
+                    _put_shared(shared, key, user, token)
+                cached = (user, token)
+            user, token = cached
+        else:
+            user, token = entry[0], entry[1]
+        return copy.copy(user), token
@@ -0,0 +1,137 @@
+"""Изменение баланса клиента (баллы, штампы, сумма трат) и журнал изменений.
+
+Счётчики на User меняются выражениями F() в самой БД, а не
+чтением-изменением-записью в Python, поэтому параллельные операции не
+затирают друг друга. Ранг клиента пересчитывается в том же UPDATE подзапросом
+по порогам рангов. Каждое изменение в той же транзакции пишет дельты в
+журнал BalanceLedgerEntry.
+
+Журнал только дополняется. Периодически snapshot_balances() сворачивает его
+в BalanceSnapshot, и баланс для аудита — это последний снимок плюс короткий
+хвост журнала (balance_for), без прохода по всей истории.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from . import authentication
+from .models import BalanceLedgerEntry, BalanceSnapshot, Rank, User
+
+BALANCE_FIELDS = ('points', 'coffee_count', 'total_spent')
+
+
+def rank_for_total_spent(total_spent_expression):
+    """Подзапрос id ранга для суммы трат (выражение в копейках над строкой пользователя)."""
+    return Subquery(
+        Rank.objects.annotate(threshold_kop=F('min_total_spent_som') * 100)
+        .filter(threshold_kop__lte=total_spent_expression)
+        .order_by('-min_total_spent_som', '-id')
+        .values('id')[:1]
+    )
+
+
+def apply_balance_change(user_id, points=0, coffee_count=0, total_spent=0, set_coffee_count=None,
+                         spend_points=0, reason=BalanceLedgerEntry.REASON_MANUAL, reference='', current=None):
+    """Прибавляет points / coffee_count / total_spent (в копейках) к балансу клиента
+    и пишет запись в журнал.
+
+    spend_points списывается до прибавления points, но не ниже нуля (баллы могли
+    быть потрачены между оформлением и принятием заказа); отрицательный
+    coffee_count тоже не уводит штампы ниже нуля. set_coffee_count задаёт штампы
+    абсолютным значением. Для этих случаев нужен текущий баланс: строка клиента
+    читается под select_for_update, либо вызывающий передаёт в current уже
+    заблокированный им экземпляр.
+
+    Возвращает запись журнала или None, если менять нечего / пользователя нет.
+    """
+    with transaction.atomic(savepoint=False):
+        if (spend_points or set_coffee_count is not None or coffee_count < 0) and current is None:
+            current = User.objects.select_for_update().only('points', 'coffee_count').filter(pk=user_id).first()
+            if current is None:
+                return None
+
+        if spend_points:
+            points -= min(spend_points, max(current.points, 0))
+        if set_coffee_count is not None:
+            coffee_count = set_coffee_count - current.coffee_count
+        elif coffee_count < 0:
+            coffee_count = -min(-coffee_count, max(current.coffee_count, 0))
+
+        values = {}
+        if points:
+            values['points'] = F('points') + points
+        if coffee_count:
+            values['coffee_count'] = F('coffee_count') + coffee_count
+        if total_spent:
+            values['total_spent'] = F('total_spent') + total_spent
+            values['current_rank'] = rank_for_total_spent(OuterRef('total_spent') + total_spent)
+        if not values:
+            return None
+        values['card_version'] = F('card_version') + 1
+        if not User.objects.filter(pk=user_id).update(**values):
+            return None
+        authentication.invalidate_user(user_id)
+        return BalanceLedgerEntry.objects.create(
+            user_id=user_id, points=points, coffee_count=coffee_count, total_spent=total_spent,
+            reason=reason, reference=reference,
+        )
+
+
+def _latest_snapshots(user_ids):
+    """{user_id: BalanceSnapshot} — последний снимок каждого из пользователей одним запросом."""
+    latest = BalanceSnapshot.objects.filter(
+        user_id=OuterRef('user_id'),
+    ).order_by('-ledger_entry_id', '-id').values('id')[:1]
+    snapshots = BalanceSnapshot.objects.filter(user_id__in=user_ids, id=Subquery(latest))
+    return {snapshot.user_id: snapshot for snapshot in snapshots}
+
+
+def entries_after_snapshot():
+    """Записи журнала после последнего снимка своего пользователя (коррелированный подзапрос)."""
+    last = BalanceSnapshot.objects.filter(
+        user_id=OuterRef('user_id'),
+    ).order_by('-ledger_entry_id').values('ledger_entry_id')[:1]
+    return BalanceLedgerEntry.objects.annotate(snapshot_entry_id=Coalesce(Subquery(last), Value(0))).filter(
+        id__gt=F('snapshot_entry_id')
+    )
+
+
+def balance_for(user_id):
+    """Баланс по журналу: последний снимок + хвост после него. Два запроса."""
+    snapshot = BalanceSnapshot.objects.filter(user_id=user_id).order_by('-ledger_entry_id', '-id').first()
+    after = snapshot.ledger_entry_id if snapshot else 0
+    tail = BalanceLedgerEntry.objects.filter(user_id=user_id, id__gt=after).aggregate(
+        **{field: Coalesce(Sum(field), Value(0)) for field in BALANCE_FIELDS}
+    )
+    return {field: (getattr(snapshot, field) if snapshot else 0) + tail[field] for field in BALANCE_FIELDS}
+
+
+def snapshot_balances(min_entries=1, batch_size=1000):
+    """Сворачивает хвосты журнала в новые снимки для всех, у кого в хвосте не меньше
+    min_entries записей. Хвосты считаются одним агрегирующим запросом по журналу,
+    снимки вставляются пачками. Возвращает число созданных снимков."""
+    high_water = BalanceLedgerEntry.objects.aggregate(max_id=Max('id'))['max_id']
+    if high_water is None:
+        return 0
+    tails = list(
+        entries_after_snapshot().filter(id__lte=high_water).values('user_id').annotate(
+            entries=Count('id'),
+            last_id=Max('id'),
+            **{f'sum_{field}': Sum(field) for field in BALANCE_FIELDS},
+        ).filter(entries__gte=min_entries)
+    )
+    created = 0
+    for start in range(0, len(tails), batch_size):
+        chunk = tails[start:start + batch_size]
+        previous = _latest_snapshots([row['user_id'] for row in chunk])
+        snapshots = []
+        for row in chunk:
+            base = previous.get(row['user_id'])
+            snapshots.append(BalanceSnapshot(
+                user_id=row['user_id'],
+                ledger_entry_id=row['last_id'],
+                **{field: (getattr(base, field) if base else 0) + row[f'sum_{field}'] for field in BALANCE_FIELDS},
+            ))
+        BalanceSnapshot.objects.bulk_create(snapshots)
+        created += len(snapshots)
+    return created
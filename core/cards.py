@@ -0,0 +1,91 @@
+"""Карточка клиента для GET /api/client/info/ — первый запрос при каждом запуске приложения.
+
+Карточка собирается за три запроса (строка клиента, активные уведомления,
+код на бесплатный кофе), ранг и прогресс берутся из таблицы рангов в памяти.
+Готовая карточка кладётся в кэш Django под ключом из User.card_version,
+версии таблицы рангов и хоста запроса (в карточке абсолютные ссылки, например
+rank_icon), поэтому в установившемся режиме ответ — это один запрос за строкой
+клиента.
+
+User.card_version увеличивается при изменении баланса (транзакция
+лояльности, принятие и отмена заказа), выпуске и гашении кода на бесплатный
+кофе, сохранении пользователя (touch()) и рассылке уведомлений (одним UPDATE
+с подзапросом по адресатам, см. Notification.create_for_recipients). Изменение рангов меняет
+версию таблицы. Кроме того, карточка устаревает сама, когда истекает
+ближайшее уведомление или код: это время хранится в ней и входит в ETag.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+
+from . import ranks
+from .models import User
+
+
+@dataclass
+class ClientCard:
+    etag: str
+    data: dict
+    valid_until: datetime = None
+
+    def is_fresh(self, now=None):
+        return self.valid_until is None or (now or timezone.now()) < self.valid_until
+
+
+def _cache():
+    return caches[getattr(settings, 'CLIENT_CARD_CACHE', 'default')]
+
+
+def _host(request):
+    """Хост запроса: абсолютные ссылки карточки зависят от него."""
+    return request.get_host() if request is not None else ''
+
+
+def _cache_key(user, request=None):
+    return f'client-card:{user.pk}:{user.card_version}:{ranks.version()}:{_host(request)}'
+
+
+def touch(user_ids):
+    """Помечает карточки клиентов устаревшими одним UPDATE."""
+    return User.objects.filter(pk__in=list(user_ids)).update(card_version=F('card_version') + 1)
+
+
+def build_card(user, request=None):
+    """Собирает карточку по свежей строке клиента: ещё два запроса."""
+    from loyalty.models import LoyaltyCode
+    from notifications.models import Notification
+    from .serializers import ClientInfoSerializer
+
+    now = timezone.now()
+    notifications = list(
+        Notification.objects.filter(receipts__user=user, expires_at__gt=now).order_by('-created_at')
+    )
+    redeem_code = LoyaltyCode.objects.filter(
+        user=user, is_active=True, is_free_coffee_redemption=True, expires_at__gt=now,
+    ).order_by('-created_at').first()
+
+    data = ClientInfoSerializer(user, context={
+        'request': request, 'notifications': notifications, 'redeem_code': redeem_code,
+    }).data
+    expiries = [n.expires_at for n in notifications] + ([redeem_code.expires_at] if redeem_code else [])
+    valid_until = min(expiries) if expiries else None
+    stamp = int(valid_until.timestamp()) if valid_until else 0
+    etag = f"card.{user.pk}.{user.card_version}.{ranks.version()}.{stamp}.{_host(request)}"
+    return ClientCard(etag=etag, data=dict(data), valid_until=valid_until)
+
+
+def get_card(user_id, request=None):
+    """Карточка клиента из кэша или собранная заново; None, если пользователя нет."""
+    user = User.objects.filter(pk=user_id).first()
+    if user is None:
+        return None
+    key = _cache_key(user, request)
+    card = _cache().get(key)
+    if card is None or not card.is_fresh():
+        card = build_card(user, request)
+        _cache().set(key, card, getattr(settings, 'CLIENT_CARD_CACHE_SECONDS', 300))
+    return card
@@ -0,0 +1,90 @@
+"""Локальная шина событий (pub/sub) для push-эндпоинтов.
+
+Брокер живёт в памяти процесса: у каждого топика кольцевой буфер последних
+EVENTS_BUFFER_SIZE событий, номера событий сквозные и монотонные. Подписчик
+ждёт на Condition и просыпается сразу после publish(), поэтому новые события
+доходят без опроса БД. Клиент, переподключаясь, передаёт номер последнего
+полученного события и получает всё, что было после него.
+
+Это замена внешнего брокера для одного процесса: при нескольких воркерах
+публикация и подписка должны попадать в один процесс (или брокер заменяется
+на Redis pub/sub с тем же интерфейсом).
+
+Номера начинаются не с нуля, а с времени запуска брокера в микросекундах.
+Номер, полученный от другого процесса или до перезапуска, не попадает в
+диапазон этого брокера (is_current): клиента нужно вернуть к текущей позиции
+и попросить перечитать данные, иначе он ждал бы, пока счётчик догонит его номер.
+"""
+import threading
+import time
+from collections import deque, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+Event = namedtuple('Event', ['id', 'topic', 'type', 'data'])
+
+
+class EventBroker:
+    def __init__(self, buffer_size=None):
+        self.buffer_size = buffer_size or getattr(settings, 'EVENTS_BUFFER_SIZE', 500)
+        self._condition = threading.Condition()
+        self._topics = {}
+        # Микросекунды, а не наносекунды: номер должен помещаться в Number JavaScript
+        self._first_id = self._last_id = time.time_ns() // 1000
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def is_current(self, after):
+        """Выдан ли номер after этим брокером (с момента его запуска и не из будущего)."""
+        return self._first_id <= after <= self._last_id
+
+    def publish(self, topic, event_type, data):
+        with self._condition:
+            self._last_id += 1
+            event = Event(self._last_id, topic, event_type, data)
+            buffer = self._topics.get(topic)
+            if buffer is None:
+                buffer = self._topics[topic] = deque(maxlen=self.buffer_size)
+            buffer.append(event)
+            self._condition.notify_all()
+        return event
+
+    def since(self, topic, after):
+        """События топика с номером больше after (без ожидания)."""
+        buffer = self._topics.get(topic)
+        if not buffer or buffer[-1].id <= after:
+            return []
+        return [event for event in buffer if event.id > after]
+
+    def wait(self, topic, after, timeout):
+        """Ждёт событий топика после after не дольше timeout секунд."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            events = self.since(topic, after)
+            while not events:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+                events = self.since(topic, after)
+        return events
+
+    async def await_events(self, topic, after, timeout):
+        """Асинхронный wait() для ASGI: ожидание уходит в отдельный поток."""
+        return await sync_to_async(self.wait, thread_sensitive=False)(topic, after, timeout)
+
+    def clear(self):
+        with self._condition:
+            self._topics.clear()
+
+
+broker = EventBroker()
+
+
+def publish_on_commit(topic, event_type, data):
+    """Публикует событие после фиксации текущей транзакции (или сразу вне её)."""
+    transaction.on_commit(lambda: broker.publish(topic, event_type, data))
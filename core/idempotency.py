@@ -0,0 +1,104 @@
+"""Ключи идемпотентности для POST-запросов.
+
+Клиент передаёт заголовок Idempotency-Key. Первый запрос с ключом
+выполняется и его ответ сохраняется. Повтор с тем же ключом и телом
+отдаётся из хранилища одним запросом по уникальному индексу и до бизнес-логики
+не доходит. Записи живут IDEMPOTENCY_KEY_TTL_HOURS и вычищаются пачками при
+создании новых.
+
+Пока первый запрос выполняется, запись висит без ответа и повтор получает 409.
+Если процесс упал посреди запроса, такая запись осталась бы до конца TTL,
+поэтому незавершённая запись старше IDEMPOTENCY_PENDING_LEASE_SECONDS
+считается брошенной: повтор забирает её себе и выполняется заново.
+"""
+import hashlib
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+REPLAY_HEADER = 'Idempotent-Replayed'
+EVICT_BATCH_SIZE = 100
+
+
+def evict_expired(now=None):
+    """Удаляет пачку истёкших ключей (по индексу expires_at)."""
+    now = now or timezone.now()
+    ids = list(IdempotencyKey.objects.filter(expires_at__lte=now).values_list('id', flat=True)[:EVICT_BATCH_SIZE])
+    if ids:
+        IdempotencyKey.objects.filter(id__in=ids).delete()
+
+
+def _take_over(record, now):
+    """Забирает брошенную незавершённую запись; из параллельных повторов это удастся одному."""
+    lease = timedelta(seconds=getattr(settings, 'IDEMPOTENCY_PENDING_LEASE_SECONDS', 30))
+    if record.created_at > now - lease:
+        return False
+    taken = IdempotencyKey.objects.filter(
+        pk=record.pk, status_code__isnull=True, created_at=record.created_at,
+    ).update(created_at=now)
+    record.created_at = now
+    return bool(taken)
+
+
+def idempotent(scope):
+    """Декоратор метода create/post APIView: повтор запроса с тем же ключом отдаёт сохранённый ответ."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key or not request.user.is_authenticated:
+                return func(self, request, *args, **kwargs)
+            if len(key) > 255:
+                return Response({'error': f'{HEADER} не длиннее 255 символов'}, status=status.HTTP_400_BAD_REQUEST)
+
+            request_hash = hashlib.sha256(request.body).hexdigest()
+            now = timezone.now()
+            record = IdempotencyKey.objects.filter(user=request.user, scope=scope, key=key).first()
+            if record and record.expires_at <= now:
+                record.delete()
+                record = None
+            if record:
+                if record.request_hash != request_hash:
+                    return Response(
+                        {'error': 'Ключ идемпотентности уже использован с другим запросом'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    )
+                if record.status_code is not None:
+                    return Response(record.response_body, status=record.status_code, headers={REPLAY_HEADER: 'true'})
+                if not _take_over(record, now):
+                    return Response({'error': 'Запрос с этим ключом ещё выполняется'}, status=status.HTTP_409_CONFLICT)
+            else:
+                ttl = timedelta(hours=getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24))
+                try:
+                    with transaction.atomic():
+                        record = IdempotencyKey.objects.create(
+                            user=request.user, scope=scope, key=key,
+                            request_hash=request_hash, expires_at=now + ttl,
+                        )
+                except IntegrityError:
+                    # Параллельный запрос с тем же ключом успел занять его первым
+                    return Response({'error': 'Запрос с этим ключом ещё выполняется'}, status=status.HTTP_409_CONFLICT)
+                evict_expired(now)
+
+            try:
+                response = func(self, request, *args, **kwargs)
+            except Exception:
+                record.delete()
+                raise
+            if response.status_code >= 500 or not hasattr(response, 'data'):
+                record.delete()
+                return response
+            record.status_code = response.status_code
+            record.response_body = response.data
+            record.save(update_fields=['status_code', 'response_body'])
+            return response
+        return wrapper
+    return decorator
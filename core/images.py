@@ -0,0 +1,152 @@
+"""Фоновая генерация уменьшенных копий изображений (Pillow).
+
+После загрузки картинки воркер создаёт копии нескольких ширин в WebP и JPEG
+и крошечную размытую заглушку (data URI). Описание копий сохраняется в
+JSON-поле модели, сериализаторы отдают его клиенту через build_srcset().
+Оригинал не трогаем.
+"""
+import base64
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.db.models.signals import post_save
+from PIL import Image, ImageFilter, ImageOps
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_WIDTH = 16
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-renditions')
+
+
+def _encode(img, fmt, **options):
+    buf = io.BytesIO()
+    img.save(buf, fmt, **options)
+    return buf.getvalue()
+
+
+def _flatten(img):
+    """RGB-копия для JPEG: прозрачность заливаем белым."""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[-1])
+        return background
+    return img.convert('RGB')
+
+
+def generate_renditions(field_file):
+    """Создаёт копии изображения в хранилище и возвращает их описание."""
+    storage = field_file.storage
+    with storage.open(field_file.name, 'rb') as f:
+        img = ImageOps.exif_transpose(Image.open(f))
+        img.load()
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'P') else 'RGB')
+
+    base, _ = os.path.splitext(field_file.name)
+    widths = [w for w in settings.IMAGE_RENDITION_WIDTHS if w < img.width] or [img.width]
+    renditions = []
+    for width in widths:
+        height = max(1, round(img.height * width / img.width))
+        resized = img.resize((width, height), Image.LANCZOS)
+        webp_name = storage.save(f"{base}_w{width}.webp", ContentFile(_encode(resized, 'WEBP', quality=80, method=4)))
+        jpeg_name = storage.save(
+            f"{base}_w{width}.jpg",
+            ContentFile(_encode(_flatten(resized), 'JPEG', quality=82, optimize=True, progressive=True)),
+        )
+        renditions.append({'width': width, 'height': height, 'webp': webp_name, 'jpeg': jpeg_name})
+
+    tiny_height = max(1, round(img.height * PLACEHOLDER_WIDTH / img.width))
+    tiny = _flatten(img).resize((PLACEHOLDER_WIDTH, tiny_height), Image.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    placeholder = 'data:image/jpeg;base64,' + base64.b64encode(_encode(tiny, 'JPEG', quality=40)).decode('ascii')
+
+    return {
+        'source': field_file.name,
+        'width': img.width,
+        'height': img.height,
+        'renditions': renditions,
+        'placeholder': placeholder,
+    }
+
+
+def delete_renditions(storage, variants):
+    for rendition in (variants or {}).get('renditions', []):
+        for key in ('webp', 'jpeg'):
+            try:
+                storage.delete(rendition[key])
+            except Exception:
+                logger.warning("Не удалось удалить копию изображения %s", rendition.get(key))
+
+
+def process_image(model_label, pk, image_field, variants_field, source_name):
+    """Задача воркера: генерирует копии и сохраняет их описание в модели."""
+    try:
+        model = apps.get_model(model_label)
+        instance = model.objects.filter(pk=pk).first()
+        if instance is None:
+            return
+        field_file = getattr(instance, image_field)
+        # Пока задача ждала очереди, картинку могли заменить или удалить
+        if not field_file or field_file.name != source_name:
+            return
+        old_variants = getattr(instance, variants_field) or {}
+        if old_variants.get('source') == source_name:
+            return
+        setattr(instance, variants_field, generate_renditions(field_file))
+        instance.save(update_fields=[variants_field])
+        delete_renditions(field_file.storage, old_variants)
+    except Exception:
+        logger.exception("Не удалось обработать изображение %s pk=%s", model_label, pk)
+    finally:
+        if getattr(settings, 'IMAGE_RENDITIONS_ASYNC', True):
+            connections.close_all()
+
+
+def schedule(instance, image_field, variants_field):
+    args = (instance._meta.label, instance.pk, image_field, variants_field, getattr(instance, image_field).name)
+    if getattr(settings, 'IMAGE_RENDITIONS_ASYNC', True):
+        transaction.on_commit(lambda: _executor.submit(process_image, *args))
+    else:
+        transaction.on_commit(lambda: process_image(*args))
+
+
+def register(model, image_field, variants_field):
+    """Подключает генерацию копий к сохранению модели."""
+    def on_save(sender, instance, **kwargs):
+        field_file = getattr(instance, image_field)
+        variants = getattr(instance, variants_field) or {}
+        if field_file and field_file.name:
+            if variants.get('source') != field_file.name:
+                schedule(instance, image_field, variants_field)
+        elif variants:
+            # Картинку убрали — убираем и копии
+            sender.objects.filter(pk=instance.pk).update(**{variants_field: {}})
+            setattr(instance, variants_field, {})
+            delete_renditions(field_file.storage, variants)
+
+    post_save.connect(on_save, sender=model, weak=False, dispatch_uid=f'image-renditions-{model._meta.label}')
+
+
+def build_srcset(variants, storage, request=None):
+    """Карта копий для клиента: {"placeholder", "webp": {ширина: url}, "jpeg": {ширина: url}}."""
+    if not variants or not variants.get('renditions'):
+        return None
+
+    def url(name):
+        u = storage.url(name)
+        return request.build_absolute_uri(u) if request is not None else u
+
+    return {
+        'width': variants.get('width'),
+        'height': variants.get('height'),
+        'placeholder': variants.get('placeholder'),
+        'webp': {str(r['width']): url(r['webp']) for r in variants['renditions']},
+        'jpeg': {str(r['width']): url(r['jpeg']) for r in variants['renditions']},
+    }
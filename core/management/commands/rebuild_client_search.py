@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core import search
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс клиентов (FTS5, только SQLite)'
+
+    def handle(self, *args, **options):
+        if not search.fts_available():
+            self.stdout.write(self.style.WARNING('Поисковая таблица недоступна на этой БД, используется icontains'))
+            return
+        indexed = search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Проиндексировано клиентов: {indexed}"))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Rank, User
+from core.ranks import assign_ranks
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает текущий ранг клиентов после изменения порогов рангов'
+
+    def handle(self, *args, **options):
+        changed = assign_ranks(User, Rank)
+        self.stdout.write(self.style.SUCCESS(f"Обновлено клиентов: {changed}"))
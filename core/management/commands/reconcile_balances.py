@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from core.reconciliation import DEFAULT_CHUNK_SIZE, FIX_COUNTERS, FIX_LEDGER, reconcile_balances
+
+
+class Command(BaseCommand):
+    help = 'Сверяет баллы, штампы и сумму трат клиентов с журналом баланса, а журнал — с транзакциями и заказами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Пользователей в одной пачке')
+        parser.add_argument(
+            '--fix', choices=[FIX_LEDGER, FIX_COUNTERS], default=None,
+            help='ledger — дописать корректировки в журнал, counters — вернуть счётчики к журналу',
+        )
+        parser.add_argument('--limit', type=int, default=50, help='Сколько расхождений вывести')
+
+    def handle(self, *args, **options):
+        result = reconcile_balances(chunk_size=options['chunk_size'], fix=options['fix'])
+        for mismatch in result.mismatches[:options['limit']]:
+            delta = ', '.join(f"{name}: {value:+}" for name, value in mismatch.delta.items() if value)
+            self.stdout.write(f"Клиент {mismatch.user_id}: {delta}")
+        for issue in result.source_issues[:options['limit']]:
+            self.stdout.write(f"Клиент {issue.user_id}, {issue.reference}: {issue.problem}")
+        failed = (result.mismatches and not result.fixed) or result.source_issues
+        style = self.style.WARNING if failed else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Проверено: {result.checked}, расхождений: {len(result.mismatches)}, "
+            f"исправлено: {result.fixed}, расхождений с транзакциями и заказами: {len(result.source_issues)}, "
+            f"время: {result.seconds:.2f} с"
+        ))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.models import UserRoleCount
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики пользователей по ролям (приблизительный total в списках)'
+
+    def handle(self, *args, **options):
+        counts = UserRoleCount.recount()
+        summary = ', '.join(f"{role}: {total}" for role, total in sorted(counts.items())) or 'пользователей нет'
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.balances import snapshot_balances
+
+
+class Command(BaseCommand):
+    help = 'Сворачивает хвосты журнала баланса в новые снимки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-entries', type=int, default=1, help='Минимум записей в хвосте для нового снимка')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Снимков в одной вставке')
+
+    def handle(self, *args, **options):
+        created = snapshot_balances(min_entries=options['min_entries'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Создано снимков: {created}"))
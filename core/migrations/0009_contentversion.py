@@ -0,0 +1,27 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_remove_rank_icon_url_rank_color_rank_icon'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50, unique=True, verbose_name='Ключ')),
+                ('version', models.PositiveBigIntegerField(default=0, verbose_name='Версия')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Изменено')),
+            ],
+            options={
+                'verbose_name': 'Версия данных',
+                'verbose_name_plural': 'Версии данных',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_contentversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rank',
+            name='icon_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии иконки'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:46
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_rank_icon_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=50, verbose_name='Операция')),
+                ('key', models.CharField(max_length=255, verbose_name='Ключ')),
+                ('request_hash', models.CharField(max_length=64, verbose_name='Хэш запроса')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='HTTP статус')),
+                ('response_body', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Тело ответа')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Истекает')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_keys', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Ключ идемпотентности',
+                'verbose_name_plural': 'Ключи идемпотентности',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='idempotencykey',
+            constraint=models.UniqueConstraint(fields=('user', 'scope', 'key'), name='core_idempotency_key_unique'),
+        ),
+    ]
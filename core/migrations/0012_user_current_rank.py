@@ -0,0 +1,40 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_current_rank(apps, schema_editor):
+    # Логика core.ranks.assign_ranks на исторических моделях: один UPDATE на полосу
+    # между соседними порогами, при равных порогах побеждает последний ранг
+    User = apps.get_model('core', 'User')
+    Rank = apps.get_model('core', 'Rank')
+    ranks = sorted(Rank.objects.all(), key=lambda r: (r.min_total_spent_som, r.id))
+    for index, rank in enumerate(ranks):
+        band = User.objects.filter(total_spent__gte=rank.min_total_spent_som * 100)
+        if index + 1 < len(ranks):
+            upper = ranks[index + 1].min_total_spent_som
+            if upper == rank.min_total_spent_som:
+                continue
+            band = band.filter(total_spent__lt=upper * 100)
+        band.update(current_rank=rank.id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='current_rank',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='clients', to='core.rank', verbose_name='Текущий ранг'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['role', 'current_rank'], name='core_user_role_rank_idx'),
+        ),
+        migrations.RunPython(fill_current_rank, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.2.3 on 2026-10-18 09:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def open_balances(apps, schema_editor):
+    # Текущие счётчики становятся начальными записями журнала, пачками по id
+    User = apps.get_model('core', 'User')
+    BalanceLedgerEntry = apps.get_model('core', 'BalanceLedgerEntry')
+    users = User.objects.exclude(points=0, coffee_count=0, total_spent=0).order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(users.filter(id__gt=last_id).values('id', 'points', 'coffee_count', 'total_spent')[:1000])
+        if not chunk:
+            break
+        BalanceLedgerEntry.objects.bulk_create([
+            BalanceLedgerEntry(
+                user_id=row['id'], points=row['points'], coffee_count=row['coffee_count'],
+                total_spent=row['total_spent'], reason='opening',
+            )
+            for row in chunk
+        ])
+        last_id = chunk[-1]['id']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_user_current_rank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ledger_entry_id', models.BigIntegerField(default=0, verbose_name='Последняя учтённая запись журнала')),
+                ('points', models.IntegerField(default=0, verbose_name='Баллы')),
+                ('coffee_count', models.IntegerField(default=0, verbose_name='Штампы')),
+                ('total_spent', models.IntegerField(default=0, verbose_name='Сумма трат (в копейках)')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Время')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to=settings.AUTH_USER_MODEL, verbose_name='Клиент')),
+            ],
+            options={
+                'verbose_name': 'Снимок баланса',
+                'verbose_name_plural': 'Снимки баланса',
+                'indexes': [models.Index(fields=['user', '-ledger_entry_id'], name='core_snapshot_user_entry_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BalanceLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.IntegerField(default=0, verbose_name='Баллы')),
+                ('coffee_count', models.IntegerField(default=0, verbose_name='Штампы')),
+                ('total_spent', models.IntegerField(default=0, verbose_name='Сумма трат (в копейках)')),
+                ('reason', models.CharField(choices=[('opening', 'Начальный остаток'), ('loyalty_transaction', 'Транзакция лояльности'), ('order_accepted', 'Заказ принят'), ('order_cancelled', 'Заказ отменён'), ('manual', 'Ручное начисление'), ('adjustment', 'Корректировка сверки')], max_length=32, verbose_name='Причина')),
+                ('reference', models.CharField(blank=True, max_length=64, verbose_name='Основание')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Время')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_entries', to=settings.AUTH_USER_MODEL, verbose_name='Клиент')),
+            ],
+            options={
+                'verbose_name': 'Запись журнала баланса',
+                'verbose_name_plural': 'Журнал баланса',
+                'indexes': [models.Index(fields=['user', 'id'], name='core_ledger_user_id_idx')],
+            },
+        ),
+        migrations.RunPython(open_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_balance_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='card_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Версия карточки клиента'),
+        ),
+    ]
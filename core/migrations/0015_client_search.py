@@ -0,0 +1,73 @@
+# Generated by Django 4.2.3 on 2026-10-18 09:07
+
+import re
+
+from django.db import migrations, models
+
+# Имена и DDL зафиксированы здесь, а не взяты из core.search: миграция не
+# должна меняться вместе с кодом приложения
+SEARCH_TABLE = 'core_user_search'
+# Разделители, которые встречаются в номерах; остальные символы добираются в Python
+PHONE_SEPARATORS = [' ', '+', '-', '(', ')', '.', '/']
+PHONE_DIGITS_MAX_LENGTH = 20
+
+
+def _strip_separators(column):
+    expression = f"COALESCE({column}, '')"
+    for separator in PHONE_SEPARATORS:
+        expression = f"REPLACE({expression}, '{separator}', '')"
+    return expression
+
+
+def _reversed(column):
+    # В SQLite нет reverse(): строка не длиннее max_length собирается посимвольно с конца
+    return ' || '.join(f'SUBSTR({column}, {i}, 1)' for i in range(PHONE_DIGITS_MAX_LENGTH, 0, -1))
+
+
+def fill_search(apps, schema_editor):
+    User = apps.get_model('core', 'User')
+    table = schema_editor.quote_name(User._meta.db_table)
+    schema_editor.execute(f'UPDATE {table} SET phone_digits = {_strip_separators("phone")}')
+    # Редкие номера с другими символами — построчно, без загрузки всей таблицы
+    leftovers = User.objects.exclude(phone_digits__regex=r'^[0-9]*$').values_list('id', 'phone')
+    for user_id, phone in leftovers.iterator(chunk_size=1000):
+        User.objects.filter(pk=user_id).update(phone_digits=re.sub(r'\D', '', phone or ''))
+    schema_editor.execute(f'UPDATE {table} SET phone_digits_reversed = {_reversed("phone_digits")}')
+
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(name, phone, tokenize = 'trigram')"
+    )
+    schema_editor.execute(
+        f"INSERT INTO {SEARCH_TABLE} (rowid, name, phone) "
+        f"SELECT id, trim(coalesce(first_name, '') || ' ' || coalesce(last_name, '')), phone_digits "
+        f"FROM {table} WHERE role = 'client'"
+    )
+    schema_editor.execute(f'ANALYZE {table}')
+
+
+def drop_search(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_user_card_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_digits_reversed',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.RunPython(fill_search, drop_search),
+    ]
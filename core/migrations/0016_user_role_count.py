@@ -0,0 +1,39 @@
+# Generated by Django 4.2.3 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+def fill_counts(apps, schema_editor):
+    User = apps.get_model('core', 'User')
+    UserRoleCount = apps.get_model('core', 'UserRoleCount')
+    UserRoleCount.objects.bulk_create([
+        UserRoleCount(role=role, count=total)
+        for role, total in User.objects.values_list('role').annotate(total=models.Count('id'))
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_client_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRoleCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(max_length=20, unique=True, verbose_name='Роль')),
+                ('count', models.BigIntegerField(default=0, verbose_name='Количество')),
+            ],
+            options={
+                'verbose_name': 'Счётчик пользователей',
+                'verbose_name_plural': 'Счётчики пользователей',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['role', 'date_joined'], name='core_user_role_joined_idx'),
+        ),
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+    ]
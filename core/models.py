@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 from colorfield.fields import ColorField
 
 # Create your models here.
@@ -126,6 +128,22 @@ class User(AbstractBaseUser, PermissionsMixin):
     points = models.IntegerField(default=0, verbose_name="Баллы")
     coffee_count = models.IntegerField(default=0, verbose_name="Количество кофе")
     total_spent = models.IntegerField(default=0, verbose_name="Общий чек (в копейках)")
+    # Денормализованный ранг по total_spent: пересчитывается в save(), после правки
+    # порогов — командой recompute_ranks
+    current_rank = models.ForeignKey(
+        'Rank',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='clients',
+        verbose_name="Текущий ранг"
+    )
+    # Нормализованный телефон для поиска (core.search): только цифры и они же задом наперёд
+    phone_digits = models.CharField(max_length=20, blank=True, default='', editable=False, db_index=True)
+    phone_digits_reversed = models.CharField(max_length=20, blank=True, default='', editable=False, db_index=True)
+    # Растёт при каждом изменении данных карточки клиента (core.cards)
+    card_version = models.PositiveIntegerField(default=0, editable=False, verbose_name="Версия карточки клиента")
 
     USERNAME_FIELD = 'phone'
     REQUIRED_FIELDS = ['role']
@@ -135,11 +153,35 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return f"{self.get_role_display()} {self.phone}"
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'phone' in update_fields:
+            from .search import digits_only
+            self.phone_digits = digits_only(self.phone)
+            self.phone_digits_reversed = self.phone_digits[::-1]
+            if update_fields is not None:
+                update_fields = kwargs['update_fields'] = set(update_fields) | {'phone_digits', 'phone_digits_reversed'}
+        if update_fields is None or 'total_spent' in update_fields:
+            from .ranks import current_rank
+            rank = current_rank(self.total_spent)
+            self.current_rank_id = rank.id if rank else None
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'current_rank'}
+        opening = self._state.adding and (self.points or self.coffee_count or self.total_spent)
+        super().save(*args, **kwargs)
+        if opening:
+            # Начальный баланс нового клиента тоже проходит через журнал
+            BalanceLedgerEntry.objects.create(
+                user=self, points=self.points, coffee_count=self.coffee_count,
+                total_spent=self.total_spent, reason=BalanceLedgerEntry.REASON_OPENING,
+            )
+
     def add_points(self, points_to_add):
         """Добавить баллы клиенту"""
         if self.role == self.ROLE_CLIENT:
-            self.points += points_to_add
-            self.save()
+            from .balances import apply_balance_change
+            apply_balance_change(self.pk, points=points_to_add, reason=BalanceLedgerEntry.REASON_MANUAL)
+            self.refresh_from_db(fields=['points'])
             return True
         return False
 
@@ -164,6 +206,17 @@ class User(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            models.Index(fields=['role', 'current_rank'], name='core_user_role_rank_idx'),
+            models.Index(fields=['role', 'date_joined'], name='core_user_role_joined_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Роль на момент загрузки: по ней сигнал переносит пользователя между счётчиками UserRoleCount
+        instance._loaded_role = instance.__dict__.get('role')
+        return instance
 
 
 class Rank(models.Model):
@@ -172,6 +225,7 @@ class Rank(models.Model):
     min_total_spent_som = models.IntegerField(verbose_name='Минимальная сумма, сом')
     cashback_percent = models.IntegerField(verbose_name='Кэшбек, %')
     icon = models.ImageField(upload_to='ranks/', blank=True, null=True, verbose_name='Иконка')
+    icon_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name='Уменьшенные копии иконки')
     color = ColorField(default="#000000", blank=True, verbose_name='Цвет ранга (HEX)')
 
     class Meta:
@@ -185,39 +239,187 @@ class Rank(models.Model):
     @classmethod
     def get_current_for_total_spent(cls, total_spent_kop: int):
         """Возвращает текущий ранг для переданной суммы трат в копейках."""
-        total_spent_som = (total_spent_kop or 0) // 100
-        ranks = list(cls.objects.all().order_by('min_total_spent_som'))
-        current = None
-        for r in ranks:
-            if total_spent_som >= r.min_total_spent_som:
-                current = r
-            else:
-                break
-        return current
+        from .ranks import get_table
+        return get_table().current(total_spent_kop)
 
     @classmethod
     def get_next_after(cls, rank):
-        if not rank:
-            # Если ранга ещё нет, вернуть минимальный как следующий
-            return cls.objects.all().order_by('min_total_spent_som').first()
-        return cls.objects.filter(min_total_spent_som__gt=rank.min_total_spent_som).order_by('min_total_spent_som').first()
+        # Если ранга ещё нет, вернуть минимальный как следующий
+        from .ranks import get_table
+        return get_table().next_after(rank)
 
     @classmethod
     def get_progress_percent(cls, total_spent_kop: int):
         """Возвращает (current_rank, next_rank, progress_percent 1..100)."""
-        total_spent_som = (total_spent_kop or 0) // 100
-        current = cls.get_current_for_total_spent(total_spent_kop)
-        next_rank = cls.get_next_after(current) if current else cls.get_next_after(None)
-        if not current and next_rank:
-            # До первого ранга
-            distance = max(1, next_rank.min_total_spent_som)
-            progress = int(round((total_spent_som / distance) * 100))
-        elif current and next_rank:
-            base = current.min_total_spent_som
-            distance = max(1, next_rank.min_total_spent_som - base)
-            progress = int(round(((total_spent_som - base) / distance) * 100))
-        else:
-            # На максимальном ранге
-            progress = 100
-        progress = max(1, min(100, progress))
-        return current, next_rank, progress
+        from .ranks import resolve
+        return resolve(total_spent_kop)
+
+
+class ContentVersion(models.Model):
+    """Счётчик версий для редко меняющихся данных (меню, ранги, заведения).
+
+    Увеличивается сигналами при каждой записи в соответствующие модели.
+    Используется для инвалидации кэшей между воркерами: чтение версии —
+    один запрос по уникальному ключу.
+    """
+    key = models.CharField(max_length=50, unique=True, verbose_name='Ключ')
+    version = models.PositiveBigIntegerField(default=0, verbose_name='Версия')
+    updated_at = models.DateTimeField(default=timezone.now, verbose_name='Изменено')
+
+    class Meta:
+        verbose_name = 'Версия данных'
+        verbose_name_plural = 'Версии данных'
+
+    def __str__(self):
+        return f"{self.key}: {self.version}"
+
+    @classmethod
+    def bump(cls, key: str):
+        """Увеличивает версию ключа (создаёт запись при первом обращении)."""
+        now = timezone.now()
+        updated = cls.objects.filter(key=key).update(version=models.F('version') + 1, updated_at=now)
+        if not updated:
+            obj, created = cls.objects.get_or_create(key=key, defaults={'version': 1, 'updated_at': now})
+            if not created:
+                cls.objects.filter(key=key).update(version=models.F('version') + 1, updated_at=now)
+
+    @classmethod
+    def get_many(cls, keys):
+        """Возвращает {key: (version, updated_at)} одним запросом. Отсутствующие ключи — (0, None)."""
+        rows = cls.objects.filter(key__in=list(keys)).values_list('key', 'version', 'updated_at')
+        result = {key: (0, None) for key in keys}
+        for key, version, updated_at in rows:
+            result[key] = (version, updated_at)
+        return result
+
+
+class UserRoleCount(models.Model):
+    """Число пользователей каждой роли для приблизительного total в списках.
+
+    Поддерживается сигналами при создании, удалении и смене роли; массовые
+    операции в обход save() его не трогают, поэтому счётчик приблизительный и
+    пересчитывается командой recount_users (или recount()).
+    """
+    role = models.CharField(max_length=20, unique=True, verbose_name='Роль')
+    count = models.BigIntegerField(default=0, verbose_name='Количество')
+
+    class Meta:
+        verbose_name = 'Счётчик пользователей'
+        verbose_name_plural = 'Счётчики пользователей'
+
+    def __str__(self):
+        return f"{self.role}: {self.count}"
+
+    @classmethod
+    def adjust(cls, role, delta):
+        if not cls.objects.filter(role=role).update(count=models.F('count') + delta):
+            obj, created = cls.objects.get_or_create(role=role, defaults={'count': delta})
+            if not created:
+                cls.objects.filter(role=role).update(count=models.F('count') + delta)
+
+    @classmethod
+    def estimate(cls, role):
+        """Приблизительное число пользователей роли; None, если счётчика ещё нет."""
+        return cls.objects.filter(role=role).values_list('count', flat=True).first()
+
+    @classmethod
+    def recount(cls):
+        """Пересчитывает все счётчики одним GROUP BY."""
+        counts = dict(User.objects.values_list('role').annotate(total=models.Count('id')))
+        for role, total in counts.items():
+            cls.objects.update_or_create(role=role, defaults={'count': total})
+        cls.objects.exclude(role__in=list(counts)).update(count=0)
+        return counts
+
+
+class IdempotencyKey(models.Model):
+    """Сохранённый ответ на POST с заголовком Idempotency-Key (см. core.idempotency).
+
+    status_code = NULL означает, что запрос с этим ключом ещё выполняется.
+    """
+    user = models.ForeignKey(
+        'User', on_delete=models.CASCADE, related_name='idempotency_keys', verbose_name='Пользователь',
+    )
+    scope = models.CharField(max_length=50, verbose_name='Операция')
+    key = models.CharField(max_length=255, verbose_name='Ключ')
+    request_hash = models.CharField(max_length=64, verbose_name='Хэш запроса')
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name='HTTP статус')
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder, verbose_name='Тело ответа')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True, verbose_name='Истекает')
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Ключи идемпотентности'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope', 'key'], name='core_idempotency_key_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope}:{self.key}"
+
+
+class BalanceLedgerEntry(models.Model):
+    """Неизменяемая запись журнала изменений баланса клиента (см. core.balances).
+
+    Каждое изменение points / coffee_count / total_spent пишет сюда дельты;
+    баланс = последний BalanceSnapshot + сумма записей после него.
+    """
+    REASON_OPENING = 'opening'
+    REASON_LOYALTY_TRANSACTION = 'loyalty_transaction'
+    REASON_ORDER_ACCEPTED = 'order_accepted'
+    REASON_ORDER_CANCELLED = 'order_cancelled'
+    REASON_MANUAL = 'manual'
+    REASON_ADJUSTMENT = 'adjustment'
+
+    REASON_CHOICES = [
+        (REASON_OPENING, 'Начальный остаток'),
+        (REASON_LOYALTY_TRANSACTION, 'Транзакция лояльности'),
+        (REASON_ORDER_ACCEPTED, 'Заказ принят'),
+        (REASON_ORDER_CANCELLED, 'Заказ отменён'),
+        (REASON_MANUAL, 'Ручное начисление'),
+        (REASON_ADJUSTMENT, 'Корректировка сверки'),
+    ]
+
+    user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='balance_entries', verbose_name='Клиент')
+    points = models.IntegerField(default=0, verbose_name='Баллы')
+    coffee_count = models.IntegerField(default=0, verbose_name='Штампы')
+    total_spent = models.IntegerField(default=0, verbose_name='Сумма трат (в копейках)')
+    reason = models.CharField(max_length=32, choices=REASON_CHOICES, verbose_name='Причина')
+    reference = models.CharField(max_length=64, blank=True, verbose_name='Основание')
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='Время')
+
+    class Meta:
+        verbose_name = 'Запись журнала баланса'
+        verbose_name_plural = 'Журнал баланса'
+        indexes = [
+            models.Index(fields=['user', 'id'], name='core_ledger_user_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_reason_display()} {self.reference}: {self.points:+}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Записи журнала баланса не изменяются')
+        super().save(*args, **kwargs)
+
+
+class BalanceSnapshot(models.Model):
+    """Баланс клиента с учётом всех записей журнала до ledger_entry_id включительно."""
+    user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='balance_snapshots', verbose_name='Клиент')
+    ledger_entry_id = models.BigIntegerField(default=0, verbose_name='Последняя учтённая запись журнала')
+    points = models.IntegerField(default=0, verbose_name='Баллы')
+    coffee_count = models.IntegerField(default=0, verbose_name='Штампы')
+    total_spent = models.IntegerField(default=0, verbose_name='Сумма трат (в копейках)')
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='Время')
+
+    class Meta:
+        verbose_name = 'Снимок баланса'
+        verbose_name_plural = 'Снимки баланса'
+        indexes = [
+            models.Index(fields=['user', '-ledger_entry_id'], name='core_snapshot_user_entry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}@{self.ledger_entry_id}"
@@ -0,0 +1,207 @@
+"""Таблица рангов в памяти процесса.
+
+Рангов единицы, меняются они только из админки, а нужны почти каждому
+запросу клиента (кэшбек, прогресс до следующего ранга). Таблица читается
+один раз в отсортированные массивы, текущий и следующий ранг ищутся через
+bisect.
+
+Актуальность: запись Rank в этом процессе сбрасывает таблицу сигналом сразу;
+другие воркеры раз в RANK_CACHE_CHECK_SECONDS сверяют счётчик ContentVersion
+'ranks' (один запрос по уникальному ключу) и перечитывают таблицу, если он
+изменился.
+"""
+import threading
+import time
+from bisect import bisect_right
+
+from django.conf import settings
+from django.db.models import Case, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest, Least
+
+from .models import ContentVersion, Rank
+from .versioning import RANKS_VERSION_KEY, version_token
+
+
+def progress_percent(done, distance):
+    """Процент пути done из distance, округлённый половиной вверх, в пределах 1..100.
+
+    Считается в целых числах так же, как в SQL-аннотации annotate_ranks(),
+    чтобы список клиентов и карточка клиента показывали одно и то же.
+    """
+    distance = max(1, distance)
+    return max(1, min(100, (200 * done + distance) // (2 * distance)))
+
+
+class RankTable:
+    def __init__(self, ranks):
+        self.ranks = sorted(ranks, key=lambda r: (r.min_total_spent_som, r.id))
+        self.thresholds = [r.min_total_spent_som for r in self.ranks]
+
+    def current(self, total_spent_kop):
+        """Текущий ранг для суммы трат в копейках (None, если не дотянул до первого)."""
+        index = bisect_right(self.thresholds, (total_spent_kop or 0) // 100)
+        return self.ranks[index - 1] if index else None
+
+    def next_after(self, rank):
+        """Следующий ранг с порогом строго выше; для None — минимальный."""
+        if rank is None:
+            return self.ranks[0] if self.ranks else None
+        index = bisect_right(self.thresholds, rank.min_total_spent_som)
+        return self.ranks[index] if index < len(self.ranks) else None
+
+    def progress(self, total_spent_kop):
+        """Возвращает (current_rank, next_rank, progress_percent 1..100)."""
+        current = self.current(total_spent_kop)
+        next_rank = self.next_after(current)
+        if next_rank:
+            base = current.min_total_spent_som if current else 0
+            progress = progress_percent((total_spent_kop or 0) // 100 - base, next_rank.min_total_spent_som - base)
+        else:
+            # На максимальном ранге
+            progress = 100
+        return current, next_rank, progress
+
+    def by_id(self, rank_id):
+        for rank in self.ranks:
+            if rank.id == rank_id:
+                return rank
+        return None
+
+
+_lock = threading.Lock()
+_table = None
+_version = None
+_checked_at = 0.0
+
+
+def _read_version():
+    version, updated_at = ContentVersion.get_many([RANKS_VERSION_KEY])[RANKS_VERSION_KEY]
+    return version_token(version, updated_at)
+
+
+def get_table():
+    """Актуальная таблица рангов; в установившемся режиме — без запросов к БД."""
+    global _table, _version, _checked_at
+    interval = getattr(settings, 'RANK_CACHE_CHECK_SECONDS', 5)
+    now = time.monotonic()
+    table = _table
+    if table is not None and now - _checked_at < interval:
+        return table
+    with _lock:
+        if _table is not None and now - _checked_at < interval:
+            return _table
+        version = _read_version()
+        if _table is None or version != _version:
+            _table = RankTable(Rank.objects.all())
+            _version = version
+        _checked_at = now
+        return _table
+
+
+def version():
+    """Версия актуальной таблицы рангов (для ключей кэша, зависящих от рангов)."""
+    get_table()
+    return _version
+
+
+def invalidate():
+    """Сбрасывает таблицу: следующий get_table() перечитает ранги."""
+    global _table, _version
+    with _lock:
+        _table = None
+        _version = None
+
+
+def resolve(total_spent_kop):
+    """(current_rank, next_rank, progress_percent) для суммы трат в копейках."""
+    return get_table().progress(total_spent_kop)
+
+
+def current_rank(total_spent_kop):
+    return get_table().current(total_spent_kop)
+
+
+def _bands(table):
+    """(ранг, нижняя граница, верхняя граница или None) в копейках для каждой полосы
+    между соседними порогами. При равных порогах побеждает последний ранг, как в
+    RankTable.current, у остальных полосы нет."""
+    for index, rank in enumerate(table.ranks):
+        upper = table.thresholds[index + 1] if index + 1 < len(table.ranks) else None
+        if upper == rank.min_total_spent_som:
+            continue
+        yield rank, rank.min_total_spent_som * 100, None if upper is None else upper * 100
+
+
+def assign_ranks(user_model, rank_model, rank_ids=None):
+    """Пересчитывает User.current_rank по порогам: один UPDATE на полосу между
+    соседними порогами плюс один для сумм ниже первого. Возвращает число
+    изменённых строк.
+
+    rank_ids ограничивает пересчёт клиентами, у которых один из этих рангов
+    сейчас стоит или должен стоять по порогам."""
+    table = RankTable(rank_model.objects.all())
+    users = user_model.objects.all()
+    if rank_ids is not None:
+        rank_ids = set(rank_ids)
+        scope = Q(current_rank__in=rank_ids)
+        for rank, lower, upper in _bands(table):
+            if rank.id in rank_ids:
+                scope |= Q(total_spent__gte=lower) & (Q() if upper is None else Q(total_spent__lt=upper))
+        users = users.filter(scope)
+    if not table.ranks:
+        return users.exclude(current_rank=None).update(current_rank=None)
+    below = users.filter(total_spent__lt=table.thresholds[0] * 100)
+    changed = below.exclude(current_rank=None).update(current_rank=None)
+    for rank, lower, upper in _bands(table):
+        band = users.filter(total_spent__gte=lower)
+        if upper is not None:
+            band = band.filter(total_spent__lt=upper)
+        changed += band.exclude(current_rank_id=rank.id).update(current_rank=rank.id)
+    return changed
+
+
+def _current_rank(field):
+    """Коррелированный подзапрос: поле текущего ранга клиента по total_spent (копейки)."""
+    return Subquery(
+        Rank.objects.annotate(threshold_kop=F('min_total_spent_som') * 100)
+        .filter(threshold_kop__lte=OuterRef('total_spent'))
+        .order_by('-min_total_spent_som', '-id')
+        .values(field)[:1]
+    )
+
+
+def _next_rank(field):
+    """Поле следующего ранга: первый с порогом строго выше текущего (для клиента без ранга — минимальный)."""
+    return Subquery(
+        Rank.objects.filter(min_total_spent_som__gt=Coalesce(OuterRef('rank_min_som'), Value(-1)))
+        .order_by('min_total_spent_som', 'id')
+        .values(field)[:1]
+    )
+
+
+def annotate_ranks(queryset):
+    """Добавляет к queryset пользователей ранг, кэшбек, следующий ранг и прогресс, посчитанные в SQL:
+
+    rank_id_sql, rank_min_som, rank_cashback, next_rank_id_sql, next_rank_min_som, rank_progress.
+
+    По ним список клиентов сортируется и фильтруется, а сериализатор читает
+    готовые значения (RankFieldsMixin) вместо расчёта на каждую строку.
+    """
+    queryset = queryset.annotate(
+        rank_id_sql=_current_rank('id'),
+        rank_min_som=_current_rank('min_total_spent_som'),
+        rank_cashback=Coalesce(_current_rank('cashback_percent'), Value(0)),
+    ).annotate(
+        next_rank_id_sql=_next_rank('id'),
+        next_rank_min_som=_next_rank('min_total_spent_som'),
+    )
+    base = Coalesce(F('rank_min_som'), Value(0))
+    distance = Greatest(F('next_rank_min_som') - base, Value(1))
+    done = F('total_spent') / 100 - base
+    return queryset.annotate(
+        rank_progress=Case(
+            When(next_rank_min_som__isnull=True, then=Value(100)),
+            default=Greatest(Value(1), Least(Value(100), (200 * done + distance) / (2 * distance))),
+            output_field=IntegerField(),
+        )
+    )
@@ -0,0 +1,248 @@
+"""Ночная сверка счётчиков баланса с журналом.
+
+Ожидаемый баланс клиента — последний BalanceSnapshot плюс записи журнала
+после него (см. core.balances). Счётчики core_user сверяются с ним пачками по
+диапазону id: на пачку три агрегирующих запроса (счётчики, снимки, хвосты
+журнала), без загрузки моделей и без прохода по истории в Python.
+
+Расхождение значит, что баланс поменяли в обход apply_balance_change. Его
+можно исправить в одну из сторон:
+- FIX_LEDGER — дописать в журнал корректировку, счётчики остаются как есть;
+- FIX_COUNTERS — вернуть счётчики к значению по журналу.
+
+Журнал и счётчики пишет один и тот же код, поэтому ошибку в нём (например,
+лишний возврат баллов при отмене заказа) первая проверка не увидит. Вторая
+(find_source_issues) сверяет с исходными строками: total_spent — с суммой
+LoyaltyTransaction.amount и final_amount применённых заказов, записи журнала
+loyalty_transaction:<id> и order:<id> — со своими транзакциями и заказами.
+Такие расхождения только выводятся: что исправлять, решает человек.
+"""
+import time
+from dataclasses import dataclass, field
+
+from django.db import transaction
+from django.db.models import F, Max, Min, OuterRef, Subquery, Sum, Value
+
+from . import authentication
+from .balances import BALANCE_FIELDS, balance_for, entries_after_snapshot, rank_for_total_spent
+from .models import BalanceLedgerEntry, BalanceSnapshot, User
+
+FIX_LEDGER = 'ledger'
+FIX_COUNTERS = 'counters'
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+@dataclass
+class Mismatch:
+    user_id: int
+    actual: dict
+    expected: dict
+
+    @property
+    def delta(self):
+        """Насколько счётчики расходятся с журналом, по полям."""
+        return {name: self.actual[name] - self.expected[name] for name in BALANCE_FIELDS}
+
+
+@dataclass
+class SourceIssue:
+    user_id: int
+    reference: str
+    problem: str
+
+
+@dataclass
+class ReconcileResult:
+    checked: int = 0
+    mismatches: list = field(default_factory=list)
+    source_issues: list = field(default_factory=list)
+    fixed: int = 0
+    seconds: float = 0.0
+
+
+def _expected_balances(lo, hi):
+    """{user_id: {поле: значение}} по журналу для пользователей с id в [lo, hi)."""
+    expected = {}
+    latest = BalanceSnapshot.objects.filter(
+        user_id=OuterRef('user_id'),
+    ).order_by('-ledger_entry_id', '-id').values('id')[:1]
+    for row in BalanceSnapshot.objects.filter(user_id__gte=lo, user_id__lt=hi, id=Subquery(latest)).values(
+        'user_id', *BALANCE_FIELDS
+    ):
+        expected[row.pop('user_id')] = row
+    tails = entries_after_snapshot().filter(user_id__gte=lo, user_id__lt=hi).values('user_id').annotate(
+        **{f'sum_{name}': Sum(name) for name in BALANCE_FIELDS}
+    )
+    for row in tails:
+        balance = expected.setdefault(row['user_id'], dict.fromkeys(BALANCE_FIELDS, 0))
+        for name in BALANCE_FIELDS:
+            balance[name] += row[f'sum_{name}']
+    return expected
+
+
+def find_mismatches(lo, hi):
+    """Расхождения счётчиков с журналом для пользователей с id в [lo, hi). Три запроса."""
+    expected = _expected_balances(lo, hi)
+    zero = dict.fromkeys(BALANCE_FIELDS, 0)
+    mismatches = []
+    checked = 0
+    for row in User.objects.filter(id__gte=lo, id__lt=hi).values('id', *BALANCE_FIELDS):
+        checked += 1
+        user_id = row.pop('id')
+        if row != expected.get(user_id, zero):
+            mismatches.append(Mismatch(user_id, row, expected.get(user_id, zero)))
+    return checked, mismatches
+
+
+SOURCE_REASONS = (
+    BalanceLedgerEntry.REASON_LOYALTY_TRANSACTION,
+    BalanceLedgerEntry.REASON_ORDER_ACCEPTED,
+    BalanceLedgerEntry.REASON_ORDER_CANCELLED,
+)
+
+
+def ledger_started_at():
+    """Время первой записи журнала: более ранние операции учтены в начальных остатках."""
+    return BalanceLedgerEntry.objects.aggregate(started=Min('created_at'))['started']
+
+
+def _order_problem(order, applied, entry):
+    """Что не так с записями журнала заказа (entry — их суммы) или None."""
+    from cart.transitions import LOYALTY_APPLIED, Status
+
+    earn = order['planned_earn_points']
+    spend = order['planned_points_to_spend'] if order['planned_use_points'] else 0
+    if entry is None:
+        return 'нет записи журнала о принятии' if applied else None
+    if order['status'] == Status.NEW:
+        return 'записи журнала у непринятого заказа'
+    if order['status'] in LOYALTY_APPLIED:
+        expected_total, expected_coffee = order['final_amount'], order['planned_coffee_quantity']
+        # Списание при принятии урезается до баланса клиента
+        points_range = (earn - spend, earn)
+    else:
+        # Отмена возвращает всё, кроме начисленных баллов и штампов, которые клиент успел потратить
+        expected_total, expected_coffee = 0, None
+        points_range = (0, earn)
+    if entry['total_spent'] != expected_total:
+        return f"сумма трат по журналу {entry['total_spent']}, по заказу {expected_total}"
+    if expected_coffee is not None and entry['coffee_count'] != expected_coffee:
+        return f"штампы по журналу {entry['coffee_count']}, по заказу {expected_coffee}"
+    if expected_coffee is None and not 0 <= entry['coffee_count'] <= order['planned_coffee_quantity']:
+        return f"штампы после отмены {entry['coffee_count']:+}"
+    if not points_range[0] <= entry['points'] <= points_range[1]:
+        return f"баллы по журналу {entry['points']:+}, допустимо от {points_range[0]} до {points_range[1]}"
+    return None
+
+
+def find_source_issues(lo, hi, since=None):
+    """Расхождения с исходными строками для пользователей с id в [lo, hi). Четыре запроса.
+
+    since — начало журнала (ledger_started_at): транзакции и заказы до него
+    записей в журнале не имеют и проверяются только в сумме трат.
+    """
+    from cart.transitions import LOYALTY_APPLIED
+    from cart.models import Order
+    from loyalty.models import LoyaltyTransaction
+
+    if since is None:
+        since = ledger_started_at()
+    entries = {
+        (row['user_id'], row['reference']): row
+        for row in BalanceLedgerEntry.objects.filter(
+            user_id__gte=lo, user_id__lt=hi, reason__in=SOURCE_REASONS,
+        ).values('user_id', 'reference').annotate(**{name: Sum(name) for name in BALANCE_FIELDS})
+    }
+    spent = {}
+    issues = []
+
+    for trx in LoyaltyTransaction.objects.filter(user_id__gte=lo, user_id__lt=hi).order_by().values(
+        'id', 'user_id', 'amount', 'points_earned', 'points_used', 'created_at'
+    ):
+        spent[trx['user_id']] = spent.get(trx['user_id'], 0) + trx['amount']
+        reference = f"loyalty_transaction:{trx['id']}"
+        entry = entries.pop((trx['user_id'], reference), None)
+        if since is None or trx['created_at'] < since:
+            continue
+        if entry is None:
+            issues.append(SourceIssue(trx['user_id'], reference, 'нет записи журнала'))
+        elif (entry['total_spent'], entry['points']) != (trx['amount'], trx['points_earned'] - trx['points_used']):
+            issues.append(SourceIssue(
+                trx['user_id'], reference,
+                f"журнал: {entry['points']:+} баллов, {entry['total_spent']} коп.; транзакция: "
+                f"{trx['points_earned'] - trx['points_used']:+} баллов, {trx['amount']} коп.",
+            ))
+
+    for order in Order.objects.filter(user_id__gte=lo, user_id__lt=hi).values(
+        'id', 'user_id', 'status', 'final_amount', 'planned_use_points', 'planned_points_to_spend',
+        'planned_earn_points', 'planned_coffee_quantity', 'created_at',
+    ):
+        applied = order['status'] in LOYALTY_APPLIED
+        if applied:
+            spent[order['user_id']] = spent.get(order['user_id'], 0) + order['final_amount']
+        reference = f"order:{order['id']}"
+        entry = entries.pop((order['user_id'], reference), None)
+        if since is None or order['created_at'] < since:
+            continue
+        problem = _order_problem(order, applied, entry)
+        if problem:
+            issues.append(SourceIssue(order['user_id'], reference, problem))
+
+    # Всё, что осталось, ссылается на несуществующую операцию или операцию другого клиента
+    for user_id, reference in entries:
+        issues.append(SourceIssue(user_id, reference, 'запись журнала без исходной операции'))
+
+    for row in User.objects.filter(id__gte=lo, id__lt=hi).values('id', 'total_spent'):
+        expected = spent.get(row['id'], 0)
+        if row['total_spent'] != expected:
+            issues.append(SourceIssue(
+                row['id'], 'total_spent', f"счётчик {row['total_spent']}, по транзакциям и заказам {expected}",
+            ))
+    return sorted(issues, key=lambda issue: (issue.user_id, issue.reference))
+
+
+def fix_mismatch(mismatch, direction):
+    """Исправляет расхождение под блокировкой строки клиента, заново сверив баланс:
+    между поиском и исправлением клиент мог получить новые начисления.
+    Возвращает True, если что-то изменилось."""
+    with transaction.atomic():
+        user = User.objects.select_for_update().only(*BALANCE_FIELDS).filter(pk=mismatch.user_id).first()
+        if user is None:
+            return False
+        actual = {name: getattr(user, name) for name in BALANCE_FIELDS}
+        expected = balance_for(user.pk)
+        if actual == expected:
+            return False
+        if direction == FIX_LEDGER:
+            BalanceLedgerEntry.objects.create(
+                user_id=user.pk, reason=BalanceLedgerEntry.REASON_ADJUSTMENT, reference='reconciliation',
+                **{name: actual[name] - expected[name] for name in BALANCE_FIELDS},
+            )
+        elif direction == FIX_COUNTERS:
+            User.objects.filter(pk=user.pk).update(
+                current_rank=rank_for_total_spent(Value(expected['total_spent'])),
+                card_version=F('card_version') + 1,
+                **expected,
+            )
+            authentication.invalidate_user(user.pk)
+        else:
+            raise ValueError(f'Неизвестное направление исправления: {direction}')
+        return True
+
+
+def reconcile_balances(chunk_size=DEFAULT_CHUNK_SIZE, fix=None):
+    """Сверяет всех пользователей пачками по chunk_size id; fix — FIX_LEDGER / FIX_COUNTERS / None."""
+    started = time.monotonic()
+    result = ReconcileResult()
+    max_id = User.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    since = ledger_started_at()
+    for lo in range(1, max_id + 1, chunk_size):
+        checked, mismatches = find_mismatches(lo, lo + chunk_size)
+        result.checked += checked
+        result.mismatches.extend(mismatches)
+        result.source_issues.extend(find_source_issues(lo, lo + chunk_size, since))
+        if fix:
+            result.fixed += sum(fix_mismatch(mismatch, fix) for mismatch in mismatches)
+    result.seconds = time.monotonic() - started
+    return result
@@ -0,0 +1,167 @@
+"""Поиск клиентов для списка менеджера (ClientListView).
+
+icontains по имени, фамилии и телефону — полный проход по core_user на
+каждое нажатие клавиши. Вместо него:
+
+- телефон: User.phone_digits (только цифры) и User.phone_digits_reversed
+  с индексами; префикс ищется диапазоном по phone_digits, окончание номера —
+  диапазоном по перевёрнутой строке;
+- имя и произвольный фрагмент номера: на SQLite — FTS5-таблица
+  core_user_search с триграммным токенизатором, строки синхронизируются
+  сигналами (core.signals) и командой rebuild_client_search.
+
+Каждый источник отдаёт не больше MAX_RESULTS лучших id отдельным запросом
+по своему индексу, поэтому время не зависит от размера таблицы. Порядок:
+совпадения по началу номера, по концу номера, затем по релевантности FTS
+(bm25). На других СУБД и для фрагментов короче MIN_TERM_LENGTH остаётся
+прежний icontains.
+"""
+import re
+
+from django.db import connection
+from django.db.models import IntegerField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from .models import User
+
+SEARCH_TABLE = 'core_user_search'
+
+# Триграммный токенизатор находит фрагменты не короче трёх символов
+MIN_TERM_LENGTH = 3
+# Сколько лучших совпадений берётся из каждого индекса
+MAX_RESULTS = 500
+# До скольких совпадений FTS они упорядочиваются по bm25
+RANK_CANDIDATES = 2000
+
+_available = {}
+
+
+def digits_only(value):
+    return re.sub(r'\D', '', value or '')
+
+
+def fts_available():
+    """Есть ли FTS5-таблица поиска в текущей БД (проверяется один раз на процесс)."""
+    alias = connection.alias
+    if alias not in _available:
+        if connection.vendor != 'sqlite':
+            _available[alias] = False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [SEARCH_TABLE])
+                _available[alias] = cursor.fetchone() is not None
+    return _available[alias]
+
+
+def reset():
+    _available.clear()
+
+
+def _name(first_name, last_name):
+    return ' '.join(part for part in (first_name, last_name) if part)
+
+
+def index_user(user):
+    """Обновляет строку пользователя в индексе; не клиенты из индекса убираются."""
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [user.pk])
+        if user.role == user.ROLE_CLIENT:
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, name, phone) VALUES (%s, %s, %s)",
+                [user.pk, _name(user.first_name, user.last_name), user.phone_digits],
+            )
+
+
+def remove_user(user_id):
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [user_id])
+
+
+def rebuild():
+    """Перестраивает индекс по core_user целиком (после массовых правок в обход save())."""
+    if not fts_available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, phone) "
+            f"SELECT id, trim(coalesce(first_name, '') || ' ' || coalesce(last_name, '')), phone_digits "
+            f"FROM core_user WHERE role = %s",
+            [User.ROLE_CLIENT],
+        )
+        indexed = cursor.rowcount
+        # Без статистики SQLite выбирает индекс по роли (почти все строки — клиенты)
+        # вместо поиска по найденным id
+        cursor.execute("ANALYZE core_user")
+        return indexed
+
+
+def _match_expression(term):
+    """Фразы FTS5 из слов запроса (все должны встретиться); None, если слов нужной длины нет."""
+    words = [word for word in term.split() if len(word) >= MIN_TERM_LENGTH]
+    if not words:
+        return None
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def _fts_ids(match):
+    """rowid из FTS5 по релевантности. bm25 считается по всем совпадениям, поэтому
+    для частых фрагментов (больше RANK_CANDIDATES строк) берутся просто новые клиенты."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s LIMIT %s", [match, RANK_CANDIDATES + 1]
+        )
+        order = 'rank' if len(cursor.fetchall()) <= RANK_CANDIDATES else 'rowid DESC'
+        cursor.execute(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s ORDER BY {order} LIMIT %s",
+            [match, MAX_RESULTS],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _ranked_ids(digits, match):
+    """id пользователей в порядке релевантности, не больше MAX_RESULTS из каждого источника.
+
+    Каждый запрос идёт только по своему индексу и обрывается по LIMIT; роль и
+    остальные фильтры списка накладываются уже на найденные id.
+    """
+    ids = []
+    if len(digits) >= MIN_TERM_LENGTH:
+        reversed_digits = digits[::-1]
+        # ':' следует за '9' в ASCII: [digits, digits + ':') — все строки с этим префиксом
+        ids += User.objects.filter(phone_digits__gte=digits, phone_digits__lt=digits + ':').order_by(
+            'phone_digits'
+        ).values_list('id', flat=True)[:MAX_RESULTS]
+        ids += User.objects.filter(
+            phone_digits_reversed__gte=reversed_digits, phone_digits_reversed__lt=reversed_digits + ':'
+        ).order_by('phone_digits_reversed').values_list('id', flat=True)[:MAX_RESULTS]
+    if match:
+        ids += _fts_ids(match)
+    return list(dict.fromkeys(ids))
+
+
+def search_clients(queryset, term):
+    """Фильтрует и упорядочивает queryset клиентов по строке поиска."""
+    term = (term or '').strip()
+    if not term:
+        return queryset
+    digits = digits_only(term)
+    match = _match_expression(term)
+    if match and not fts_available():
+        match = None
+    if match or len(digits) >= MIN_TERM_LENGTH:
+        ids = _ranked_ids(digits, match)
+        # Порядок задаётся одним CASE в SQL: сотни When() компилировались бы дольше самих запросов
+        position = RawSQL(
+            'CASE "core_user"."id" ' + 'WHEN %s THEN %s ' * len(ids) + 'END',
+            [value for pair in ((user_id, index) for index, user_id in enumerate(ids)) for value in pair],
+            output_field=IntegerField(),
+        ) if ids else Value(0, output_field=IntegerField())
+        return queryset.filter(id__in=ids).annotate(search_position=position).order_by('search_position')
+    return queryset.filter(
+        Q(first_name__icontains=term) | Q(last_name__icontains=term) | Q(phone__icontains=term)
+    )
@@ -1,4 +1,6 @@
 from rest_framework import serializers
+from . import ranks
+from .images import build_srcset
 from .models import User, CoffeeShop, Rank
 
 
@@ -68,43 +70,30 @@ class BaristaInfoSerializer(serializers.ModelSerializer):
         return False
 
 
-class ClientInfoSerializer(serializers.ModelSerializer):
-    free_coffee_count = serializers.SerializerMethodField()
-    coffee_to_next_free = serializers.SerializerMethodField()
-    total_spent_rubles = serializers.SerializerMethodField()
-    rank = serializers.SerializerMethodField()
-    cashback_percent = serializers.SerializerMethodField()
-    next_rank = serializers.SerializerMethodField()
-    progress_to_next_percent = serializers.SerializerMethodField()
-    rank_color = serializers.SerializerMethodField()
-    rank_icon = serializers.SerializerMethodField()
-
-    notifications = serializers.SerializerMethodField()
-    redeem_token = serializers.SerializerMethodField()
-
-    class Meta:
-        model = User
-        fields = [
-            'id', 'phone', 'first_name', 'last_name', 'birth_date',
-            'points', 'coffee_count', 'total_spent',
-            'free_coffee_count', 'coffee_to_next_free', 'total_spent_rubles',
-            'rank', 'cashback_percent', 'next_rank', 'progress_to_next_percent',
-            'rank_color', 'rank_icon', 'notifications', 'redeem_token'
-        ]
-
-    def get_free_coffee_count(self, obj):
-        return obj.get_free_coffee_count()
+class RankFieldsMixin:
+    """Поля ранга клиента: всё считается по таблице рангов в памяти (core.ranks)."""
 
     def _rank_tuple(self, obj):
-        from .models import Rank
-        current, next_rank, progress = Rank.get_progress_percent(obj.total_spent)
-        return current, next_rank, progress
+        # Полей ранга семь, считаем один раз на объект
+        cached = getattr(self, '_rank_cache', None)
+        if cached is None or cached[0] is not obj:
+            if hasattr(obj, 'rank_progress'):
+                # Queryset размечен ranks.annotate_ranks(): ранги берутся по готовым id
+                table = ranks.get_table()
+                resolved = (table.by_id(obj.rank_id_sql), table.by_id(obj.next_rank_id_sql), obj.rank_progress)
+            else:
+                resolved = ranks.resolve(obj.total_spent)
+            cached = (obj, resolved)
+            self._rank_cache = cached
+        return cached[1]
 
     def get_rank(self, obj):
         current, _, _ = self._rank_tuple(obj)
         return current.name if current else None
 
     def get_cashback_percent(self, obj):
+        if hasattr(obj, 'rank_cashback'):
+            return obj.rank_cashback
         current, _, _ = self._rank_tuple(obj)
         return current.cashback_percent if current else 0
 
@@ -132,6 +121,34 @@ class ClientInfoSerializer(serializers.ModelSerializer):
             return current.icon.url
         return None
 
+
+class ClientInfoSerializer(RankFieldsMixin, serializers.ModelSerializer):
+    free_coffee_count = serializers.SerializerMethodField()
+    coffee_to_next_free = serializers.SerializerMethodField()
+    total_spent_rubles = serializers.SerializerMethodField()
+    rank = serializers.SerializerMethodField()
+    cashback_percent = serializers.SerializerMethodField()
+    next_rank = serializers.SerializerMethodField()
+    progress_to_next_percent = serializers.SerializerMethodField()
+    rank_color = serializers.SerializerMethodField()
+    rank_icon = serializers.SerializerMethodField()
+
+    notifications = serializers.SerializerMethodField()
+    redeem_token = serializers.SerializerMethodField()
+
+    class Meta:
+        model = User
+        fields = [
+            'id', 'phone', 'first_name', 'last_name', 'birth_date',
+            'points', 'coffee_count', 'total_spent',
+            'free_coffee_count', 'coffee_to_next_free', 'total_spent_rubles',
+            'rank', 'cashback_percent', 'next_rank', 'progress_to_next_percent',
+            'rank_color', 'rank_icon', 'notifications', 'redeem_token'
+        ]
+
+    def get_free_coffee_count(self, obj):
+        return obj.get_free_coffee_count()
+
     def get_notifications(self, obj):
         # Возвращаем активные (неистёкшие) уведомления для этого пользователя
         try:
@@ -140,10 +157,13 @@ class ClientInfoSerializer(serializers.ModelSerializer):
         except Exception:
             return []
         request = self.context.get('request') if hasattr(self, 'context') else None
+        # Карточка клиента (core.cards) передаёт уже загруженные уведомления
+        if 'notifications' in self.context:
+            return NotificationSerializer(self.context['notifications'], many=True, context={'request': request}).data
         if not request or not request.user.is_authenticated:
             return []
         from django.utils import timezone
-        qs = Notification.objects.filter(receipts__user=obj, expires_at__gt=timezone.now()).order_by('-created_at').distinct()
+        qs = Notification.objects.filter(receipts__user=obj, expires_at__gt=timezone.now()).order_by('-created_at')
         return NotificationSerializer(qs, many=True, context={'request': request}).data
 
     def get_coffee_to_next_free(self, obj):
@@ -153,6 +173,9 @@ class ClientInfoSerializer(serializers.ModelSerializer):
         return obj.get_total_spent_rubles()
 
     def get_redeem_token(self, obj):
+        if 'redeem_code' in self.context:
+            lc = self.context['redeem_code']
+            return lc.code if lc else None
         try:
             from loyalty.models import LoyaltyCode
             from django.utils import timezone
@@ -166,45 +189,8 @@ class ClientInfoSerializer(serializers.ModelSerializer):
         except Exception:
             return None
 
-    def _rank_tuple(self, obj):
-        from .models import Rank
-        current, next_rank, progress = Rank.get_progress_percent(obj.total_spent)
-        return current, next_rank, progress
-
-    def get_rank(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        return current.name if current else None
-
-    def get_cashback_percent(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        return current.cashback_percent if current else 0
 
-    def get_next_rank(self, obj):
-        _, next_rank, _ = self._rank_tuple(obj)
-        return next_rank.name if next_rank else None
-
-    def get_progress_to_next_percent(self, obj):
-        _, _, progress = self._rank_tuple(obj)
-        return progress
-
-    def get_rank_color(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        return getattr(current, 'color', None) if current else None
-
-    def get_rank_icon(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        if current and getattr(current, 'icon', None):
-            request = self.context.get('request') if hasattr(self, 'context') else None
-            if request:
-                try:
-                    return request.build_absolute_uri(current.icon.url)
-                except Exception:
-                    return None
-            return current.icon.url
-        return None
-
-
-class ClientListSerializer(serializers.ModelSerializer):
+class ClientListSerializer(RankFieldsMixin, serializers.ModelSerializer):
     total_spent_rubles = serializers.SerializerMethodField()
     free_coffee_count = serializers.SerializerMethodField()
     registration_date = serializers.DateTimeField(source='date_joined', read_only=True, format='%Y-%m-%d')
@@ -225,49 +211,12 @@ class ClientListSerializer(serializers.ModelSerializer):
             'rank_color', 'rank_icon'
         ]
 
-    def _rank_tuple(self, obj):
-        from .models import Rank
-        current, next_rank, progress = Rank.get_progress_percent(obj.total_spent)
-        return current, next_rank, progress
-
-    def get_rank(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        return current.name if current else None
-
-    def get_cashback_percent(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        return current.cashback_percent if current else 0
-
-    def get_next_rank(self, obj):
-        _, next_rank, _ = self._rank_tuple(obj)
-        return next_rank.name if next_rank else None
-
-    def get_progress_to_next_percent(self, obj):
-        _, _, progress = self._rank_tuple(obj)
-        return progress
-
     def get_total_spent_rubles(self, obj):
         return obj.get_total_spent_rubles()
 
     def get_free_coffee_count(self, obj):
         return obj.get_free_coffee_count()
 
-    def get_rank_color(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        return getattr(current, 'color', None) if current else None
-
-    def get_rank_icon(self, obj):
-        current, _, _ = self._rank_tuple(obj)
-        if current and getattr(current, 'icon', None):
-            request = self.context.get('request') if hasattr(self, 'context') else None
-            if request:
-                try:
-                    return request.build_absolute_uri(current.icon.url)
-                except Exception:
-                    return None
-            return current.icon.url
-        return None
-
 
 class CoffeeShopSerializer(serializers.ModelSerializer):
     opening_hours = serializers.JSONField(required=False)
@@ -319,10 +268,15 @@ class WorkingHoursSerializer(serializers.Serializer):
 
 class RankSerializer(serializers.ModelSerializer):
     icon_url = serializers.SerializerMethodField()
+    icon_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Rank
-        fields = ['id', 'name', 'min_total_spent_som', 'cashback_percent', 'color', 'icon_url']
+        fields = ['id', 'name', 'min_total_spent_som', 'cashback_percent', 'color', 'icon_url', 'icon_srcset']
+
+    def get_icon_srcset(self, obj):
+        request = self.context.get('request') if hasattr(self, 'context') else None
+        return build_srcset(obj.icon_variants, obj.icon.storage, request)
 
     def get_icon_url(self, obj):
         if getattr(obj, 'icon', None):
@@ -1,9 +1,77 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
+from . import authentication, cards, images, ranks, search
+from .models import ContentVersion, CoffeeShop, Rank, User, UserRoleCount
+from .versioning import RANKS_VERSION_KEY, COFFEESHOPS_VERSION_KEY
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
-        Token.objects.get_or_create(user=instance) 
\ No newline at end of file
+        Token.objects.get_or_create(user=instance)
+
+
+@receiver([post_save, post_delete], sender=Rank)
+def bump_ranks_version(sender, **kwargs):
+    ContentVersion.bump(RANKS_VERSION_KEY)
+    ranks.invalidate()
+
+
+@receiver([post_save, post_delete], sender=CoffeeShop)
+def bump_coffeeshops_version(sender, **kwargs):
+    ContentVersion.bump(COFFEESHOPS_VERSION_KEY)
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def bump_coffeeshops_version_on_staff_change(sender, instance=None, **kwargs):
+    # Список заведений показывает число бариста и телефон ответственного
+    if instance is not None and instance.role in (User.ROLE_BARISTA, User.ROLE_SENIOR_BARISTA):
+        ContentVersion.bump(COFFEESHOPS_VERSION_KEY)
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_auth_user(sender, instance=None, **kwargs):
+    if instance is not None and instance.pk is not None:
+        authentication.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def count_user_roles(sender, instance=None, created=False, **kwargs):
+    loaded_role = getattr(instance, '_loaded_role', None)
+    if created:
+        UserRoleCount.adjust(instance.role, 1)
+    elif loaded_role is not None and loaded_role != instance.role:
+        UserRoleCount.adjust(loaded_role, -1)
+        UserRoleCount.adjust(instance.role, 1)
+    instance._loaded_role = instance.role
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def uncount_user_role(sender, instance=None, **kwargs):
+    UserRoleCount.adjust(instance.role, -1)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def index_user_for_search(sender, instance=None, **kwargs):
+    search.index_user(instance)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def remove_user_from_search(sender, instance=None, **kwargs):
+    search.remove_user(instance.pk)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def touch_client_card(sender, instance=None, created=False, **kwargs):
+    if not created:
+        cards.touch([instance.pk])
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_cached_auth_token(sender, instance=None, **kwargs):
+    if instance is not None:
+        authentication.invalidate_token(instance.key)
+
+
+images.register(Rank, 'icon', 'icon_variants')
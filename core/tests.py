@@ -1,3 +1,444 @@
+from django.core.cache import cache
 from django.test import TestCase
+from django.utils import timezone
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+from notifications.models import Notification
+from . import authentication, ranks
+from .balances import apply_balance_change, balance_for, snapshot_balances
+from .models import BalanceLedgerEntry, BalanceSnapshot, CoffeeShop, ContentVersion, Rank, User, UserRoleCount
+from .ranks import assign_ranks
+from .reconciliation import (
+    FIX_COUNTERS, FIX_LEDGER, find_mismatches, find_source_issues, ledger_started_at, reconcile_balances,
+)
+from .serializers import ClientInfoSerializer
+from .versioning import RANKS_VERSION_KEY
 
-# Create your tests here.
+
+class RanksConditionalGetTest(TestCase):
+    def setUp(self):
+        self.api_client = APIClient()
+        Rank.objects.create(name="Бронза", min_total_spent_som=0, cashback_percent=3)
+
+    def test_etag_changes_when_rank_saved(self):
+        url = reverse('ranks-list')
+        response = self.api_client.get(url)
+        etag = response['ETag']
+        self.assertEqual(self.api_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Rank.objects.create(name="Серебро", min_total_spent_som=5000, cashback_percent=5)
+        response = self.api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 2)
+
+
+class RankResolverTest(TestCase):
+    def setUp(self):
+        self.bronze = Rank.objects.create(name="Бронза", min_total_spent_som=0, cashback_percent=3)
+        self.silver = Rank.objects.create(name="Серебро", min_total_spent_som=5000, cashback_percent=5)
+        self.gold = Rank.objects.create(name="Золото", min_total_spent_som=20000, cashback_percent=7)
+        ranks.get_table()
+
+    def test_lookup_without_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(ranks.resolve(0), (self.bronze, self.silver, 1))
+            self.assertEqual(ranks.resolve(499999), (self.bronze, self.silver, 100))
+            self.assertEqual(ranks.resolve(1250000), (self.silver, self.gold, 50))
+            self.assertEqual(ranks.resolve(10 ** 9), (self.gold, None, 100))
+            self.assertEqual(Rank.get_current_for_total_spent(500000), self.silver)
+            self.assertEqual(Rank.get_next_after(None), self.bronze)
+
+    def test_client_info_reads_rank_table_once(self):
+        user = User.objects.create(phone="+70001112233", role=User.ROLE_CLIENT, total_spent=1250000)
+        with self.assertNumQueries(0):
+            data = {
+                field: getattr(ClientInfoSerializer(), f'get_{field}')(user)
+                for field in ('rank', 'cashback_percent', 'next_rank', 'progress_to_next_percent')
+            }
+        self.assertEqual(data, {
+            'rank': 'Серебро', 'cashback_percent': 5, 'next_rank': 'Золото', 'progress_to_next_percent': 50,
+        })
+
+    def test_change_from_other_worker_is_picked_up_by_version(self):
+        # Другой воркер: запись без сигналов этого процесса, только счётчик версии
+        Rank.objects.filter(pk=self.silver.pk).update(cashback_percent=6)
+        ContentVersion.bump(RANKS_VERSION_KEY)
+        self.assertEqual(ranks.current_rank(500000).cashback_percent, 5)
+        with self.settings(RANK_CACHE_CHECK_SECONDS=0):
+            # версия + ранги
+            with self.assertNumQueries(2):
+                self.assertEqual(ranks.current_rank(500000).cashback_percent, 6)
+            with self.assertNumQueries(1):
+                ranks.current_rank(500000)
+
+
+class CurrentRankTest(TestCase):
+    def setUp(self):
+        self.bronze = Rank.objects.create(name="Бронза", min_total_spent_som=0, cashback_percent=3)
+        self.silver = Rank.objects.create(name="Серебро", min_total_spent_som=5000, cashback_percent=5)
+        self.clients = [
+            User.objects.create(phone=f"+7000111220{i}", role=User.ROLE_CLIENT, total_spent=spent)
+            for i, spent in enumerate([0, 499999, 500000, 900000])
+        ]
+        self.manager = User.objects.create(phone="+70009990000", role=User.ROLE_MANAGER)
+
+    def test_rank_follows_total_spent_on_save(self):
+        client = self.clients[1]
+        self.assertEqual(client.current_rank, self.bronze)
+        client.total_spent += 1
+        client.save(update_fields=['total_spent'])
+        client.refresh_from_db()
+        self.assertEqual(client.current_rank, self.silver)
+
+    def test_recompute_after_threshold_change(self):
+        Rank.objects.filter(pk=self.silver.pk).update(min_total_spent_som=8000)
+        gold = Rank.objects.create(name="Золото", min_total_spent_som=9000, cashback_percent=7)
+        User.objects.filter(pk=self.clients[0].pk).update(total_spent=-100)
+        # ранги + UPDATE ниже первого порога + по UPDATE на каждую из трёх полос
+        with self.assertNumQueries(5):
+            changed = assign_ranks(User, Rank)
+        self.assertEqual(changed, 3)
+        ranks_by_client = dict(User.objects.filter(role=User.ROLE_CLIENT).values_list('id', 'current_rank'))
+        self.assertEqual(
+            [ranks_by_client[c.id] for c in self.clients],
+            [None, self.bronze.id, self.bronze.id, gold.id],
+        )
+
+    def test_recompute_only_selected_ranks(self):
+        Rank.objects.filter(pk=self.silver.pk).update(min_total_spent_som=8000)
+        gold = Rank.objects.create(name="Золото", min_total_spent_som=9000, cashback_percent=7)
+        self.assertEqual(assign_ranks(User, Rank, rank_ids=[gold.id]), 1)
+        self.assertEqual(User.objects.get(pk=self.clients[2].pk).current_rank_id, self.silver.id)
+        # Клиенты, у которых выбранный ранг стоит сейчас, тоже пересчитываются
+        self.assertEqual(assign_ranks(User, Rank, rank_ids=[self.silver.id]), 1)
+        ranks_by_client = dict(User.objects.filter(role=User.ROLE_CLIENT).values_list('id', 'current_rank'))
+        self.assertEqual(
+            [ranks_by_client[c.id] for c in self.clients],
+            [self.bronze.id, self.bronze.id, self.bronze.id, gold.id],
+        )
+
+    def test_client_list_filters_by_rank(self):
+        api_client = APIClient()
+        api_client.force_authenticate(self.manager)
+        response = api_client.get(reverse('client-list'), {'rank': self.silver.id})
+        self.assertEqual({c['id'] for c in response.data['results']}, {self.clients[2].id, self.clients[3].id})
+
+        # Порог поменялся, колонка current_rank ещё не пересчитана: фильтр совпадает с показанным рангом
+        Rank.objects.filter(pk=self.silver.pk).update(min_total_spent_som=8000)
+        ranks.invalidate()
+        response = api_client.get(reverse('client-list'), {'rank': self.silver.id})
+        self.assertEqual([c['id'] for c in response.data['results']], [self.clients[3].id])
+        self.assertEqual(response.data['results'][0]['rank'], 'Серебро')
+        response = api_client.get(reverse('client-list'), {'rank': self.bronze.id})
+        self.assertEqual({c['rank'] for c in response.data['results']}, {'Бронза'})
+
+
+class BalanceLedgerTest(TestCase):
+    def setUp(self):
+        self.client_user = User.objects.create(phone="+70001112299", role=User.ROLE_CLIENT, points=100)
+        self.other = User.objects.create(phone="+70001112298", role=User.ROLE_CLIENT)
+
+    def test_changes_are_journaled(self):
+        apply_balance_change(self.client_user.id, points=20, total_spent=5000, reference='order:1')
+        apply_balance_change(self.client_user.id, spend_points=500, coffee_count=-3)
+        self.client_user.add_points(7)
+        self.client_user.refresh_from_db()
+        self.assertEqual((self.client_user.points, self.client_user.coffee_count), (7, 0))
+        self.assertEqual(
+            list(self.client_user.balance_entries.order_by('id').values_list('reason', 'points')),
+            [('opening', 100), ('manual', 20), ('manual', -120), ('manual', 7)],
+        )
+        self.assertEqual(balance_for(self.client_user.id), {'points': 7, 'coffee_count': 0, 'total_spent': 5000})
+        entry = self.client_user.balance_entries.first()
+        entry.points = 0
+        with self.assertRaises(ValueError):
+            entry.save()
+
+    def test_snapshot_folds_tail(self):
+        apply_balance_change(self.client_user.id, points=5)
+        apply_balance_change(self.other.id, coffee_count=2)
+        self.assertEqual(snapshot_balances(min_entries=2), 1)
+        self.assertEqual(snapshot_balances(), 1)
+        self.assertEqual(snapshot_balances(), 0)
+        apply_balance_change(self.client_user.id, points=-5)
+        with self.assertNumQueries(2):
+            self.assertEqual(balance_for(self.client_user.id)['points'], 100)
+        self.assertEqual(BalanceSnapshot.objects.filter(user=self.client_user).get().points, 105)
+
+
+class ReconciliationTest(TestCase):
+    def setUp(self):
+        self.clients = [
+            User.objects.create(phone=f"+7000333440{i}", role=User.ROLE_CLIENT, points=10 * i) for i in range(4)
+        ]
+        apply_balance_change(self.clients[1].id, points=5, total_spent=1000)
+        snapshot_balances()
+        apply_balance_change(self.clients[1].id, coffee_count=2)
+        # Правка в обход журнала
+        User.objects.filter(pk__in=[self.clients[2].id, self.clients[3].id]).update(points=999)
+
+    def test_finds_mismatches_in_chunks(self):
+        with self.assertNumQueries(3):
+            checked, mismatches = find_mismatches(self.clients[0].id, self.clients[-1].id + 1)
+        self.assertEqual(checked, 4)
+        self.assertEqual([m.user_id for m in mismatches], [self.clients[2].id, self.clients[3].id])
+        self.assertEqual(mismatches[0].delta, {'points': 979, 'coffee_count': 0, 'total_spent': 0})
+        self.assertEqual(len(reconcile_balances(chunk_size=2).mismatches), 2)
+
+    def test_fix_ledger_and_counters(self):
+        self.assertEqual(reconcile_balances(fix=FIX_LEDGER).fixed, 2)
+        self.assertEqual(balance_for(self.clients[2].id)['points'], 999)
+
+        User.objects.filter(pk=self.clients[1].id).update(points=0, total_spent=0)
+        self.assertEqual(reconcile_balances(fix=FIX_COUNTERS).fixed, 1)
+        client = self.clients[1]
+        client.refresh_from_db()
+        self.assertEqual((client.points, client.coffee_count, client.total_spent), (15, 2, 1000))
+        self.assertEqual(reconcile_balances().mismatches, [])
+
+    def test_ledger_is_checked_against_source_rows(self):
+        from cart.models import Order
+        from loyalty.models import LoyaltyTransaction
+
+        user = self.clients[0]
+        shop = CoffeeShop.objects.create(name="Shop", address="Addr")
+        order = Order.objects.create(
+            user=user, coffee_shop=shop, status=Order.Status.CANCELLED, final_amount=10000,
+            planned_use_points=True, planned_points_to_spend=20, planned_earn_points=10,
+        )
+        reference = f'order:{order.id}'
+        apply_balance_change(user.id, points=10, total_spent=10000,
+                             reason=BalanceLedgerEntry.REASON_ORDER_ACCEPTED, reference=reference)
+        # Отмена вернула запланированные 20 баллов, хотя принятие ничего не списало
+        apply_balance_change(user.id, points=10, total_spent=-10000,
+                             reason=BalanceLedgerEntry.REASON_ORDER_CANCELLED, reference=reference)
+        trx = LoyaltyTransaction.objects.create(user=user, transaction_type='earning', amount=5000, points_earned=5)
+        apply_balance_change(user.id, points=1, reason=BalanceLedgerEntry.REASON_LOYALTY_TRANSACTION,
+                             reference='loyalty_transaction:999999')
+
+        since = ledger_started_at()
+        with self.assertNumQueries(4):
+            issues = find_source_issues(user.id, user.id + 1, since)
+        self.assertEqual([(i.reference, i.problem.split(',')[0]) for i in issues], [
+            (f'loyalty_transaction:{trx.id}', 'нет записи журнала'),
+            ('loyalty_transaction:999999', 'запись журнала без исходной операции'),
+            (reference, 'баллы по журналу +20'),
+            ('total_spent', 'счётчик 0'),
+        ])
+        # Исправления счётчиков их не трогают, а счётчики с журналом сходятся
+        self.assertEqual(find_mismatches(user.id, user.id + 1), (1, []))
+        self.assertEqual(len(reconcile_balances().source_issues), 5)
+
+
+class CachedTokenAuthenticationTest(TestCase):
+    def setUp(self):
+        authentication.clear()
+        self.user = User.objects.create(phone="+70005556601", role=User.ROLE_CLIENT)
+        self.key = Token.objects.get(user=self.user).key
+        self.backend = authentication.CachedTokenAuthentication()
+
+    def test_cached_until_user_changes(self):
+        with self.assertNumQueries(1):
+            self.backend.authenticate_credentials(self.key)
+        with self.assertNumQueries(0):
+            user, token = self.backend.authenticate_credentials(self.key)
+        self.assertEqual((user.pk, token.key), (self.user.pk, self.key))
+        user.first_name = 'Изменено в запросе'
+        self.assertNotEqual(self.backend.authenticate_credentials(self.key)[0].first_name, 'Изменено в запросе')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Анна'
+            self.user.save(update_fields=['first_name'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.authenticate_credentials(self.key)[0].first_name, 'Анна')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_balance_change(self.user.pk, points=5)
+        self.assertEqual(self.backend.authenticate_credentials(self.key)[0].points, 5)
+
+    def test_deleted_token_is_rejected(self):
+        self.backend.authenticate_credentials(self.key)
+        with self.captureOnCommitCallbacks(execute=True):
+            Token.objects.filter(key=self.key).delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.backend.authenticate_credentials(self.key)
+
+
+class ClientCardTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Rank.objects.create(name="Бронза", min_total_spent_som=0, cashback_percent=3)
+        ranks.get_table()
+        self.user = User.objects.create(phone="+70007778801", role=User.ROLE_CLIENT)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(self.user)
+        self.url = reverse('client-info')
+
+    def test_card_is_cached_and_revalidated(self):
+        # строка клиента + уведомления + код на бесплатный кофе
+        with self.assertNumQueries(3):
+            response = self.api_client.get(self.url)
+        self.assertEqual(response.data['rank'], 'Бронза')
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.api_client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        apply_balance_change(self.user.pk, points=40)
+        response = self.api_client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['points'], 40)
+
+        Notification.create_for_recipients(
+            'Привет', Notification.TYPE_GENERIC, [self.user], timezone.now() + timezone.timedelta(hours=1),
+        )
+        response = self.api_client.get(self.url)
+        self.assertEqual([n['text'] for n in response.data['notifications']], ['Привет'])
+
+    def test_card_links_follow_the_request_host(self):
+        Rank.objects.update(icon='ranks/bronze.png')
+        ranks.invalidate()
+        with self.settings(ALLOWED_HOSTS=['a.example', 'b.example']):
+            first = self.api_client.get(self.url, HTTP_HOST='a.example')
+            second = self.api_client.get(self.url, HTTP_HOST='b.example')
+            self.assertEqual(
+                self.api_client.get(self.url, HTTP_HOST='b.example', HTTP_IF_NONE_MATCH=first['ETag']).status_code,
+                200,
+            )
+        self.assertTrue(first.data['rank_icon'].startswith('http://a.example/'))
+        self.assertTrue(second.data['rank_icon'].startswith('http://b.example/'))
+
+
+class ClientSearchTest(TestCase):
+    def setUp(self):
+        ranks.invalidate()
+        self.manager = User.objects.create(phone="+70009990001", role=User.ROLE_MANAGER)
+        self.anna = self.client_with("+7 (999) 111-22-33", "Анна", "Петрова")
+        self.ivan = self.client_with("+79995554411", "Иван", "Сидоров")
+        self.petr = self.client_with("+79992223344", "Пётр", "Анисимов")
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(self.manager)
+
+    def client_with(self, phone, first_name, last_name):
+        return User.objects.create(phone=phone, role=User.ROLE_CLIENT, first_name=first_name, last_name=last_name)
+
+    def search(self, term):
+        response = self.api_client.get(reverse('client-list'), {'search': term})
+        return [c['id'] for c in response.data['results']]
+
+    def test_phone_prefix_and_suffix(self):
+        self.assertEqual(self.anna.phone_digits, '79991112233')
+        self.assertEqual(self.search('7999111'), [self.anna.id])
+        self.assertEqual(self.search('44-11'), [self.ivan.id])
+        # Фрагмент из середины номера находит триграммный индекс
+        self.assertEqual(self.search('555'), [self.ivan.id])
+
+    def test_names_are_indexed_and_ranked(self):
+        self.assertEqual(self.search('петров'), [self.anna.id])
+        self.assertEqual(set(self.search('анн')), {self.anna.id})
+        # Совпадение по концу номера выше совпадения из середины
+        self.assertEqual(self.search('2233'), [self.anna.id, self.petr.id])
+        # Слова короче трёх символов триграммам не по силам и не сужают выдачу
+        self.assertEqual(self.search('ан пет'), [self.anna.id])
+
+        self.ivan.last_name = 'Петровский'
+        self.ivan.save()
+        self.assertEqual(set(self.search('петров')), {self.anna.id, self.ivan.id})
+        self.petr.delete()
+        self.assertEqual(self.search('аниси'), [])
+
+
+class ClientListPaginationTest(TestCase):
+    def setUp(self):
+        ranks.invalidate()
+        self.manager = User.objects.create(phone="+70009990002", role=User.ROLE_MANAGER)
+        self.clients = [User.objects.create(phone=f"+7000444550{i}", role=User.ROLE_CLIENT) for i in range(5)]
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(self.manager)
+        self.url = reverse('client-list')
+
+    def test_cursor_pages_without_count(self):
+        seen = []
+        url, params = self.url, {'pagination': 'cursor', 'page_size': 2}
+        while url:
+            with self.assertNumQueries(1):
+                response = self.api_client.get(url, params)
+            self.assertNotIn('count', response.data)
+            seen += [c['id'] for c in response.data['results']]
+            url, params = response.data['next'], None
+        self.assertEqual(seen, [c.id for c in reversed(self.clients)])
+
+    def test_cursor_rejects_rank_ordering(self):
+        for params in ({'pagination': 'cursor', 'ordering': '-cashback'}, {'cursor': 'abc', 'ordering': 'rank'}):
+            response = self.api_client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+        response = self.api_client.get(self.url, {'pagination': 'cursor', 'ordering': 'name'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_cursor_rejects_search(self):
+        response = self.api_client.get(self.url, {'pagination': 'cursor', 'search': '7000'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.api_client.get(self.url, {'search': '7000'}).status_code, 200)
+
+    def test_role_counter_and_estimated_count(self):
+        self.assertEqual(UserRoleCount.estimate(User.ROLE_CLIENT), 5)
+        self.clients[0].role = User.ROLE_BARISTA
+        self.clients[0].save()
+        self.clients[1].delete()
+        self.assertEqual(UserRoleCount.estimate(User.ROLE_CLIENT), 3)
+        self.assertEqual(UserRoleCount.estimate(User.ROLE_BARISTA), 1)
+
+        UserRoleCount.objects.filter(role=User.ROLE_CLIENT).update(count=1000)
+        response = self.api_client.get(self.url, {'count': 'estimate'})
+        self.assertEqual((response.data['count'], response.data['count_estimated']), (1000, True))
+        response = self.api_client.get(self.url, {'count': 'estimate', 'pagination': 'cursor'})
+        self.assertEqual((response.data['count'], len(response.data['results'])), (1000, 3))
+        # С фильтрами оценки нет — точный COUNT(*)
+        response = self.api_client.get(self.url, {'count': 'estimate', 'min_coffee': '0'})
+        self.assertEqual(response.data['count'], 3)
+        self.assertNotIn('count_estimated', response.data)
+
+        self.assertEqual(UserRoleCount.recount()[User.ROLE_CLIENT], 3)
+
+
+class RankAnnotationTest(TestCase):
+    def setUp(self):
+        ranks.invalidate()
+        Rank.objects.create(name="Бронза", min_total_spent_som=1000, cashback_percent=3)
+        Rank.objects.create(name="Серебро", min_total_spent_som=5000, cashback_percent=5)
+        Rank.objects.create(name="Серебро+", min_total_spent_som=5000, cashback_percent=6)
+        Rank.objects.create(name="Золото", min_total_spent_som=20000, cashback_percent=7)
+        ranks.get_table()
+        self.manager = User.objects.create(phone="+70009990003", role=User.ROLE_MANAGER)
+        self.clients = [
+            User.objects.create(phone=f"+7000666770{i}", role=User.ROLE_CLIENT, total_spent=spent)
+            for i, spent in enumerate([0, 50050, 99999, 100000, 499999, 500000, 1250050, 2000000, 9000000])
+        ]
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(self.manager)
+
+    def test_sql_matches_rank_table(self):
+        table = ranks.get_table()
+        for user in ranks.annotate_ranks(User.objects.filter(role=User.ROLE_CLIENT)):
+            current, next_rank, progress = table.progress(user.total_spent)
+            self.assertEqual(
+                (user.rank_id_sql, user.next_rank_id_sql, user.rank_progress, user.rank_cashback),
+                (getattr(current, 'id', None), getattr(next_rank, 'id', None), progress,
+                 current.cashback_percent if current else 0),
+                user.total_spent,
+            )
+
+    def test_list_sorts_and_filters_by_rank(self):
+        url = reverse('client-list')
+        # страница клиентов + COUNT(*)
+        with self.assertNumQueries(2):
+            response = self.api_client.get(url, {'ordering': '-cashback', 'page_size': 100})
+        self.assertEqual([c['cashback_percent'] for c in response.data['results']], [7, 7, 6, 6, 3, 3, 0, 0, 0])
+        self.assertEqual(response.data['results'][0]['rank'], 'Золото')
+
+        response = self.api_client.get(url, {'ordering': 'progress', 'min_progress': '50'})
+        progress = [c['progress_to_next_percent'] for c in response.data['results']]
+        self.assertEqual(progress, sorted(progress))
+        self.assertTrue(all(p >= 50 for p in progress))
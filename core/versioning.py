@@ -0,0 +1,43 @@
+"""Условные GET-запросы (ETag / Last-Modified) по счётчикам ContentVersion.
+
+Версия берётся из дешёвого счётчика, который увеличивают сигналы при записи
+в модели, а не из хэша готового ответа: при совпадении If-None-Match вьюха
+отвечает 304, не трогая сериализаторы.
+"""
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from .models import ContentVersion
+
+RANKS_VERSION_KEY = 'ranks'
+COFFEESHOPS_VERSION_KEY = 'coffeeshops'
+
+
+def version_token(version, updated_at):
+    """Строковое представление версии: номер + время изменения в микросекундах."""
+    return f"{version}.{int(updated_at.timestamp() * 1000000) if updated_at else 0}"
+
+
+def get_content_versions(request, keys):
+    """Возвращает {key: (version, updated_at)}, читая каждый ключ не более раза за запрос."""
+    versions = getattr(request, '_content_versions', None)
+    if versions is None:
+        versions = {}
+        request._content_versions = versions
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        versions.update(ContentVersion.get_many(missing))
+    return {key: versions[key] for key in keys}
+
+
+def versioned(*keys):
+    """Декоратор метода get: сильный ETag и Last-Modified по версиям ключей, 304 на If-None-Match."""
+    def etag_func(request, *args, **kwargs):
+        versions = get_content_versions(request, keys)
+        return '-'.join(f"{key}.{version_token(*versions[key])}" for key in keys)
+
+    def last_modified_func(request, *args, **kwargs):
+        versions = get_content_versions(request, keys)
+        stamps = [updated_at for _, updated_at in versions.values() if updated_at]
+        return max(stamps) if stamps else None
+
+    return method_decorator(condition(etag_func=etag_func, last_modified_func=last_modified_func))
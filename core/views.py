@@ -1,21 +1,28 @@
 from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework import status, permissions, authentication, generics
-from rest_framework.pagination import PageNumberPagination
+from rest_framework import status, permissions, generics
+from django.core.paginator import Paginator as DjangoPaginator
+from django.db.models import F
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from django.contrib.auth import authenticate
 from django.contrib.auth import get_user_model
 from rest_framework.authtoken.models import Token
-from .models import CoffeeShop, User
+from .authentication import CachedTokenAuthentication
+from .cards import get_card
+from .ranks import annotate_ranks
+from .search import search_clients
+from .models import CoffeeShop, User, UserRoleCount
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from .serializers import (
-    ClientPhoneCheckSerializer, ClientRegistrationSerializer, ClientInfoSerializer,
+    ClientPhoneCheckSerializer, ClientRegistrationSerializer,
     CoffeeShopSerializer, WorkingHoursSerializer, ClientListSerializer,
     BaristaLoginSerializer, BaristaInfoSerializer, RankSerializer
 )
-from django.db import models
+from .versioning import versioned, RANKS_VERSION_KEY, COFFEESHOPS_VERSION_KEY
 
 UserModel = get_user_model()
 
@@ -24,6 +31,51 @@ class StandardResultsSetPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 100
 
+
+def _estimated_count(request, view):
+    """Приблизительный total вместо COUNT(*) при ?count=estimate, если вьюха его умеет."""
+    if request.query_params.get('count') != 'estimate' or not hasattr(view, 'estimated_count'):
+        return None
+    return view.estimated_count()
+
+
+class ClientPagination(StandardResultsSetPagination):
+    """Постраничная пагинация списка клиентов; при ?count=estimate total берётся из счётчика."""
+
+    def paginate_queryset(self, queryset, request, view=None):
+        estimate = _estimated_count(request, view)
+        if estimate is not None:
+            # Атрибут класса заменяет cached_property count: COUNT(*) не выполняется
+            self.django_paginator_class = type('EstimatedPaginator', (DjangoPaginator,), {'count': estimate})
+        self.count_estimated = estimate is not None
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count_estimated:
+            response.data['count_estimated'] = True
+        return response
+
+
+class ClientCursorPagination(CursorPagination):
+    """Keyset-пагинация клиентов по (date_joined, id): глубина страницы не влияет на
+    скорость, COUNT(*) не выполняется. Включается ?pagination=cursor или ?cursor=."""
+    ordering = ('-date_joined', '-id')
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.estimate = _estimated_count(request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.estimate is not None:
+            response.data['count'] = self.estimate
+            response.data['count_estimated'] = True
+        return response
+
 @method_decorator(csrf_exempt, name='dispatch')
 class ManagerLoginView(APIView):
     permission_classes = []
@@ -83,7 +135,7 @@ class BaristaInfoView(APIView):
     Получение информации о бариста
     """
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     
     def get(self, request):
         user = request.user
@@ -104,7 +156,7 @@ class IsManager(permissions.BasePermission):
 
 class BaristaRegisterView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
         phone = request.data.get('phone')
@@ -136,7 +188,7 @@ class BaristaRegisterView(APIView):
 
 class CoffeeShopRegisterView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
         serializer = CoffeeShopSerializer(data=request.data)
@@ -150,8 +202,9 @@ class CoffeeShopRegisterView(APIView):
 
 class CoffeeShopListView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
+    @versioned(COFFEESHOPS_VERSION_KEY)
     def get(self, request):
         shops = CoffeeShop.objects.all()
         serializer = CoffeeShopSerializer(shops, many=True)
@@ -159,7 +212,7 @@ class CoffeeShopListView(APIView):
 
 class BaristaListView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def get(self, request):
         baristas = User.objects.filter(role__in=[User.ROLE_BARISTA, User.ROLE_SENIOR_BARISTA])
@@ -182,21 +235,55 @@ class ClientListView(generics.ListAPIView):
     Получение списка всех клиентов с пагинацией
     """
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = ClientListSerializer
-    pagination_class = StandardResultsSetPagination
-    
+    pagination_class = ClientPagination
+    filter_params = ('search', 'min_spent', 'min_coffee', 'rank', 'min_progress')
+    # ?ordering=: сортировка по аннотациям ranks.annotate_ranks()
+    rank_orderings = {
+        'rank': ('rank_min_som', 'rank_id_sql'),
+        'cashback': ('rank_cashback',),
+        'progress': ('rank_progress',),
+    }
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            cursor_mode = params.get('pagination') == 'cursor' or ClientCursorPagination.cursor_query_param in params
+            self._paginator = ClientCursorPagination() if cursor_mode else self.pagination_class()
+        return self._paginator
+
+    def list(self, request, *args, **kwargs):
+        # Курсор держит порядок (date_joined, id): сортировку по рангу и релевантность
+        # поиска он бы молча отбросил
+        if isinstance(self.paginator, ClientCursorPagination):
+            params = request.query_params
+            if params.get('ordering', '').lstrip('-') in self.rank_orderings:
+                return Response(
+                    {'error': 'ordering по рангу несовместим с pagination=cursor'},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if params.get('search'):
+                return Response(
+                    {'error': 'search несовместим с pagination=cursor: выдача упорядочена по релевантности'},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+        return super().list(request, *args, **kwargs)
+
+    def estimated_count(self):
+        """Число клиентов из счётчика UserRoleCount; с фильтрами оценки нет."""
+        if any(self.request.query_params.get(name) for name in self.filter_params):
+            return None
+        return UserRoleCount.estimate(User.ROLE_CLIENT)
+
     def get_queryset(self):
         queryset = User.objects.filter(role=User.ROLE_CLIENT).order_by('-date_joined')
         
-        # Фильтрация по имени, фамилии или телефону
+        # Поиск по имени, фамилии или телефону с ранжированием (core.search)
         search = self.request.query_params.get('search', None)
         if search:
-            queryset = queryset.filter(
-                models.Q(first_name__icontains=search) | 
-                models.Q(last_name__icontains=search) | 
-                models.Q(phone__icontains=search)
-            )
+            queryset = search_clients(queryset, search)
         
         # Фильтрация по минимальной сумме трат
         min_spent = self.request.query_params.get('min_spent', None)
@@ -207,7 +294,32 @@ class ClientListView(generics.ListAPIView):
         min_coffee = self.request.query_params.get('min_coffee', None)
         if min_coffee and min_coffee.isdigit():
             queryset = queryset.filter(coffee_count__gte=int(min_coffee))
-            
+
+        # Ранг, кэшбек и прогресс считаются в SQL одним запросом на страницу
+        queryset = annotate_ranks(queryset)
+
+        # Фильтрация по рангу (id ранга или none — без ранга). По той же аннотации, что
+        # показывается и сортируется, а не по User.current_rank: колонка отстаёт от
+        # порогов до recompute_ranks
+        rank = self.request.query_params.get('rank', None)
+        if rank == 'none':
+            queryset = queryset.filter(rank_id_sql__isnull=True)
+        elif rank and rank.isdigit():
+            queryset = queryset.filter(rank_id_sql=int(rank))
+
+        min_progress = self.request.query_params.get('min_progress', None)
+        if min_progress and min_progress.isdigit():
+            queryset = queryset.filter(rank_progress__gte=int(min_progress))
+
+        ordering = self.request.query_params.get('ordering', '')
+        fields = self.rank_orderings.get(ordering.lstrip('-'))
+        if fields:
+            if ordering.startswith('-'):
+                fields = tuple(F(name).desc(nulls_last=True) for name in fields)
+            else:
+                fields = tuple(F(name).asc(nulls_first=True) for name in fields)
+            queryset = queryset.order_by(*fields, '-date_joined', '-id')
+
         return queryset
 
     def get_serializer_context(self):
@@ -217,7 +329,7 @@ class ClientListView(generics.ListAPIView):
 
 class AssignBaristaView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
         barista_id = request.data.get('barista_id')
@@ -242,7 +354,7 @@ class AssignBaristaView(APIView):
 
 class EditBaristaView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
         barista_id = request.data.get('barista_id')
@@ -274,7 +386,7 @@ class EditBaristaView(APIView):
 
 class EditCoffeeShopView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
         coffee_shop_id = request.data.get('coffee_shop_id')
@@ -293,7 +405,7 @@ class EditCoffeeShopView(APIView):
 
 class CoffeeShopWorkingHoursView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
         coffee_shop_id = request.data.get('coffee_shop_id')
@@ -453,13 +565,22 @@ class ClientRegistrationView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _client_card_etag(request, *args, **kwargs):
+    # Карточка читается по свежей строке клиента, а не по request.user из кэша аутентификации
+    if request.user.role != User.ROLE_CLIENT:
+        return None
+    request._client_card = get_card(request.user.pk, request)
+    return request._client_card.etag if request._client_card else None
+
+
 class ClientInfoView(APIView):
     """
     Получение информации о клиенте
     """
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
+    @method_decorator(condition(etag_func=_client_card_etag))
     def get(self, request):
         user = request.user
         
@@ -469,8 +590,9 @@ class ClientInfoView(APIView):
                 'error': 'Доступ только для клиентов'
             }, status=status.HTTP_403_FORBIDDEN)
 
-        serializer = ClientInfoSerializer(user, context={'request': request})
-        return Response(serializer.data)
+        # Карточка уже получена при расчёте ETag
+        card = getattr(request, '_client_card', None) or get_card(user.pk, request)
+        return Response(card.data)
 
     def patch(self, request):
         """Частичное обновление данных клиента: phone, first_name, last_name"""
@@ -493,8 +615,9 @@ class ClientInfoView(APIView):
         if last_name is not None:
             user.last_name = last_name
 
-        user.save()
-        return Response(ClientInfoSerializer(user).data)
+        # Только изменённые поля: request.user из кэша аутентификации может хранить устаревший баланс
+        user.save(update_fields=['phone', 'first_name', 'last_name'])
+        return Response(get_card(user.pk, request).data)
 
     def put(self, request):
         """Полное обновление (эквивалентно patch для перечисленных полей)"""
@@ -504,8 +627,9 @@ class ClientInfoView(APIView):
 class RanksListView(APIView):
     """Публичный список рангов и их условий."""
     permission_classes = [AllowAny]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
+    @versioned(RANKS_VERSION_KEY)
     def get(self, request):
         from .models import Rank
         ranks = Rank.objects.all().order_by('min_total_spent_som')
@@ -1,8 +1,9 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework import status, authentication
+from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 
+from core.authentication import CachedTokenAuthentication
 from core.models import User
 from .serializers import FeedbackCreateSerializer, FeedbackListSerializer
 from .models import Feedback
@@ -10,7 +11,7 @@ from .models import Feedback
 
 class FeedbackCreateView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
         # Только клиенты могут оставлять отзывы
@@ -25,7 +26,7 @@ class FeedbackCreateView(APIView):
 
 class FeedbackListView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def get(self, request):
         # Только управляющий видит список отзывов
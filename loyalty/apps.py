@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class LoyaltyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'loyalty'
+
+    def ready(self):
+        # Регистрация системных проверок (LOYALTY_CODE_SECRET)
+        import loyalty.checks  # noqa: F401
+        # Встроенный планировщик очистки кодов; по умолчанию выключен (см. purge_loyalty_codes)
+        interval = getattr(settings, 'LOYALTY_CODE_PURGE_INTERVAL_SECONDS', None)
+        if interval:
+            from .maintenance import start_scheduler
+            start_scheduler(interval)
@@ -0,0 +1,15 @@
+"""Системные проверки приложения loyalty (manage.py check)."""
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+@register()
+def check_code_secret(app_configs, **kwargs):
+    """Без LOYALTY_CODE_SECRET коды не выдаются: ловим это при старте, а не на первом запросе."""
+    if getattr(settings, 'LOYALTY_CODE_SECRET', ''):
+        return []
+    return [Error(
+        'LOYALTY_CODE_SECRET не задан: коды лояльности не выдаются',
+        hint='Задайте переменную окружения LOYALTY_CODE_SECRET (длинная случайная строка).',
+        id='loyalty.E001',
+    )]
@@ -0,0 +1,67 @@
+"""Выдача кодов лояльности без перебора.
+
+Код — образ порядкового номера из счётчика LoyaltyCodeSequence при
+перестановке всего пространства кодов (6 цифр — 10^6, 8 цифр — 10^8).
+Перестановка — сбалансированная сеть Фейстеля по основанию 10^3 / 10^4
+с ключом LOYALTY_CODE_SECRET. Номера идут подряд, поэтому коды непредсказуемы
+только пока ключ секретен: он задаётся переменной окружения отдельно от
+SECRET_KEY (тот лежит в репозитории), и без него коды не выдаются. Один и
+тот же код повторяется только через полный круг счётчика. К этому времени
+прежний владелец кода давно истёк или использован, поэтому уникальность
+требуется только среди активных кодов (условный UniqueConstraint).
+
+Выдача кода — два запроса к счётчику плюс вставка, независимо от размера
+истории. Если на коде всё ещё висит активный неистёкший владелец (круг
+пройден быстрее срока жизни кода), берётся следующий номер, но не более
+MAX_ATTEMPTS раз.
+"""
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+
+KIND_REGULAR = 'regular'
+KIND_REDEEM = 'redeem'
+
+# Длина кода и половина разрядов для сети Фейстеля
+CODE_DIGITS = {KIND_REGULAR: 6, KIND_REDEEM: 8}
+FEISTEL_ROUNDS = 4
+MAX_ATTEMPTS = 5
+
+
+def _secret():
+    secret = getattr(settings, 'LOYALTY_CODE_SECRET', '')
+    if not secret:
+        raise ImproperlyConfigured('LOYALTY_CODE_SECRET не задан: без него коды лояльности предсказуемы')
+    return secret.encode()
+
+
+def _round_function(kind, round_index, value, modulus):
+    message = f'{kind}:{round_index}:{value}'.encode()
+    digest = hmac.new(_secret(), message, hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big') % modulus
+
+
+def permute(kind, number):
+    """Биекция [0, 10^digits) → [0, 10^digits) для вида кода kind."""
+    half = 10 ** (CODE_DIGITS[kind] // 2)
+    left, right = divmod(number % (half * half), half)
+    for round_index in range(FEISTEL_ROUNDS):
+        left, right = right, (left + _round_function(kind, round_index, right, half)) % half
+    return left * half + right
+
+
+def format_code(kind, number):
+    return str(permute(kind, number)).zfill(CODE_DIGITS[kind])
+
+
+def next_number(kind):
+    """Следующий номер счётчика. Вызывать внутри транзакции: UPDATE блокирует строку до конца."""
+    from .models import LoyaltyCodeSequence
+
+    if not LoyaltyCodeSequence.objects.filter(kind=kind).update(next_value=F('next_value') + 1):
+        LoyaltyCodeSequence.objects.get_or_create(kind=kind)
+        LoyaltyCodeSequence.objects.filter(kind=kind).update(next_value=F('next_value') + 1)
+    return LoyaltyCodeSequence.objects.values_list('next_value', flat=True).get(kind=kind) - 1
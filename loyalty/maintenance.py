@@ -0,0 +1,95 @@
+"""Очистка отработавших кодов лояльности.
+
+Коды живут 15 минут (бесплатный кофе — 7 дней), а каждое открытие
+приложения выпускает новый, поэтому таблица растёт без ограничений. Здесь
+удаляются истёкшие и деактивированные коды старше LOYALTY_CODE_RETENTION_HOURS
+(недавние оставляем, чтобы клиент успел получить статус used/expired).
+
+Удаление идёт пачками по первичному ключу, каждая пачка — своя короткая
+транзакция: на SQLite блокировка записи не держится дольше одной пачки и
+запросы приложения успевают пройти между ними.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import LoyaltyCode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+@dataclass
+class PurgeResult:
+    deleted: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+
+def stale_codes(now=None):
+    now = now or timezone.now()
+    cutoff = now - timezone.timedelta(hours=getattr(settings, 'LOYALTY_CODE_RETENTION_HOURS', 24))
+    return LoyaltyCode.objects.filter(Q(expires_at__lt=cutoff) | Q(is_active=False, created_at__lt=cutoff))
+
+
+def purge_stale_codes(batch_size=DEFAULT_BATCH_SIZE, pause=0.0, max_batches=None, dry_run=False):
+    """Удаляет отработавшие коды пачками по batch_size; pause — пауза между пачками, секунд."""
+    started = time.monotonic()
+    result = PurgeResult()
+    queryset = stale_codes()
+    if dry_run:
+        result.deleted = queryset.count()
+    else:
+        last_id = 0
+        while max_batches is None or result.batches < max_batches:
+            ids = list(
+                queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                deleted, _ = LoyaltyCode.objects.filter(id__in=ids).delete()
+            result.deleted += deleted
+            result.batches += 1
+            last_id = ids[-1]
+            if pause and len(ids) == batch_size:
+                time.sleep(pause)
+    result.seconds = time.monotonic() - started
+    return result
+
+
+_scheduler = None
+
+
+def start_scheduler(interval):
+    """Фоновый поток, запускающий очистку раз в interval секунд (один на процесс)."""
+    global _scheduler
+    if _scheduler is not None:
+        return _scheduler
+
+    def run():
+        while True:
+            time.sleep(interval)
+            close_old_connections()
+            try:
+                result = purge_stale_codes(pause=0.05)
+                if result.deleted:
+                    logger.info(
+                        'Удалено кодов лояльности: %s за %.2f с (%s пачек)',
+                        result.deleted, result.seconds, result.batches,
+                    )
+            except Exception:
+                logger.exception('Очистка кодов лояльности не удалась')
+            finally:
+                close_old_connections()
+
+    _scheduler = threading.Thread(target=run, name='loyalty-code-purge', daemon=True)
+    _scheduler.start()
+    return _scheduler
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from loyalty.maintenance import DEFAULT_BATCH_SIZE, purge_stale_codes
+
+
+class Command(BaseCommand):
+    help = 'Удаляет истёкшие и использованные коды лояльности пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Строк в одной пачке')
+        parser.add_argument('--pause', type=float, default=0.05, help='Пауза между пачками, секунд')
+        parser.add_argument('--max-batches', type=int, default=None, help='Остановиться после N пачек')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, ничего не удалять')
+
+    def handle(self, *args, **options):
+        result = purge_stale_codes(
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            max_batches=options['max_batches'],
+            dry_run=options['dry_run'],
+        )
+        verb = 'К удалению' if options['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} кодов: {result.deleted}, пачек: {result.batches}, время: {result.seconds:.2f} с"
+        ))
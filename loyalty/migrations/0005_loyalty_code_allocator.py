@@ -0,0 +1,34 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loyalty', '0004_alter_loyaltycode_code_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoyaltyCodeSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16, unique=True, verbose_name='Вид кода')),
+                ('next_value', models.BigIntegerField(default=0, verbose_name='Следующий номер')),
+            ],
+            options={
+                'verbose_name': 'Счётчик кодов лояльности',
+                'verbose_name_plural': 'Счётчики кодов лояльности',
+            },
+        ),
+        migrations.AlterField(
+            model_name='loyaltycode',
+            name='code',
+            field=models.CharField(db_index=True, max_length=8, verbose_name='Код лояльности'),
+        ),
+        migrations.AddConstraint(
+            model_name='loyaltycode',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('code',), name='loyalty_code_active_unique'),
+        ),
+    ]
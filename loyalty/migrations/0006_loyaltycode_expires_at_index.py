@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loyalty', '0005_loyalty_code_allocator'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='loyaltycode',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, verbose_name='Время истечения'),
+        ),
+    ]
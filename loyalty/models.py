@@ -1,11 +1,19 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
+from core import cards
 from core.models import User
-import random
-import string
+from core.events import publish_on_commit
+from . import codes
 
 # Create your models here.
 
+EVENT_CODE_DEACTIVATED = 'code.deactivated'
+
+
+def code_topic(user_id):
+    """Топик событий по кодам клиента: ожидающий статус кода просыпается по нему."""
+    return f'loyalty-codes:user:{user_id}'
+
 class LoyaltyCode(models.Model):
     """Модель для хранения временных кодов лояльности пользователей"""
     
@@ -17,7 +25,7 @@ class LoyaltyCode(models.Model):
     )
     code = models.CharField(
         max_length=8,
-        unique=True,
+        db_index=True,
         verbose_name="Код лояльности"
     )
     created_at = models.DateTimeField(
@@ -25,6 +33,7 @@ class LoyaltyCode(models.Model):
         verbose_name="Время создания"
     )
     expires_at = models.DateTimeField(
+        db_index=True,
         verbose_name="Время истечения"
     )
     is_active = models.BooleanField(
@@ -40,6 +49,12 @@ class LoyaltyCode(models.Model):
         verbose_name = "Код лояльности"
         verbose_name_plural = "Коды лояльности"
         ordering = ['-created_at']
+        constraints = [
+            # Код переиспользуется после истечения/использования, уникален только среди активных
+            models.UniqueConstraint(
+                fields=['code'], condition=models.Q(is_active=True), name='loyalty_code_active_unique'
+            ),
+        ]
     
     def __str__(self):
         return f"Код {self.code} для {self.user.phone}"
@@ -52,43 +67,68 @@ class LoyaltyCode(models.Model):
         """Деактивирует код"""
         self.is_active = False
         self.save()
+        if self.is_free_coffee_redemption:
+            cards.touch([self.user_id])
+        publish_on_commit(code_topic(self.user_id), EVENT_CODE_DEACTIVATED, {'code': self.code})
     
-    @classmethod
-    def generate_regular_code(cls):
-        """6-значный код для обычных операций"""
-        return ''.join(random.choices(string.digits, k=6))
+    def claim(self):
+        """Атомарно гасит код, если он ещё активен и не истёк: UPDATE ... WHERE is_active.
+
+        Возвращает True, только если код погасил именно этот вызов; из двух
+        параллельных сканирований одного кода успех получит одно.
+        """
+        claimed = type(self).objects.filter(
+            pk=self.pk, is_active=True, expires_at__gt=timezone.now()
+        ).update(is_active=False)
+        if not claimed:
+            return False
+        self.is_active = False
+        if self.is_free_coffee_redemption:
+            cards.touch([self.user_id])
+        publish_on_commit(code_topic(self.user_id), EVENT_CODE_DEACTIVATED, {'code': self.code})
+        return True
 
-    @classmethod
-    def generate_redeem_code(cls):
-        """8-значный код для бесплатного кофе"""
-        return ''.join(random.choices(string.digits, k=8))
-    
     @classmethod
     def create_for_user(cls, user, expiration_minutes=15, is_free_coffee=False):
-        """Создает новый код. Деактивирует только активные коды того же типа."""
-        # Деактивируем только коды того же типа
-        cls.objects.filter(
-            user=user,
-            is_active=True,
-            is_free_coffee_redemption=is_free_coffee
-        ).update(is_active=False)
+        """Создает новый код. Деактивирует только активные коды того же типа.
 
-        # Генерируем новый уникальный код соответствующей длины
-        while True:
-            code = (
-                cls.generate_redeem_code() if is_free_coffee else cls.generate_regular_code()
-            )
-            if not cls.objects.filter(code=code, is_active=True).exists():
-                break
-
-        # Создаем новый код с указанным сроком действия
-        expires_at = timezone.now() + timezone.timedelta(minutes=expiration_minutes)
-        return cls.objects.create(
-            user=user,
-            code=code,
-            expires_at=expires_at,
-            is_free_coffee_redemption=is_free_coffee
-        )
+        Код выдаётся аллокатором loyalty.codes за ограниченное число запросов.
+        """
+        kind = codes.KIND_REDEEM if is_free_coffee else codes.KIND_REGULAR
+        now = timezone.now()
+        expires_at = now + timezone.timedelta(minutes=expiration_minutes)
+
+        with transaction.atomic():
+            # Деактивируем только коды того же типа
+            replaced = cls.objects.filter(
+                user=user,
+                is_active=True,
+                is_free_coffee_redemption=is_free_coffee
+            ).update(is_active=False)
+            if replaced:
+                # Какие именно коды заменены, не важно: ожидающий перечитает свой
+                publish_on_commit(code_topic(user.id), EVENT_CODE_DEACTIVATED, {'code': None})
+
+            for _ in range(codes.MAX_ATTEMPTS):
+                code = codes.format_code(kind, codes.next_number(kind))
+                # Прежний владелец кода, если он ещё числится активным, уже истёк
+                cls.objects.filter(code=code, is_active=True, expires_at__lte=now).update(is_active=False)
+                try:
+                    with transaction.atomic():
+                        loyalty_code = cls.objects.create(
+                            user=user,
+                            code=code,
+                            expires_at=expires_at,
+                            is_free_coffee_redemption=is_free_coffee
+                        )
+                except IntegrityError:
+                    # Код ещё действует у другого клиента — берём следующий номер
+                    continue
+                if is_free_coffee:
+                    # Код на бесплатный кофе показывается в карточке клиента
+                    cards.touch([user.id])
+                return loyalty_code
+        raise RuntimeError("Не удалось выдать код лояльности: все попытки заняты активными кодами")
 
     @classmethod
     def create_free_for_user(cls, user, expiration_minutes=60*24*7):
@@ -156,3 +196,17 @@ class LoyaltyTransaction(models.Model):
     
     def __str__(self):
         return f"{self.get_transaction_type_display()} {self.points} баллов для {self.user.phone}"
+
+
+class LoyaltyCodeSequence(models.Model):
+    """Счётчик выданных кодов по виду (6-значные / 8-значные), см. loyalty.codes"""
+
+    kind = models.CharField(max_length=16, unique=True, verbose_name="Вид кода")
+    next_value = models.BigIntegerField(default=0, verbose_name="Следующий номер")
+
+    class Meta:
+        verbose_name = "Счётчик кодов лояльности"
+        verbose_name_plural = "Счётчики кодов лояльности"
+
+    def __str__(self):
+        return f"{self.kind}: {self.next_value}"
@@ -1,7 +1,9 @@
 from rest_framework import serializers
 from django.db import transaction
 from .models import LoyaltyCode, LoyaltyTransaction
-from core.models import User, Rank
+from core.balances import apply_balance_change
+from core.models import BalanceLedgerEntry, User
+from core.ranks import current_rank as resolve_current_rank
 from core.serializers import UserSerializer
 
 class LoyaltyCodeSerializer(serializers.ModelSerializer):
@@ -116,7 +118,6 @@ class LoyaltyTransactionCreateSerializer(serializers.Serializer):
     
     def create(self, validated_data):
         code_obj = validated_data.pop('code_obj')
-        user = code_obj.user
         amount = validated_data['amount']
         points_to_use = validated_data['points_to_use']
         coffee_quantity = validated_data.get('coffee_quantity', 0)
@@ -129,66 +130,72 @@ class LoyaltyTransactionCreateSerializer(serializers.Serializer):
             except Exception:
                 pass
             raise serializers.ValidationError({"error": "Бариста не привязан к кофейне"})
-        
-        # Рассчитываем сумму для начисления бонусов (после вычета использованных бонусов)
-        amount_for_points = max(0, amount - points_to_use)
-        # Определяем кэшбек по рангу пользователя
-        current_rank = Rank.get_current_for_total_spent(user.total_spent)
-        cashback_percent = current_rank.cashback_percent if current_rank else 0
-        points_earned = int(amount_for_points * (cashback_percent / 100.0))
-        
-        # Создаем транзакцию
-        try:
-            print(
-                f"[LoyaltyTransactionCreateSerializer.create] Creating transaction: user_id={user.id}, barista_id={barista.id}, shop_id={coffee_shop.id}, "
-                f"amount_som={amount}, points_to_use={points_to_use}, points_earned={points_earned}, coffee_qty={coffee_quantity}, cashback_percent={cashback_percent}"
-            )
-        except Exception:
-            pass
-        trx = LoyaltyTransaction.objects.create(
-            user=user,
-            barista=barista,
-            coffee_shop=coffee_shop,
-            transaction_type=LoyaltyTransaction.TYPE_EARNING,
-            amount=amount * 100,  # конвертируем в копейки
-            points_used=points_to_use,
-            points_earned=points_earned
-        )
-        
-        # Обновляем данные пользователя и выпускаем бесплатный токен при достижении 7
+
         with transaction.atomic():
-            user.points = user.points - points_to_use + points_earned
-            before = user.coffee_count or 0
-            after = before + (coffee_quantity or 0)
+            # Сначала гасим код: из параллельных сканирований одного кода дальше пройдёт одно
+            if not code_obj.claim():
+                raise serializers.ValidationError({"code": "Код уже использован или истёк"})
+
+            # Строка клиента блокируется до конца транзакции, баланс читаем уже под блокировкой
+            user = User.objects.select_for_update().get(pk=code_obj.user_id)
+            if points_to_use > user.points:
+                raise serializers.ValidationError({
+                    "points_to_use": f"Недостаточно бонусов. Доступно: {user.points}"
+                })
 
-            # Проверяем наличие активного бесплатного токена
-            has_active_free = LoyaltyCode.objects.filter(user=user, is_active=True, is_free_coffee_redemption=True).exists()
+            # Рассчитываем сумму для начисления бонусов (после вычета использованных бонусов)
+            amount_for_points = max(0, amount - points_to_use)
+            # Определяем кэшбек по рангу пользователя
+            current_rank = resolve_current_rank(user.total_spent)
+            cashback_percent = current_rank.cashback_percent if current_rank else 0
+            points_earned = int(amount_for_points * (cashback_percent / 100.0))
 
+            try:
+                print(
+                    f"[LoyaltyTransactionCreateSerializer.create] Creating transaction: user_id={user.id}, "
+                    f"barista_id={barista.id}, shop_id={coffee_shop.id}, amount_som={amount}, "
+                    f"points_to_use={points_to_use}, points_earned={points_earned}, coffee_qty={coffee_quantity}, "
+                    f"cashback_percent={cashback_percent}"
+                )
+            except Exception:
+                pass
+            trx = LoyaltyTransaction.objects.create(
+                user=user,
+                barista=barista,
+                coffee_shop=coffee_shop,
+                transaction_type=LoyaltyTransaction.TYPE_EARNING,
+                amount=amount * 100,  # конвертируем в копейки
+                points_used=points_to_use,
+                points_earned=points_earned
+            )
+
+            # Штампы и выпуск бесплатного токена при достижении 7
+            after = (user.coffee_count or 0) + (coffee_quantity or 0)
+            has_active_free = LoyaltyCode.objects.filter(
+                user=user, is_active=True, is_free_coffee_redemption=True,
+            ).exists()
             if has_active_free:
                 # Штампы не накапливаются выше 6, пока есть активный бесплатный токен
-                user.coffee_count = min(6, after)
+                coffee_count = min(6, after)
+            elif after >= 7:
+                # Выдали один бесплатный токен, стакать нельзя; кэп на 6 в случае очень большого заказа.
+                # Ошибка выпуска кода откатывает всю продажу: иначе клиент потерял бы 7 штампов без токена
+                LoyaltyCode.create_free_for_user(user)
+                coffee_count = min(max(0, after - 7), 6)
             else:
-                if after >= 7:
-                    # Выдали один бесплатный токен, стакать нельзя
-                    user.coffee_count = max(0, after - 7)
-                    # Кэп на 6 в случае очень большого заказа
-                    user.coffee_count = min(user.coffee_count, 6)
-                    try:
-                        LoyaltyCode.create_free_for_user(user)
-                    except Exception:
-                        # Даже если выпуск кода не удался, не падаем транзакцией продаж
-                        pass
-                else:
-                    user.coffee_count = after
+                coffee_count = after
 
-            user.total_spent += amount * 100  # в копейках
-            user.save()
-        
-        # Деактивируем код
-        try:
-            print(f"[LoyaltyTransactionCreateSerializer.create] Deactivating code: code={code_obj.code}")
-        except Exception:
-            pass
-        code_obj.deactivate()
-        
-        return trx
\ No newline at end of file
+            apply_balance_change(
+                user.id,
+                points=points_earned - points_to_use,
+                total_spent=amount * 100,  # в копейках
+                set_coffee_count=coffee_count,
+                reason=BalanceLedgerEntry.REASON_LOYALTY_TRANSACTION,
+                reference=f'loyalty_transaction:{trx.id}',
+                current=user,
+            )
+            # Баланс для ответа читается ещё под блокировкой: после фиксации строку
+            # может снова заблокировать параллельный запрос
+            user.refresh_from_db(fields=['points', 'coffee_count', 'total_spent', 'current_rank'])
+
+        return trx
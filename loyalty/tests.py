@@ -1,13 +1,28 @@
-from django.test import TestCase
+from django.db import connection
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
-from core.models import User, CoffeeShop
-from .models import LoyaltyCode, LoyaltyTransaction
+from core import ranks
+from core.models import BalanceLedgerEntry, User, CoffeeShop, Rank
+from django.core.management import call_command
+from io import StringIO
+from . import codes
+from .maintenance import purge_stale_codes
+from .models import LoyaltyCode, LoyaltyCodeSequence, LoyaltyTransaction
 from django.utils import timezone
+import threading
+import time
+from unittest import mock
 
 # Create your tests here.
 
+# Ключ перестановки кодов задаётся только окружением (loyalty.codes)
+with_code_secret = override_settings(LOYALTY_CODE_SECRET='test-loyalty-code-secret')
+
+
+@with_code_secret
 class LoyaltyTransactionTest(TestCase):
     def setUp(self):
         # Создаем кофейню
@@ -23,7 +38,8 @@ class LoyaltyTransactionTest(TestCase):
             first_name="Test",
             last_name="Client"
         )
-        self.client_token = Token.objects.create(user=self.client_user)
+        # Токен создаётся сигналом при создании пользователя
+        self.client_token = Token.objects.get(user=self.client_user)
         
         # Создаем баристу
         self.barista_user = User.objects.create(
@@ -35,7 +51,7 @@ class LoyaltyTransactionTest(TestCase):
         )
         self.barista_user.password = "testpassword"
         self.barista_user.save()
-        self.barista_token = Token.objects.create(user=self.barista_user)
+        self.barista_token = Token.objects.get(user=self.barista_user)
         
         # Создаем код лояльности для клиента
         self.loyalty_code = LoyaltyCode.create_for_user(self.client_user)
@@ -55,6 +71,7 @@ class LoyaltyTransactionTest(TestCase):
         data = {
             'code': self.loyalty_code.code,
             'amount': 100,  # 100 сом
+            'points_to_use': 0,
             'transaction_type': LoyaltyTransaction.TYPE_EARNING
         }
         
@@ -68,3 +85,222 @@ class LoyaltyTransactionTest(TestCase):
         # Проверяем, что в ответе есть поле amount_in_currency с правильной суммой в сомах
         self.assertEqual(response.data['transaction']['amount'], 10000)
         self.assertEqual(response.data['transaction']['amount_in_currency'], 100)
+
+    def test_unexpected_error_is_not_replayed(self):
+        self.api_client.force_authenticate(self.barista_user)
+        url = reverse('loyalty:create_transaction')
+        data = {'code': self.loyalty_code.code, 'amount': 100, 'points_to_use': 0}
+        with mock.patch('loyalty.serializers.apply_balance_change', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.api_client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='scan-1')
+        # Сбой не сохранён под ключом: повтор выполняется заново
+        response = self.api_client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='scan-1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(LoyaltyTransaction.objects.count(), 1)
+
+    def test_failed_free_code_rolls_back_the_sale(self):
+        User.objects.filter(pk=self.client_user.pk).update(coffee_count=6)
+        self.api_client.force_authenticate(self.barista_user)
+        data = {'code': self.loyalty_code.code, 'amount': 100, 'points_to_use': 0, 'coffee_quantity': 1}
+        failure = ImproperlyConfigured('LOYALTY_CODE_SECRET не задан')
+        with mock.patch('loyalty.serializers.LoyaltyCode.create_free_for_user', side_effect=failure):
+            with self.assertRaises(ImproperlyConfigured):
+                self.api_client.post(reverse('loyalty:create_transaction'), data, format='json')
+        self.client_user.refresh_from_db()
+        self.assertEqual(self.client_user.coffee_count, 6)
+        self.assertTrue(LoyaltyCode.objects.get(pk=self.loyalty_code.pk).is_active)
+        self.assertFalse(LoyaltyTransaction.objects.exists())
+
+
+@with_code_secret
+class LoyaltyCodeStatusWaitTest(TransactionTestCase):
+    def setUp(self):
+        self.client_user = User.objects.create(phone="+70001112233", role=User.ROLE_CLIENT)
+        self.loyalty_code = LoyaltyCode.create_for_user(self.client_user)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(self.client_user)
+        self.url = reverse('loyalty:code_status')
+
+    def test_waiting_request_wakes_on_deactivation(self):
+        def use_code():
+            LoyaltyCode.objects.get(pk=self.loyalty_code.pk).deactivate()
+            connection.close()
+
+        timer = threading.Timer(0.3, use_code)
+        started = time.monotonic()
+        timer.start()
+        response = self.api_client.get(self.url, {'code': self.loyalty_code.code, 'wait': 10})
+        timer.join()
+        self.assertEqual(response.data['status'], 'used')
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_deactivation_on_another_worker_is_noticed(self):
+        def use_code_elsewhere():
+            # Другой воркер: строка меняется, событие в брокер этого процесса не приходит
+            LoyaltyCode.objects.filter(pk=self.loyalty_code.pk).update(is_active=False)
+            connection.close()
+
+        timer = threading.Timer(0.3, use_code_elsewhere)
+        started = time.monotonic()
+        timer.start()
+        with mock.patch('loyalty.views.CODE_STATUS_RECHECK_SECONDS', 0.5):
+            response = self.api_client.get(self.url, {'code': self.loyalty_code.code, 'wait': 10})
+        timer.join()
+        self.assertEqual(response.data['status'], 'used')
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_waiting_request_returns_on_expiry(self):
+        LoyaltyCode.objects.filter(pk=self.loyalty_code.pk).update(
+            expires_at=timezone.now() + timezone.timedelta(seconds=0.3)
+        )
+        started = time.monotonic()
+        response = self.api_client.get(self.url, {'code': self.loyalty_code.code, 'wait': 10})
+        self.assertEqual(response.data['status'], 'expired')
+        self.assertLess(time.monotonic() - started, 5)
+
+
+@with_code_secret
+class LoyaltyCodeAllocatorTest(TestCase):
+    def setUp(self):
+        self.client_user = User.objects.create(phone="+70001112233", role=User.ROLE_CLIENT)
+        self.other_user = User.objects.create(phone="+70001112244", role=User.ROLE_CLIENT)
+
+    def test_permutation_gives_distinct_codes(self):
+        regular = {codes.format_code(codes.KIND_REGULAR, n) for n in range(2000)}
+        self.assertEqual(len(regular), 2000)
+        self.assertTrue(all(len(c) == 6 and c.isdigit() for c in regular))
+        self.assertEqual(len(codes.format_code(codes.KIND_REDEEM, 7)), 8)
+        # Полный круг возвращает тот же код
+        self.assertEqual(codes.format_code(codes.KIND_REGULAR, 10 ** 6 + 5), codes.format_code(codes.KIND_REGULAR, 5))
+
+    def test_missing_secret_fails_system_check(self):
+        from .checks import check_code_secret
+        self.assertEqual(check_code_secret(None), [])
+        with override_settings(LOYALTY_CODE_SECRET=''):
+            self.assertEqual([e.id for e in check_code_secret(None)], ['loyalty.E001'])
+
+    def test_codes_are_keyed_by_dedicated_secret(self):
+        code = codes.format_code(codes.KIND_REGULAR, 5)
+        with self.settings(LOYALTY_CODE_SECRET='other-secret'):
+            self.assertNotEqual(codes.format_code(codes.KIND_REGULAR, 5), code)
+        with self.settings(LOYALTY_CODE_SECRET=''):
+            with self.assertRaises(ImproperlyConfigured):
+                LoyaltyCode.create_for_user(self.client_user)
+        self.assertFalse(LoyaltyCode.objects.exists())
+
+    def test_expired_holder_is_recycled_and_active_one_skipped(self):
+        LoyaltyCode.create_for_user(self.other_user)
+        number = LoyaltyCodeSequence.objects.get(kind=codes.KIND_REGULAR).next_value
+        recycled = codes.format_code(codes.KIND_REGULAR, number)
+        stale = LoyaltyCode.objects.create(
+            user=self.other_user, code=recycled, expires_at=timezone.now() - timezone.timedelta(minutes=1),
+        )
+        # деактивация своих + счётчик (2) + освобождение истёкшего + INSERT, плюс две пары SAVEPOINT/RELEASE
+        with self.assertNumQueries(9):
+            issued = LoyaltyCode.create_for_user(self.client_user)
+        self.assertEqual(issued.code, recycled)
+        stale.refresh_from_db()
+        self.assertFalse(stale.is_active)
+
+        # Следующий номер занят действующим кодом — аллокатор берёт следующий
+        busy = codes.format_code(codes.KIND_REGULAR, number + 1)
+        expires_at = timezone.now() + timezone.timedelta(minutes=10)
+        LoyaltyCode.objects.create(user=self.other_user, code=busy, expires_at=expires_at)
+        issued = LoyaltyCode.create_for_user(self.client_user)
+        self.assertEqual(issued.code, codes.format_code(codes.KIND_REGULAR, number + 2))
+        self.assertEqual(LoyaltyCode.objects.filter(code=busy, is_active=True).count(), 1)
+
+
+@with_code_secret
+class LoyaltyCodePurgeTest(TestCase):
+    def test_purges_old_codes_in_batches(self):
+        user = User.objects.create(phone="+70001112233", role=User.ROLE_CLIENT)
+        now = timezone.now()
+        old = now - timezone.timedelta(days=3)
+        for i in range(5):
+            LoyaltyCode.objects.create(user=user, code=f'10000{i}', expires_at=old, is_active=i % 2 == 0)
+        recent_used = LoyaltyCode.objects.create(user=user, code='200000', expires_at=now, is_active=False)
+        live = LoyaltyCode.create_for_user(user)
+        LoyaltyCode.objects.filter(pk__in=[recent_used.pk, live.pk]).update(created_at=now)
+        LoyaltyCode.objects.filter(code__startswith='10000').update(created_at=old)
+
+        self.assertEqual(purge_stale_codes(dry_run=True).deleted, 5)
+        result = purge_stale_codes(batch_size=2)
+        self.assertEqual((result.deleted, result.batches), (5, 3))
+        self.assertEqual(set(LoyaltyCode.objects.values_list('pk', flat=True)), {recent_used.pk, live.pk})
+
+        out = StringIO()
+        call_command('purge_loyalty_codes', stdout=out)
+        self.assertIn('Удалено кодов: 0', out.getvalue())
+
+
+@with_code_secret
+class LoyaltyTransactionConcurrencyTest(TransactionTestCase):
+    """Параллельные сканирования одного кода: провести транзакцию может только одно."""
+
+    def setUp(self):
+        ranks.invalidate()
+        Rank.objects.create(name="Бронза", min_total_spent_som=0, cashback_percent=10)
+        self.coffee_shop = CoffeeShop.objects.create(name="Test Coffee Shop", address="Test Address")
+        self.client_user = User.objects.create(phone="+70001112233", role=User.ROLE_CLIENT, points=500)
+        self.baristas = [
+            User.objects.create(phone=f"+7000444556{i}", role=User.ROLE_BARISTA, coffee_shop=self.coffee_shop)
+            for i in range(6)
+        ]
+        self.loyalty_code = LoyaltyCode.create_for_user(self.client_user)
+
+    def test_same_code_scanned_concurrently(self):
+        barrier = threading.Barrier(len(self.baristas))
+        results = []
+
+        def scan(barista):
+            # Исключения запроса тестовый клиент ловит глобальным сигналом и поднимает
+            # во всех потоках сразу, поэтому здесь они превращаются в ответ 500
+            api_client = APIClient(raise_request_exception=False)
+            api_client.force_authenticate(barista)
+            barrier.wait()
+            try:
+                # Тестовая SQLite в памяти не ждёт блокировок, а сразу отказывает
+                # "table is locked" (500): такой запрос бариста просто повторяет
+                for _ in range(200):
+                    response = api_client.post(reverse('loyalty:create_transaction'), {
+                        'code': self.loyalty_code.code, 'amount': 1000, 'points_to_use': 200, 'coffee_quantity': 1,
+                    }, format='json')
+                    if response.status_code == 500:
+                        time.sleep(0.005)
+                        continue
+                    results.append(response.status_code)
+                    break
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=scan, args=(b,)) for b in self.baristas]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), len(self.baristas), results)
+        self.assertEqual(results.count(201), 1, results)
+        self.assertEqual(results.count(400), len(self.baristas) - 1, results)
+        self.assertEqual(LoyaltyTransaction.objects.count(), 1)
+        entries = BalanceLedgerEntry.objects.filter(
+            user=self.client_user, reason=BalanceLedgerEntry.REASON_LOYALTY_TRANSACTION,
+        )
+        self.assertEqual(list(entries.values_list('points', 'total_spent')), [(-200 + 80, 100000)])
+        self.client_user.refresh_from_db()
+        # 500 - 200 списано + 10% от (1000 - 200) начислено
+        self.assertEqual(self.client_user.points, 380)
+        self.assertEqual(self.client_user.coffee_count, 1)
+        self.assertEqual(self.client_user.total_spent, 100000)
+        self.assertFalse(LoyaltyCode.objects.get(pk=self.loyalty_code.pk).is_active)
+
+    def test_sequential_rescan_is_rejected(self):
+        api_client = APIClient()
+        api_client.force_authenticate(self.baristas[0])
+        payload = {'code': self.loyalty_code.code, 'amount': 100, 'points_to_use': 0}
+        url = reverse('loyalty:create_transaction')
+        self.assertEqual(api_client.post(url, payload, format='json').status_code, 201)
+        self.assertEqual(api_client.post(url, payload, format='json').status_code, 400)
+        self.client_user.refresh_from_db()
+        self.assertEqual(self.client_user.total_spent, 10000)
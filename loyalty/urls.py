@@ -20,7 +20,7 @@ urlpatterns = [
     
     # Маршрут для проверки кода лояльности (для баристы)
     path('loyalty/code/verify/', LoyaltyCodeVerifyView.as_view(), name='verify_code'),
-    # Клиентский polling статуса кода
+    # Статус кода для клиента (long-poll через ?wait=)
     path('loyalty/code/status/', LoyaltyCodeStatusView.as_view(), name='code_status'),
     
     # Маршрут для создания транзакции (начисление/списание баллов) (для баристы)
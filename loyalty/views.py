@@ -1,18 +1,29 @@
 from django.shortcuts import render
-from rest_framework import viewsets, status, generics, authentication
+from rest_framework import viewsets, status, generics
 from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.exceptions import ValidationError
-from .models import LoyaltyCode, LoyaltyTransaction
+from .models import LoyaltyCode, LoyaltyTransaction, code_topic
 from .serializers import (
     LoyaltyCodeSerializer,
     LoyaltyTransactionSerializer,
     LoyaltyCodeVerificationSerializer,
     LoyaltyTransactionCreateSerializer
 )
+from core.authentication import CachedTokenAuthentication, refresh_balance
 from core.models import User
+from core.idempotency import idempotent
+from core.events import broker
+from django.db import transaction as db_transaction
 from django.utils import timezone
+import time
+
+# Максимальное удержание запроса статуса кода (?wait), секунд
+CODE_STATUS_MAX_WAIT = 30
+# Шаг ожидания: брокер событий живёт в процессе, и код, погашенный запросом на другом
+# воркере, этот процесс не разбудит — между шагами статус перечитывается из БД
+CODE_STATUS_RECHECK_SECONDS = 3
 
 
 
@@ -20,7 +31,7 @@ class LoyaltyCodeView(generics.CreateAPIView):
     """Представление для генерации кода лояльности для клиента"""
     
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = LoyaltyCodeSerializer
     
     def create(self, request, *args, **kwargs):
@@ -45,7 +56,7 @@ class LoyaltyFreeCoffeeCodeView(generics.CreateAPIView):
     """Представление для генерации кода для получения бесплатного кофе"""
     
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = LoyaltyCodeSerializer
     
     def create(self, request, *args, **kwargs):
@@ -59,6 +70,7 @@ class LoyaltyFreeCoffeeCodeView(generics.CreateAPIView):
             )
         
         # Проверяем, что у клиента достаточно кофе для бесплатного
+        refresh_balance(user)
         if user.coffee_count < 7:
             return Response(
                 {
@@ -79,7 +91,7 @@ class LoyaltyFreeCoffeeCodeView(generics.CreateAPIView):
 class LoyaltyCodeVerifyView(generics.GenericAPIView):
     """Представление для проверки кода лояльности"""
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = LoyaltyCodeVerificationSerializer
     
     def post(self, request, *args, **kwargs):
@@ -157,11 +169,13 @@ class LoyaltyCodeVerifyView(generics.GenericAPIView):
 class LoyaltyCodeStatusView(generics.GenericAPIView):
     """Клиентский чек статуса QR-кода: active | used | expired.
 
-    Клиент опрашивает раз в секунду. Когда статус становится used,
-    фронт делает редирект на главную.
+    С параметром ?wait=N (секунд, до 30) запрос удерживается, пока код активен:
+    ответ приходит сразу после его использования бариста, по истечении срока
+    или по таймауту. Без wait — мгновенный ответ, как при прежнем опросе раз в секунду.
+    Когда статус становится used, фронт делает редирект на главную.
     """
     permission_classes = [AllowAny]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def get(self, request, *args, **kwargs):
         code = request.query_params.get("code")
@@ -169,13 +183,34 @@ class LoyaltyCodeStatusView(generics.GenericAPIView):
             return Response({"error": "Параметр code обязателен"}, status=status.HTTP_400_BAD_REQUEST)
         if not code.isdigit() or len(code) not in (6, 8):
             return Response({"error": "Неверный формат code"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            wait = min(max(float(request.query_params.get("wait", 0)), 0), CODE_STATUS_MAX_WAIT)
+        except ValueError:
+            return Response({"error": "Неверный формат wait"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Номер события берём до чтения кода, чтобы не пропустить деактивацию между ними
+        topic = code_topic(request.user.id)
+        after = broker.last_id
 
         # Только коды текущего пользователя
-        try:
-            lc = LoyaltyCode.objects.get(code=code, user=request.user)
-        except LoyaltyCode.DoesNotExist:
+        # Коды переиспользуются, поэтому берём последний выданный пользователю
+        lc = LoyaltyCode.objects.filter(code=code, user=request.user).order_by('-created_at', '-id').first()
+        if lc is None:
             return Response({"error": "Код не найден"}, status=status.HTTP_404_NOT_FOUND)
 
+        deadline = time.monotonic() + wait
+        while lc.is_active and not lc.is_expired():
+            remaining = min(deadline - time.monotonic(), (lc.expires_at - timezone.now()).total_seconds())
+            if remaining <= 0:
+                break
+            events = broker.wait(topic, after, min(remaining, CODE_STATUS_RECHECK_SECONDS))
+            if events:
+                after = events[-1].id
+            lc.refresh_from_db(fields=['is_active'])
+        if wait and lc.is_active:
+            # Код могли погасить после последней проверки
+            lc.refresh_from_db(fields=['is_active'])
+
         is_expired = lc.is_expired()
         is_active = lc.is_active and not is_expired
         used = (not lc.is_active) and not is_expired
@@ -195,7 +230,7 @@ class LoyaltyCodeStatusView(generics.GenericAPIView):
 class LoyaltyFreeCoffeeConfirmView(generics.GenericAPIView):
     """Подтверждение выдачи бесплатного кофе (деактивация 8-значного токена). Для бариста."""
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request, *args, **kwargs):
         # Только бариста
@@ -214,19 +249,20 @@ class LoyaltyFreeCoffeeConfirmView(generics.GenericAPIView):
         if lc.is_expired():
             return Response({"error": "Срок действия кода истек"}, status=status.HTTP_400_BAD_REQUEST)
 
-        customer = lc.user
-        # Создаём нулевую транзакцию-аудит
-        trx = LoyaltyTransaction.objects.create(
-            user=customer,
-            barista=request.user,
-            coffee_shop=getattr(request.user, 'coffee_shop', None),
-            transaction_type=LoyaltyTransaction.TYPE_SPENDING,
-            amount=0,
-            points_used=0,
-            points_earned=0,
-        )
-
-        lc.deactivate()
+        with db_transaction.atomic():
+            # Условное гашение: повторное/параллельное подтверждение того же кода не пройдёт
+            if not lc.claim():
+                return Response({"error": "Код не найден или уже использован"}, status=status.HTTP_404_NOT_FOUND)
+            # Создаём нулевую транзакцию-аудит
+            trx = LoyaltyTransaction.objects.create(
+                user_id=lc.user_id,
+                barista=request.user,
+                coffee_shop=getattr(request.user, 'coffee_shop', None),
+                transaction_type=LoyaltyTransaction.TYPE_SPENDING,
+                amount=0,
+                points_used=0,
+                points_earned=0,
+            )
 
         return Response({
             "success": True,
@@ -243,9 +279,10 @@ class LoyaltyTransactionCreateView(generics.CreateAPIView):
     Система начисляет 5% бонусов от суммы после вычета использованных бонусов.
     """
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = LoyaltyTransactionCreateSerializer
     
+    @idempotent('loyalty-transaction-create')
     def create(self, request, *args, **kwargs):
         try:
             print(f"[LoyaltyTransactionCreateView.create] Raw body: {request.body}")
@@ -283,8 +320,11 @@ class LoyaltyTransactionCreateView(generics.CreateAPIView):
                 pass
             raise
         
+        # 400 — только ValidationError; остальные ошибки уходят наружу как 5xx,
+        # и @idempotent не сохраняет их под ключом: повтор выполнится заново
+        transaction = serializer.save()
+
         try:
-            transaction = serializer.save()
             result_serializer = LoyaltyTransactionSerializer(transaction)
             
             # Получаем обновленную информацию о пользователе
@@ -329,19 +369,16 @@ class LoyaltyTransactionCreateView(generics.CreateAPIView):
             
         except Exception as e:
             try:
-                print(f"[LoyaltyTransactionCreateView.create] Exception during save/respond: {e}")
+                print(f"[LoyaltyTransactionCreateView.create] Exception during respond: {e}")
             except Exception:
                 pass
-            return Response(
-                {"error": str(e)},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+            raise
 
 
 class LoyaltyTransactionHistoryView(generics.ListAPIView):
     """Представление для просмотра истории транзакций лояльности"""
     permission_classes = [IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = LoyaltyTransactionSerializer
     
     def get_queryset(self):
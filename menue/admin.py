@@ -21,9 +21,12 @@ class MenuItemAdmin(admin.ModelAdmin):
     list_filter = ("category", "is_active")
     search_fields = ("name", "ingredients")
     inlines = [ItemVariantInline]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_variants()
     
     def get_default_price(self, obj):
-        default_variant = obj.variants.filter(is_default=True).first()
+        default_variant = obj.default_variants[0] if obj.default_variants else None
         if default_variant:
             return default_variant.price
         return "-"
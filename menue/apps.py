@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MenueConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'menue'
+
+    def ready(self):
+        import menue.signals
@@ -0,0 +1,269 @@
+"""Массовый импорт и потоковый экспорт меню.
+
+Импорт принимает JSON ({"items": [...]}) или CSV (строка на вариант товара),
+проверяет весь документ в памяти, разрешает категории, порции, товары и
+варианты несколькими запросами и применяет изменения одной транзакцией через
+bulk_create/bulk_update. Так как bulk-операции не шлют сигналы, журнал
+MenuChange и версия меню обновляются здесь явно.
+"""
+import csv
+import io
+import json
+from collections import OrderedDict
+
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from core.models import ContentVersion
+from .models import Category, MenuItem, ItemVariant, Portion, MenuChange
+from .serializers import MenuImportSerializer
+from .snapshot import MENU_VERSION_KEY
+
+CSV_COLUMNS = [
+    'item_id', 'category_id', 'category', 'name', 'description', 'ingredients',
+    'is_active', 'portion_id', 'price', 'is_default',
+]
+
+ITEM_FIELDS = ['category_id', 'name', 'description', 'ingredients', 'is_active']
+
+
+def parse_csv(text):
+    """CSV → документ импорта. Строки одного товара (item_id или категория+название) объединяются."""
+    reader = csv.DictReader(io.StringIO(text))
+    missing = {'name', 'portion_id', 'price'} - set(reader.fieldnames or [])
+    if missing:
+        raise serializers.ValidationError({'file': f"В CSV нет колонок: {', '.join(sorted(missing))}"})
+
+    items = OrderedDict()
+    for row in reader:
+        row = {key: (value or '').strip() for key, value in row.items() if key}
+        if row.get('item_id'):
+            key = ('id', row['item_id'])
+        else:
+            key = ('name', row.get('category_id'), row.get('category'), row['name'])
+        if key not in items:
+            item = {'name': row['name'], 'variants': []}
+            # Текстовые поля берутся, если есть колонка (пустая ячейка очищает поле),
+            # остальные — только непустые: чего нет в файле, то у товара не меняется
+            for field in ('description', 'ingredients'):
+                if field in row:
+                    item[field] = row[field]
+            for field in ('item_id', 'category_id', 'category', 'is_active'):
+                if row.get(field):
+                    item['id' if field == 'item_id' else field] = row[field]
+            items[key] = item
+        if row.get('portion_id'):
+            variant = {'portion_id': row['portion_id'], 'price': row['price']}
+            if row.get('is_default'):
+                variant['is_default'] = row['is_default']
+            items[key]['variants'].append(variant)
+    return {'items': list(items.values())}
+
+
+def _category_key(spec):
+    return spec.get('category_id') or spec['category']
+
+
+class MenuImport:
+    """Импорт меню: validate() без записи в БД, apply() — одна транзакция."""
+
+    def __init__(self, document):
+        self.document = document
+        self.errors = {}
+
+    def validate(self):
+        serializer = MenuImportSerializer(data=self.document)
+        serializer.is_valid(raise_exception=True)
+        self.items = serializer.validated_data['items']
+
+        category_ids = {spec['category_id'] for spec in self.items if spec.get('category_id')}
+        self.categories_by_id = Category.objects.in_bulk(category_ids)
+        category_names = {spec['category'] for spec in self.items if not spec.get('category_id')}
+        self.categories_by_name = {c.name: c for c in Category.objects.filter(name__in=category_names)}
+        portion_ids = {v['portion_id'] for spec in self.items for v in spec['variants']}
+        self.portions = Portion.objects.in_bulk(portion_ids)
+        item_ids = {spec['id'] for spec in self.items if spec.get('id')}
+        self.items_by_id = MenuItem.objects.in_bulk(item_ids)
+        names = {spec['name'] for spec in self.items if not spec.get('id')}
+        self.items_by_name = {(i.category_id, i.name): i for i in MenuItem.objects.filter(name__in=names)}
+
+        errors = {}
+        for index, spec in enumerate(self.items):
+            row_errors = []
+            if spec.get('category_id') and spec['category_id'] not in self.categories_by_id:
+                row_errors.append(f"Категория id={spec['category_id']} не найдена")
+            if spec.get('id') and spec['id'] not in self.items_by_id:
+                row_errors.append(f"Товар id={spec['id']} не найден")
+            for variant in spec['variants']:
+                if variant['portion_id'] not in self.portions:
+                    row_errors.append(f"Порция id={variant['portion_id']} не найдена")
+            if row_errors:
+                errors[index] = row_errors
+        if errors:
+            raise serializers.ValidationError({'items': errors})
+
+    def apply(self, dry_run=False):
+        """Применяет документ и возвращает отчёт об изменениях."""
+        with transaction.atomic():
+            report = self._apply()
+            if dry_run:
+                transaction.set_rollback(True)
+        report['dry_run'] = dry_run
+        return report
+
+    def _apply(self):
+        now = timezone.now()
+
+        # Категории, заданные по названию и отсутствующие в БД, создаём
+        new_names = []
+        for spec in self.items:
+            name = spec.get('category')
+            if not spec.get('category_id') and name not in self.categories_by_name and name not in new_names:
+                new_names.append(name)
+        created_categories = Category.objects.bulk_create([Category(name=name) for name in new_names])
+        self.categories_by_name.update({c.name: c for c in created_categories})
+
+        # Товары
+        new_items, changed_items, unchanged_items, item_for_spec = [], [], [], []
+        seen = {}
+        for spec in self.items:
+            category = (
+                self.categories_by_id.get(spec.get('category_id'))
+                or self.categories_by_name[spec.get('category')]
+            )
+            # Только поля, заданные в строке: остальные у существующего товара не трогаем
+            values = {'category_id': category.id, 'name': spec['name']}
+            optional = ('description', 'ingredients', 'is_active')
+            values.update({field: spec[field] for field in optional if field in spec})
+            if spec.get('id'):
+                item = self.items_by_id[spec['id']]
+            else:
+                item = self.items_by_name.get((category.id, spec['name']))
+            if item is None:
+                key = (category.id, spec['name'])
+                item = seen.get(key)
+                if item is None:
+                    item = MenuItem(created_at=now, updated_at=now, **values)
+                    seen[key] = item
+                    new_items.append(item)
+            elif any(getattr(item, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(item, field, value)
+                item.updated_at = now
+                if item not in changed_items:
+                    changed_items.append(item)
+            elif item not in changed_items and item not in unchanged_items:
+                unchanged_items.append(item)
+            item_for_spec.append(item)
+
+        MenuItem.objects.bulk_create(new_items)
+        MenuItem.objects.bulk_update(changed_items, ITEM_FIELDS + ['updated_at'])
+
+        # Варианты: одним запросом читаем существующие для всех затронутых товаров
+        existing = {}
+        touched_item_ids = {item.id for item in item_for_spec}
+        for variant in ItemVariant.objects.filter(menu_item_id__in=touched_item_ids):
+            existing[(variant.menu_item_id, variant.portion_id)] = variant
+
+        new_variants, changed_variants = {}, {}
+        unchanged_variants = 0
+        for spec, item in zip(self.items, item_for_spec):
+            # Вариант по умолчанию меняется, только если документ задаёт его явно
+            has_default = any(v.get('is_default') for v in spec['variants'])
+            imported_portions = {v['portion_id'] for v in spec['variants']}
+            for v in spec['variants']:
+                variant = existing.get((item.id, v['portion_id']))
+                keep = variant is not None and not has_default and variant.is_default
+                is_default = v.get('is_default', keep)
+                if variant is None:
+                    new_variants[(item.id, v['portion_id'])] = ItemVariant(
+                        menu_item=item, portion=self.portions[v['portion_id']],
+                        price=v['price'], is_default=is_default,
+                    )
+                elif variant.price != v['price'] or variant.is_default != is_default:
+                    variant.price = v['price']
+                    variant.is_default = is_default
+                    changed_variants[variant.id] = variant
+                else:
+                    unchanged_variants += 1
+            # Вариант по умолчанию у товара один: снимаем флаг с остальных
+            if has_default:
+                for (item_id, portion_id), variant in existing.items():
+                    if item_id == item.id and portion_id not in imported_portions and variant.is_default:
+                        variant.is_default = False
+                        changed_variants[variant.id] = variant
+
+        created_variants = ItemVariant.objects.bulk_create(list(new_variants.values()))
+        ItemVariant.objects.bulk_update(list(changed_variants.values()), ['price', 'is_default'])
+
+        changes = [
+            (MenuChange.MODEL_CATEGORY, [c.id for c in created_categories]),
+            (MenuChange.MODEL_ITEM, [i.id for i in new_items] + [i.id for i in changed_items]),
+            (MenuChange.MODEL_VARIANT, [v.id for v in created_variants] + list(changed_variants)),
+        ]
+        if any(ids for _, ids in changes):
+            for model, ids in changes:
+                MenuChange.record(model, ids, MenuChange.ACTION_UPSERT)
+            ContentVersion.bump(MENU_VERSION_KEY)
+
+        return {
+            'categories': {'created': [c.name for c in created_categories]},
+            'items': {
+                'created': [i.id for i in new_items],
+                'updated': [i.id for i in changed_items],
+                'unchanged': len(unchanged_items),
+            },
+            'variants': {
+                'created': len(created_variants),
+                'updated': len(changed_variants),
+                'unchanged': unchanged_variants,
+            },
+        }
+
+
+def export_items():
+    """Товары для экспорта: варианты предзагружаются пачками при итерации."""
+    return MenuItem.objects.with_variants().order_by('id').iterator(chunk_size=500)
+
+
+def _item_to_dict(item):
+    return {
+        'id': item.id,
+        'category_id': item.category_id,
+        'category': item.category.name,
+        'name': item.name,
+        'description': item.description,
+        'ingredients': item.ingredients,
+        'is_active': item.is_active,
+        'variants': [
+            {'portion_id': v.portion_id, 'price': str(v.price), 'is_default': v.is_default}
+            for v in item.variants.all()
+        ],
+    }
+
+
+def stream_json():
+    yield '{"items": ['
+    for index, item in enumerate(export_items()):
+        yield (',' if index else '') + json.dumps(_item_to_dict(item), ensure_ascii=False)
+    yield ']}'
+
+
+class _Echo:
+    """Псевдо-буфер для csv.writer: возвращает строку вместо записи."""
+    def write(self, value):
+        return value
+
+
+def stream_csv():
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for item in export_items():
+        data = _item_to_dict(item)
+        base = [data['id'], data['category_id'], data['category'], data['name'],
+                data['description'], data['ingredients'], data['is_active']]
+        if not data['variants']:
+            yield writer.writerow(base + ['', '', ''])
+        for v in data['variants']:
+            yield writer.writerow(base + [v['portion_id'], v['price'], v['is_default']])
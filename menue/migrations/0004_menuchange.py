@@ -0,0 +1,28 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menue', '0003_remove_menuitem_portions_remove_menuitem_price_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MenuChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('category', 'Категория'), ('item', 'Позиция меню'), ('variant', 'Вариант товара'), ('portion', 'Порция')], max_length=16, verbose_name='Сущность')),
+                ('object_id', models.BigIntegerField(verbose_name='ID объекта')),
+                ('action', models.CharField(choices=[('upsert', 'Создание/изменение'), ('delete', 'Удаление')], max_length=8, verbose_name='Действие')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время изменения')),
+            ],
+            options={
+                'verbose_name': 'Изменение меню',
+                'verbose_name_plural': 'Изменения меню',
+                'ordering': ['id'],
+            },
+        ),
+    ]
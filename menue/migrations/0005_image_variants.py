@@ -0,0 +1,23 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menue', '0004_menuchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии фото'),
+        ),
+        migrations.AddField(
+            model_name='menuitem',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии фото'),
+        ),
+    ]
@@ -6,6 +6,7 @@ class Category(models.Model):
     name = models.CharField(max_length=100, verbose_name="Название категории")
     description = models.TextField(blank=True, verbose_name="Описание категории")
     image = models.ImageField(upload_to='categories/', blank=True, null=True, verbose_name="Фото категории")
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name="Уменьшенные копии фото")
 
     def __str__(self):
         return self.name
@@ -27,16 +28,33 @@ class Portion(models.Model):
         verbose_name_plural = "Порции"
         unique_together = ("name", "volume", "unit")
 
+class MenuItemQuerySet(models.QuerySet):
+    def with_variants(self):
+        """Товары с категорией, вариантами и вариантом по умолчанию.
+
+        Вариант по умолчанию кладётся в атрибут default_variants (список из 0-1
+        элементов), поэтому сериализатор не делает запросов на каждый товар.
+        """
+        variants = ItemVariant.objects.select_related('portion').order_by('id')
+        return self.select_related('category').prefetch_related(
+            models.Prefetch('variants', queryset=variants),
+            models.Prefetch('variants', queryset=variants.filter(is_default=True), to_attr='default_variants'),
+        )
+
+
 class MenuItem(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='items', verbose_name="Категория")
     name = models.CharField(max_length=100, verbose_name="Название товара")
     description = models.TextField(blank=True, verbose_name="Описание")
     ingredients = models.TextField(blank=True, verbose_name="Состав")
     image = models.ImageField(upload_to='menu_items/', blank=True, null=True, verbose_name="Фото")
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name="Уменьшенные копии фото")
     is_active = models.BooleanField(default=True, verbose_name="Активен")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
 
+    objects = MenuItemQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -57,3 +75,46 @@ class ItemVariant(models.Model):
         verbose_name = "Вариант товара"
         verbose_name_plural = "Варианты товаров"
         unique_together = ("menu_item", "portion")
+
+
+class MenuChange(models.Model):
+    """Журнал изменений меню для инкрементальной синхронизации клиентов.
+
+    id записи — монотонная версия меню: клиент передаёт последнюю известную
+    версию и получает только объекты, изменённые после неё.
+    """
+    MODEL_CATEGORY = 'category'
+    MODEL_ITEM = 'item'
+    MODEL_VARIANT = 'variant'
+    MODEL_PORTION = 'portion'
+    MODEL_CHOICES = [
+        (MODEL_CATEGORY, 'Категория'),
+        (MODEL_ITEM, 'Позиция меню'),
+        (MODEL_VARIANT, 'Вариант товара'),
+        (MODEL_PORTION, 'Порция'),
+    ]
+
+    ACTION_UPSERT = 'upsert'
+    ACTION_DELETE = 'delete'
+    ACTION_CHOICES = [
+        (ACTION_UPSERT, 'Создание/изменение'),
+        (ACTION_DELETE, 'Удаление'),
+    ]
+
+    model = models.CharField(max_length=16, choices=MODEL_CHOICES, verbose_name="Сущность")
+    object_id = models.BigIntegerField(verbose_name="ID объекта")
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES, verbose_name="Действие")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Время изменения")
+
+    def __str__(self):
+        return f"#{self.id} {self.action} {self.model}:{self.object_id}"
+
+    class Meta:
+        verbose_name = "Изменение меню"
+        verbose_name_plural = "Изменения меню"
+        ordering = ['id']
+
+    @classmethod
+    def record(cls, model, object_ids, action):
+        """Записывает изменения пачкой (одним INSERT)."""
+        cls.objects.bulk_create([cls(model=model, object_id=oid, action=action) for oid in object_ids])
@@ -1,12 +1,17 @@
 from rest_framework import serializers
+from core.images import build_srcset
 from .models import Category, MenuItem, Portion, ItemVariant
 
 class CategorySerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Category
-        fields = ['id', 'name', 'description', 'image']
+        fields = ['id', 'name', 'description', 'image', 'image_srcset']
+
+    def get_image_srcset(self, obj):
+        return build_srcset(obj.image_variants, obj.image.storage, self.context.get('request'))
 
     def get_image(self, obj):
         request = self.context.get('request')
@@ -33,6 +38,7 @@ class MenuItemSerializer(serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
     category_id = serializers.PrimaryKeyRelatedField(queryset=Category.objects.all(), source='category', write_only=True)
     image = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
     variants = ItemVariantSerializer(many=True, read_only=True)
     
     # Для совместимости с API документацией
@@ -42,7 +48,7 @@ class MenuItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = MenuItem
         fields = [
-            'id', 'category', 'category_id', 'name', 'description', 'ingredients', 'image',
+            'id', 'category', 'category_id', 'name', 'description', 'ingredients', 'image', 'image_srcset',
             'variants', 'volume', 'price', 'is_active', 'created_at', 'updated_at'
         ]
 
@@ -53,10 +59,23 @@ class MenuItemSerializer(serializers.ModelSerializer):
                 return request.build_absolute_uri(obj.image.url)
             return obj.image.url
         return None
+
+    def get_image_srcset(self, obj):
+        return build_srcset(obj.image_variants, obj.image.storage, self.context.get('request'))
     
+    def _get_default_variant(self, obj):
+        # Предзагружен через MenuItem.objects.with_variants()
+        if hasattr(obj, 'default_variants'):
+            return obj.default_variants[0] if obj.default_variants else None
+        # Берём из variants.all(): при prefetch_related это не стоит запросов
+        for variant in obj.variants.all():
+            if variant.is_default:
+                return variant
+        return None
+
     def get_volume(self, obj):
         # Возвращает объем варианта по умолчанию для обратной совместимости
-        default_variant = obj.variants.filter(is_default=True).first()
+        default_variant = self._get_default_variant(obj)
         if default_variant:
             portion = default_variant.portion
             return f"{portion.volume} {portion.unit}"
@@ -64,7 +83,7 @@ class MenuItemSerializer(serializers.ModelSerializer):
     
     def get_price(self, obj):
         # Возвращает цену варианта по умолчанию для обратной совместимости
-        default_variant = obj.variants.filter(is_default=True).first()
+        default_variant = self._get_default_variant(obj)
         if default_variant:
             return default_variant.price
         return None
@@ -141,5 +160,77 @@ class MenuItemSerializer(serializers.ModelSerializer):
                             )
                         except Portion.DoesNotExist:
                             pass
+
+        # Предзагруженный вариант по умолчанию мог устареть
+        if hasattr(instance, 'default_variants'):
+            del instance.default_variants
         
-        return instance 
\ No newline at end of file
+        return instance 
+
+class MenuItemSyncSerializer(serializers.ModelSerializer):
+    """Плоское представление товара для menu/changes (без вложенных объектов)."""
+    image = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MenuItem
+        fields = [
+            'id', 'category_id', 'name', 'description', 'ingredients', 'image', 'image_srcset',
+            'is_active', 'created_at', 'updated_at'
+        ]
+
+    def get_image_srcset(self, obj):
+        return build_srcset(obj.image_variants, obj.image.storage, self.context.get('request'))
+
+    def get_image(self, obj):
+        request = self.context.get('request')
+        if obj.image and hasattr(obj.image, 'url'):
+            if request is not None:
+                return request.build_absolute_uri(obj.image.url)
+            return obj.image.url
+        return None
+
+
+class ItemVariantSyncSerializer(serializers.ModelSerializer):
+    """Плоское представление варианта для menu/changes."""
+
+    class Meta:
+        model = ItemVariant
+        fields = ['id', 'menu_item_id', 'portion_id', 'price', 'is_default']
+
+
+class MenuImportVariantSerializer(serializers.Serializer):
+    portion_id = serializers.IntegerField()
+    price = serializers.DecimalField(max_digits=7, decimal_places=2, min_value=0)
+    # Без поля флаг существующего варианта не меняется, новый создаётся без него
+    is_default = serializers.BooleanField(required=False)
+
+
+class MenuImportItemSerializer(serializers.Serializer):
+    """Строка документа импорта меню. Проверяется целиком в памяти, без запросов к БД.
+
+    Необязательные поля без значений по умолчанию: отсутствующее в строке поле
+    у существующего товара не меняется.
+    """
+    id = serializers.IntegerField(required=False)
+    category_id = serializers.IntegerField(required=False)
+    category = serializers.CharField(max_length=100, required=False)
+    name = serializers.CharField(max_length=100)
+    description = serializers.CharField(allow_blank=True, required=False)
+    ingredients = serializers.CharField(allow_blank=True, required=False)
+    is_active = serializers.BooleanField(required=False)
+    variants = MenuImportVariantSerializer(many=True, required=False, default=list)
+
+    def validate(self, data):
+        if not data.get('category_id') and not data.get('category'):
+            raise serializers.ValidationError({'category': 'Укажите category_id или название категории'})
+        portion_ids = [v['portion_id'] for v in data['variants']]
+        if len(portion_ids) != len(set(portion_ids)):
+            raise serializers.ValidationError({'variants': 'Порции внутри товара не должны повторяться'})
+        if sum(1 for v in data['variants'] if v.get('is_default')) > 1:
+            raise serializers.ValidationError({'variants': 'Вариант по умолчанию может быть только один'})
+        return data
+
+
+class MenuImportSerializer(serializers.Serializer):
+    items = MenuImportItemSerializer(many=True, allow_empty=False)
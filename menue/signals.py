@@ -0,0 +1,31 @@
+from django.db.models.signals import post_save, post_delete
+from core import images
+from core.models import ContentVersion
+from .models import Category, MenuItem, ItemVariant, Portion, MenuChange
+from .snapshot import MENU_VERSION_KEY
+
+CHANGE_MODELS = {
+    Category: MenuChange.MODEL_CATEGORY,
+    MenuItem: MenuChange.MODEL_ITEM,
+    ItemVariant: MenuChange.MODEL_VARIANT,
+    Portion: MenuChange.MODEL_PORTION,
+}
+
+
+def on_menu_saved(sender, instance, **kwargs):
+    MenuChange.record(CHANGE_MODELS[sender], [instance.pk], MenuChange.ACTION_UPSERT)
+    ContentVersion.bump(MENU_VERSION_KEY)
+
+
+def on_menu_deleted(sender, instance, **kwargs):
+    MenuChange.record(CHANGE_MODELS[sender], [instance.pk], MenuChange.ACTION_DELETE)
+    ContentVersion.bump(MENU_VERSION_KEY)
+
+
+for _model in CHANGE_MODELS:
+    post_save.connect(on_menu_saved, sender=_model, dispatch_uid=f'menu-version-save-{_model.__name__}')
+    post_delete.connect(on_menu_deleted, sender=_model, dispatch_uid=f'menu-version-delete-{_model.__name__}')
+
+
+images.register(Category, 'image', 'image_variants')
+images.register(MenuItem, 'image', 'image_variants')
@@ -0,0 +1,74 @@
+"""Снимок дерева меню для MenuTreeView.
+
+Дерево собирается фиксированным числом запросов (категории → товары →
+варианты с порциями) и сериализуется один раз на версию меню. Версию
+увеличивают сигналы из menue.signals при любой записи в Category,
+MenuItem, ItemVariant или Portion.
+"""
+import threading
+
+from django.core.cache import cache
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+
+from core.versioning import get_content_versions, version_token
+from .models import Category, MenuItem, ItemVariant
+from .serializers import CategorySerializer, MenuItemSerializer
+
+MENU_VERSION_KEY = 'menu'
+CACHE_TIMEOUT = 60 * 60 * 24
+
+# Последний снимок в памяти процесса: {base_url: (version, body)}
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def menu_tree_queryset():
+    """Категории с предзагруженными товарами, вариантами и порциями (3 запроса)."""
+    variants = ItemVariant.objects.select_related('portion').order_by('id')
+    items = MenuItem.objects.prefetch_related(Prefetch('variants', queryset=variants)).order_by('id')
+    return Category.objects.prefetch_related(Prefetch('items', queryset=items)).order_by('id')
+
+
+def build_menu_tree(request):
+    """Собирает дерево меню в виде списка словарей."""
+    context = {'request': request}
+    data = []
+    for cat in menu_tree_queryset():
+        cat_ser = CategorySerializer(cat, context=context).data
+        cat_ser['items'] = MenuItemSerializer(cat.items.all(), many=True, context=context).data
+        data.append(cat_ser)
+    return data
+
+
+def get_menu_version(request):
+    """Версия меню в виде строки: номер + время изменения.
+
+    Время делает версию уникальной даже после пересоздания таблицы версий.
+    """
+    return version_token(*get_content_versions(request, [MENU_VERSION_KEY])[MENU_VERSION_KEY])
+
+
+def get_menu_tree_bytes(request):
+    """Возвращает JSON дерева меню для текущей версии.
+
+    Версия читается до сборки дерева: если меню изменится во время сборки,
+    в кэш попадут более свежие данные под старой версией, но не наоборот.
+    Снимок зависит от хоста (в нём абсолютные URL картинок).
+    """
+    version = get_menu_version(request)
+    base_url = request.build_absolute_uri('/')
+
+    snapshot = _snapshots.get(base_url)
+    if snapshot and snapshot[0] == version:
+        return snapshot[1]
+
+    cache_key = f'menue:menu-tree:{version}:{base_url}'
+    body = cache.get(cache_key)
+    if body is None:
+        body = JSONRenderer().render(build_menu_tree(request))
+        cache.set(cache_key, body, CACHE_TIMEOUT)
+
+    with _lock:
+        _snapshots[base_url] = (version, body)
+    return body
@@ -0,0 +1,58 @@
+"""Инкрементальная синхронизация меню по журналу MenuChange.
+
+Клиент хранит версию (id последней записи журнала) и запрашивает
+menu/changes/?since=<version>. В ответ приходят только объекты, созданные,
+изменённые или удалённые после этой версии. since=0 (или неизвестная
+серверу версия) возвращает полное состояние с флагом full=true.
+"""
+from .models import Category, MenuItem, ItemVariant, Portion, MenuChange
+from .serializers import (
+    CategorySerializer, PortionSerializer, MenuItemSyncSerializer, ItemVariantSyncSerializer
+)
+
+# Ключ в ответе, модель, сериализатор
+SYNC_MODELS = {
+    MenuChange.MODEL_CATEGORY: ('categories', Category, CategorySerializer),
+    MenuChange.MODEL_ITEM: ('items', MenuItem, MenuItemSyncSerializer),
+    MenuChange.MODEL_VARIANT: ('variants', ItemVariant, ItemVariantSyncSerializer),
+    MenuChange.MODEL_PORTION: ('portions', Portion, PortionSerializer),
+}
+
+
+def get_latest_menu_change_id():
+    return MenuChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def get_menu_changes(since, request):
+    """Собирает ответ для menu/changes: не более шести запросов при любом объёме меню."""
+    latest = get_latest_menu_change_id()
+    full = since <= 0 or since > latest
+    context = {'request': request}
+
+    result = {'version': latest, 'full': full}
+    deleted = {}
+    if full:
+        for key, model, serializer_class in SYNC_MODELS.values():
+            result[key] = serializer_class(model.objects.order_by('id'), many=True, context=context).data
+            deleted[key] = []
+        result['deleted'] = deleted
+        return result
+
+    # Последнее действие по каждому объекту в интервале (since, latest]
+    last_action = {}
+    rows = MenuChange.objects.filter(id__gt=since, id__lte=latest).order_by('id')
+    for model_key, object_id, action in rows.values_list('model', 'object_id', 'action'):
+        last_action[(model_key, object_id)] = action
+
+    for model_key, (key, model, serializer_class) in SYNC_MODELS.items():
+        upsert_ids = {oid for (m, oid), action in last_action.items()
+                      if m == model_key and action == MenuChange.ACTION_UPSERT}
+        deleted_ids = {oid for (m, oid), action in last_action.items()
+                       if m == model_key and action == MenuChange.ACTION_DELETE}
+        objects = list(model.objects.filter(id__in=upsert_ids).order_by('id')) if upsert_ids else []
+        # Объект мог быть удалён уже после чтения журнала
+        deleted_ids |= upsert_ids - {obj.id for obj in objects}
+        result[key] = serializer_class(objects, many=True, context=context).data
+        deleted[key] = sorted(deleted_ids)
+    result['deleted'] = deleted
+    return result
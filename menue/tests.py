@@ -1,3 +1,267 @@
-from django.test import TestCase
+import io
+import json
+import shutil
+import tempfile
+from decimal import Decimal
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from PIL import Image
+from django.urls import reverse
+from rest_framework.test import APIClient
+from .models import Category, MenuItem, Portion, ItemVariant
 
-# Create your tests here.
+
+class MenuTreeSnapshotTest(TestCase):
+    def setUp(self):
+        self.api_client = APIClient()
+        self.portion_s = Portion.objects.create(name="S", volume=250)
+        self.portion_l = Portion.objects.create(name="L", volume=400)
+        for c in range(3):
+            cat = Category.objects.create(name=f"Категория {c}")
+            for i in range(4):
+                item = MenuItem.objects.create(category=cat, name=f"Товар {c}-{i}")
+                ItemVariant.objects.create(
+                    menu_item=item, portion=self.portion_s, price=Decimal('100'), is_default=True,
+                )
+                ItemVariant.objects.create(menu_item=item, portion=self.portion_l, price=Decimal('150'))
+
+    def test_query_count_does_not_depend_on_menu_size(self):
+        url = reverse('menu-tree')
+        # версия + категории + товары + варианты с порциями
+        with self.assertNumQueries(4):
+            response = self.api_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data), 3)
+        self.assertEqual(len(data[0]['items']), 4)
+        self.assertEqual(data[0]['items'][0]['price'], 100.0)
+        self.assertEqual(data[0]['items'][0]['volume'], '250 мл')
+
+        # Повторный запрос той же версии отдаётся из снимка
+        with self.assertNumQueries(1):
+            self.api_client.get(url)
+
+    def test_write_bumps_version(self):
+        url = reverse('menu-tree')
+        self.api_client.get(url)
+        item = MenuItem.objects.first()
+        item.name = "Новое имя"
+        item.save()
+        data = self.api_client.get(url).json()
+        names = [i['name'] for cat in data for i in cat['items']]
+        self.assertIn("Новое имя", names)
+
+    def test_conditional_get_returns_304(self):
+        url = reverse('menu-tree')
+        response = self.api_client.get(url)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        with self.assertNumQueries(1):
+            response = self.api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Portion.objects.create(name="XL", volume=500)
+        response = self.api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class MenuChangesTest(TestCase):
+    def setUp(self):
+        self.api_client = APIClient()
+        self.portion = Portion.objects.create(name="S", volume=250)
+        self.category = Category.objects.create(name="Кофе")
+        self.item = MenuItem.objects.create(category=self.category, name="Латте")
+        self.variant = ItemVariant.objects.create(
+            menu_item=self.item, portion=self.portion, price=Decimal('150'), is_default=True,
+        )
+        self.url = reverse('menu-changes')
+
+    def test_full_sync_then_delta(self):
+        full = self.api_client.get(self.url, {'since': 0}).json()
+        self.assertTrue(full['full'])
+        self.assertEqual(len(full['items']), 1)
+        version = full['version']
+
+        self.item.name = "Латте XL"
+        self.item.save()
+        other = Category.objects.create(name="Десерты")
+        other_id = other.id
+        other.delete()
+
+        delta = self.api_client.get(self.url, {'since': version}).json()
+        self.assertFalse(delta['full'])
+        self.assertEqual([i['name'] for i in delta['items']], ["Латте XL"])
+        self.assertEqual(delta['categories'], [])
+        self.assertEqual(delta['deleted']['categories'], [other_id])
+        self.assertEqual(delta['variants'], [])
+
+        empty = self.api_client.get(self.url, {'since': delta['version']}).json()
+        self.assertEqual(empty['items'], [])
+        self.assertEqual(empty['version'], delta['version'])
+
+    def test_cascade_delete_is_logged(self):
+        version = self.api_client.get(self.url).json()['version']
+        self.category.delete()
+        delta = self.api_client.get(self.url, {'since': version}).json()
+        self.assertEqual(delta['deleted']['items'], [self.item.id])
+        self.assertEqual(delta['deleted']['variants'], [self.variant.id])
+
+
+class MenuItemListTest(TestCase):
+    def setUp(self):
+        from core.models import User
+        self.manager = User.objects.create_user(phone="+70000000001", role=User.ROLE_MANAGER, password="pass")
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(self.manager)
+        portion = Portion.objects.create(name="S", volume=250)
+        self.category = Category.objects.create(name="Кофе")
+        for i in range(12):
+            item = MenuItem.objects.create(category=self.category, name=f"Товар {i}")
+            ItemVariant.objects.create(menu_item=item, portion=portion, price=Decimal('100'), is_default=True)
+
+    def test_list_costs_constant_queries(self):
+        url = reverse('menuitem-list-create')
+        with self.assertNumQueries(3):
+            response = self.api_client.get(url)
+        self.assertEqual(len(response.data), 12)
+        self.assertEqual(response.data[0]['volume'], '250 мл')
+
+        with self.assertNumQueries(4):
+            response = self.api_client.get(url, {'page': 2})
+        self.assertEqual(response.data['count'], 12)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_update_returns_fresh_default_variant(self):
+        item = MenuItem.objects.first()
+        variant = item.variants.get()
+        url = reverse('menuitem-detail', args=[item.id])
+        response = self.api_client.patch(url, {'variants': [{'id': variant.id, 'price': '120.00'}]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['price'], Decimal('120.00'))
+
+
+@override_settings(IMAGE_RENDITIONS_ASYNC=False, IMAGE_RENDITION_WIDTHS=(160, 320))
+class MenuItemImageRenditionsTest(TestCase):
+    def setUp(self):
+        from core.models import User
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        manager = User.objects.create_user(phone="+70000000001", role=User.ROLE_MANAGER, password="pass")
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(manager)
+        self.item = MenuItem.objects.create(category=Category.objects.create(name="Кофе"), name="Латте")
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_upload_generates_renditions(self):
+        buf = io.BytesIO()
+        Image.new('RGB', (800, 600), (120, 80, 40)).save(buf, 'JPEG')
+        upload = SimpleUploadedFile('latte.jpg', buf.getvalue(), content_type='image/jpeg')
+        url = reverse('menuitem-image-update', args=[self.item.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.api_client.patch(url, {'image': upload}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+
+        self.item.refresh_from_db()
+        variants = self.item.image_variants
+        self.assertEqual(variants['source'], self.item.image.name)
+        self.assertEqual([r['width'] for r in variants['renditions']], [160, 320])
+        self.assertTrue(variants['placeholder'].startswith('data:image/jpeg;base64,'))
+
+        data = self.api_client.get(reverse('menuitem-detail', args=[self.item.id])).data
+        self.assertIn('320', data['image_srcset']['webp'])
+        self.assertTrue(data['image_srcset']['jpeg']['160'].endswith('_w160.jpg'))
+
+
+class MenuBulkImportExportTest(TestCase):
+    def setUp(self):
+        from core.models import User
+        manager = User.objects.create_user(phone="+70000000001", role=User.ROLE_MANAGER, password="pass")
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(manager)
+        self.small = Portion.objects.create(name="S", volume=250)
+        self.large = Portion.objects.create(name="L", volume=400)
+        self.coffee = Category.objects.create(name="Кофе")
+        self.latte = MenuItem.objects.create(category=self.coffee, name="Латте")
+        self.latte_small = ItemVariant.objects.create(
+            menu_item=self.latte, portion=self.small, price=Decimal('150'), is_default=True,
+        )
+
+    def test_json_import_creates_and_updates_in_bulk(self):
+        document = {'items': [
+            {'category': 'Кофе', 'name': 'Латте', 'variants': [
+                {'portion_id': self.small.id, 'price': '160.00'},
+                {'portion_id': self.large.id, 'price': '200.00', 'is_default': True},
+            ]},
+        ] + [
+            {'category': 'Сезонное', 'name': f'Напиток {i}', 'variants': [
+                {'portion_id': self.small.id, 'price': '180.00', 'is_default': True},
+            ]} for i in range(20)
+        ]}
+        with self.assertNumQueries(14):
+            response = self.api_client.post(reverse('menu-import'), document, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['categories']['created'], ['Сезонное'])
+        self.assertEqual(len(response.data['items']['created']), 20)
+        self.assertEqual(response.data['items']['unchanged'], 1)
+        self.assertEqual(response.data['variants'], {'created': 21, 'updated': 1, 'unchanged': 0})
+
+        self.latte_small.refresh_from_db()
+        self.assertEqual(self.latte_small.price, Decimal('160.00'))
+        self.assertFalse(self.latte_small.is_default)
+        self.assertEqual(MenuItem.objects.filter(category__name='Сезонное').count(), 20)
+
+    def test_invalid_document_changes_nothing(self):
+        document = {'items': [
+            {'category': 'Новое', 'name': 'Чай', 'variants': [{'portion_id': 999, 'price': '10'}]},
+        ]}
+        response = self.api_client.post(reverse('menu-import'), document, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Category.objects.filter(name='Новое').exists())
+
+    def test_csv_round_trip(self):
+        response = self.api_client.get(reverse('menu-export'), {'export_format': 'csv'})
+        text = b''.join(response.streaming_content).decode('utf-8')
+        text = text.replace('150.00', '155.00')
+        upload = SimpleUploadedFile('menu.csv', text.encode('utf-8'), content_type='text/csv')
+        response = self.api_client.post(reverse('menu-import'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['variants']['updated'], 1)
+        self.latte_small.refresh_from_db()
+        self.assertEqual(self.latte_small.price, Decimal('155.00'))
+
+    def test_raw_csv_body(self):
+        body = f'name,category_id,portion_id,price\nЛатте,{self.coffee.id},{self.small.id},170\n'
+        response = self.api_client.post(reverse('menu-import'), body, content_type='text/csv')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.latte_small.refresh_from_db()
+        self.assertEqual(self.latte_small.price, Decimal('170.00'))
+
+    def test_omitted_fields_are_left_unchanged(self):
+        MenuItem.objects.filter(pk=self.latte.pk).update(description='Эспрессо и молоко', ingredients='молоко')
+        document = {'items': [
+            {'id': self.latte.id, 'category_id': self.coffee.id, 'name': 'Латте', 'variants': [
+                {'portion_id': self.small.id, 'price': '165.00'},
+                {'portion_id': self.large.id, 'price': '210.00'},
+            ]},
+        ]}
+        response = self.api_client.post(reverse('menu-import'), document, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['items']['unchanged'], 1)
+        self.latte.refresh_from_db()
+        self.assertEqual((self.latte.description, self.latte.ingredients), ('Эспрессо и молоко', 'молоко'))
+        self.latte_small.refresh_from_db()
+        self.assertEqual(self.latte_small.price, Decimal('165.00'))
+        self.assertTrue(self.latte_small.is_default)
+        self.assertFalse(ItemVariant.objects.get(menu_item=self.latte, portion=self.large).is_default)
+
+    def test_json_export(self):
+        response = self.api_client.get(reverse('menu-export'))
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data['items'][0]['name'], 'Латте')
+        self.assertEqual(data['items'][0]['variants'][0]['price'], '150.00')
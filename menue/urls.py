@@ -1,6 +1,9 @@
 from django.urls import path
 from .views import (
     MenuTreeView, 
+    MenuChangesView,
+    MenuImportView,
+    MenuExportView,
     MenuItemListCreateView, 
     MenuItemRetrieveUpdateDestroyView, 
     MenuItemImageUpdateView,
@@ -13,6 +16,9 @@ from .views import (
 urlpatterns = [
     # Меню и товары
     path('menu-tree/', MenuTreeView.as_view(), name='menu-tree'),
+    path('menu/changes/', MenuChangesView.as_view(), name='menu-changes'),
+    path('menu/import/', MenuImportView.as_view(), name='menu-import'),
+    path('menu/export/', MenuExportView.as_view(), name='menu-export'),
     path('menu-items/', MenuItemListCreateView.as_view(), name='menuitem-list-create'),
     path('menu-items/<int:pk>/', MenuItemRetrieveUpdateDestroyView.as_view(), name='menuitem-detail'),
     path('menu-items/<int:pk>/image/', MenuItemImageUpdateView.as_view(), name='menuitem-image-update'),
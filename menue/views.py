@@ -1,43 +1,113 @@
+import json
 from django.shortcuts import render
-from rest_framework import generics, permissions, authentication, status
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import MenuItem, Category, Portion, ItemVariant
 from .serializers import MenuItemSerializer, CategorySerializer, PortionSerializer, ItemVariantSerializer
-from core.views import IsManager
+from .snapshot import MENU_VERSION_KEY, get_menu_tree_bytes
+from .sync import get_menu_changes
+from .bulk import MenuImport, parse_csv, stream_csv, stream_json
+from core.authentication import CachedTokenAuthentication
+from core.views import IsManager, StandardResultsSetPagination
+from core.versioning import versioned
 
 # Create your views here.
 
+class MenuItemPagination(StandardResultsSetPagination):
+    """Постраничный режим включается параметром ?page или ?page_size.
+
+    Без них список возвращается целиком, как раньше.
+    """
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.page_query_param not in params and self.page_size_query_param not in params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
 # CRUD для управляющего
 class MenuItemListCreateView(generics.ListCreateAPIView):
-    queryset = MenuItem.objects.all()
     serializer_class = MenuItemSerializer
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
+    pagination_class = MenuItemPagination
+
+    def get_queryset(self):
+        queryset = MenuItem.objects.with_variants().order_by('id')
+        category_id = self.request.query_params.get('category_id')
+        if category_id and category_id.isdigit():
+            queryset = queryset.filter(category_id=int(category_id))
+        return queryset
 
 class MenuItemRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = MenuItem.objects.all()
+    queryset = MenuItem.objects.with_variants()
     serializer_class = MenuItemSerializer
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
 # Древовидный вывод: категории с вложенными товарами
 class MenuTreeView(generics.GenericAPIView):
+    # Публичный доступ. Отдаём готовый JSON-снимок текущей версии меню (см. menue.snapshot)
+    @versioned(MENU_VERSION_KEY)
+    def get(self, request):
+        return HttpResponse(get_menu_tree_bytes(request), content_type='application/json')
+
+# Инкрементальная синхронизация меню: только изменения после версии since
+class MenuChangesView(APIView):
     # Публичный доступ
+    permission_classes = []
+
+    def get(self, request):
+        since = request.query_params.get('since', '0')
+        if not since.isdigit():
+            return Response(
+                {'error': 'since должен быть целым неотрицательным числом'}, status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(get_menu_changes(int(since), request))
+
+# Массовый импорт меню (JSON или CSV) для управляющего
+class MenuImportView(APIView):
+    permission_classes = [IsManager]
+    authentication_classes = [CachedTokenAuthentication]
+
+    def post(self, request):
+        # Тело text/csv читается до request.FILES / request.data: парсера CSV
+        # у DRF нет, и разбор тела ответил бы 415
+        is_csv_body = request.content_type.startswith('text/csv')
+        upload = None if is_csv_body else request.FILES.get('file')
+        try:
+            if is_csv_body:
+                document = parse_csv(request.body.decode('utf-8-sig'))
+            elif upload is not None:
+                text = upload.read().decode('utf-8-sig')
+                is_csv = upload.name.lower().endswith('.csv') or upload.content_type == 'text/csv'
+                document = parse_csv(text) if is_csv else json.loads(text)
+            else:
+                document = request.data
+        except ValueError as e:
+            return Response({'error': f'Не удалось прочитать файл: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        dry_run = request.query_params.get('dry_run') in ('1', 'true')
+        importer = MenuImport(document)
+        importer.validate()
+        return Response(importer.apply(dry_run=dry_run))
+
+# Потоковый экспорт меню: ?export_format=json (по умолчанию) или csv
+class MenuExportView(APIView):
+    permission_classes = [IsManager]
+    authentication_classes = [CachedTokenAuthentication]
+
     def get(self, request):
-        categories = Category.objects.all()
-        data = []
-        for cat in categories:
-            items = MenuItem.objects.filter(category=cat)
-            items_ser = MenuItemSerializer(items, many=True, context={'request': request}).data
-            cat_ser = CategorySerializer(cat, context={'request': request}).data
-            cat_ser['items'] = items_ser
-            data.append(cat_ser)
-        return Response(data)
+        if request.query_params.get('export_format') == 'csv':
+            response = StreamingHttpResponse(stream_csv(), content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename="menu.csv"'
+            return response
+        return StreamingHttpResponse(stream_json(), content_type='application/json')
 
 class MenuItemImageUpdateView(APIView):
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def patch(self, request, pk):
         try:
@@ -56,19 +126,19 @@ class PortionListCreateView(generics.ListCreateAPIView):
     queryset = Portion.objects.all()
     serializer_class = PortionSerializer
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
 class PortionRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Portion.objects.all()
     serializer_class = PortionSerializer
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
 # CRUD для вариантов товаров
 class ItemVariantListCreateView(generics.ListCreateAPIView):
     serializer_class = ItemVariantSerializer
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     
     def get_queryset(self):
         menu_item_id = self.kwargs.get('menu_item_id')
@@ -86,4 +156,4 @@ class ItemVariantRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView
     queryset = ItemVariant.objects.all()
     serializer_class = ItemVariantSerializer
     permission_classes = [IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
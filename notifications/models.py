@@ -1,7 +1,10 @@
 from django.db import models
+from django.db.models import F
 from django.utils import timezone
 import uuid
 
+from core.models import User
+
 
 class Notification(models.Model):
     """Внутренние уведомления для пользователей.
@@ -53,6 +56,8 @@ class Notification(models.Model):
         # bulk link recipients
         receipts = [NotificationReceipt(notification=n, user=u) for u in recipients]
         NotificationReceipt.objects.bulk_create(receipts)
+        # Подзапрос по адресатам, а не IN-список id: при рассылке всем клиентам их сотни тысяч
+        User.objects.filter(notification_receipts__notification=n).update(card_version=F('card_version') + 1)
         return n
 
 
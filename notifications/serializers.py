@@ -6,7 +6,7 @@ from core.models import User
 
 class NotificationSerializer(serializers.ModelSerializer):
     uid = serializers.UUIDField(read_only=True)
-    created_by_id = serializers.IntegerField(source='created_by.id', read_only=True)
+    created_by_id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Notification
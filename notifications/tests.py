@@ -1,3 +1,23 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-# Create your tests here.
+from core.models import User
+from .models import Notification
+
+
+class NotificationCreateTest(TestCase):
+    def test_cards_are_touched_without_listing_recipients(self):
+        users = [User.objects.create(phone=f"+7000777660{i}", role=User.ROLE_CLIENT) for i in range(5)]
+        versions = dict(User.objects.values_list('id', 'card_version'))
+        with CaptureQueriesContext(connection) as ctx:
+            Notification.create_for_recipients(
+                'Всем', Notification.TYPE_GENERIC, users, timezone.now() + timezone.timedelta(hours=1),
+            )
+        update = next(q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "core_user"'))
+        # Адресаты выбираются подзапросом по уведомлению, а не списком id
+        self.assertIn('SELECT', update)
+        self.assertIn('notification_id', update)
+        for user_id, version in User.objects.values_list('id', 'card_version'):
+            self.assertEqual(version, versions[user_id] + 1)
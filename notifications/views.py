@@ -1,8 +1,9 @@
-from rest_framework import generics, permissions, authentication, status
+from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from django.utils import timezone
 from .models import Notification, NotificationReceipt
 from .serializers import NotificationSerializer, NotificationSendSerializer
+from core.authentication import CachedTokenAuthentication
 from core.models import User
 
 
@@ -14,7 +15,7 @@ class IsManager(permissions.BasePermission):
 class NotificationListView(generics.ListAPIView):
     """Список активных уведомлений для текущего пользователя (не истёкших)."""
     permission_classes = [permissions.IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = NotificationSerializer
 
     def get_queryset(self):
@@ -34,7 +35,7 @@ class NotificationListView(generics.ListAPIView):
 class NotificationSendView(generics.CreateAPIView):
     """Менеджер создаёт и рассылает уведомления (всем или выборочно)."""
     permission_classes = [permissions.IsAuthenticated, IsManager]
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = NotificationSendSerializer
 
     def get_serializer_context(self):